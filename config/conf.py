@@ -7,8 +7,16 @@ VERSION = "0.0.5"
 TEST_MODE = True
 LOG_LEVEL = "DEBUG"
 
+# Local DataNode data dir(s); may be a comma separated list, as with dfs.datanode.data.dir
 HDFS_ROOT = '/hadoop/hdfs/data'
 
+# Local file in which each worker keeps its index of block ids to block file paths between runs
+SHARD_INDEX_PATH = '/var/tmp/testshred_shard_index.json'
+
+# Local file recording the setup done in HDFS, such as creating the shred directories, so runs skip checking it
+# Remove it to have the next run check the setup again
+SETUP_MARKER_PATH = '/var/tmp/testshred_setup.json'
+
 ZOOKEEPER = {
     'HOST': 'localhost',
     'PORT': 2181,
@@ -19,12 +27,105 @@ HDFS_SHRED_PATH = "/tmp/testshred"
 
 LINUXFS_SHRED_PATH = ".testshred"
 
+# Job status is recorded in append-only journals; a journal with more entries than this is compacted when next written
+JOURNAL_COMPACT_ENTRIES = 200
+# Local file locked while writing job journals, so overlapping runs on a node take turns at the journals they share
+JOURNAL_LOCK_PATH = '/var/tmp/testshred_journal.lock'
+
+# Job store files read from HDFS are cached in-process; the number of files kept, and the number of seconds content
+# is trusted before being revalidated against the file's modification time
+JOB_INFO_CACHE_SIZE = 1024
+JOB_INFO_CACHE_TTL = 5
+
+# Workers find jobs for a stage from an index of jobs by master status; with this disabled every job is scanned
+JOB_INDEX = True
+# Scans of every job read master status in pages of this many jobs, with this many concurrent reads
+JOB_SCAN_PAGE_SIZE = 500
+JOB_SCAN_THREADS = 8
+
 # Number of times to overwrite the file before writing out zeros and removing it from the filesystem
 # a SHRED_COUNT of 6 will overwrite the file 7 times; 6 with random garbage, and the 7th as zeros.
 SHRED_COUNT = 6
 
+# Engine used to shred shards in stage 5; 'coreutils' runs the linux shred command for each shard,
+# 'native' overwrites them in-process using the buffer settings below
+SHRED_ENGINE = 'coreutils'
+# Size in bytes of the reusable write buffer of the native engine, must be a multiple of 4096
+SHRED_BUFFER_SIZE = 4 * 1024 * 1024
+# Have the native engine bypass the page cache with O_DIRECT; not supported by every filesystem
+SHRED_O_DIRECT = False
+# The native engine draws random data from AES-CTR if the optional 'cryptography' module is installed
+
+# Number of shards shredded at once on each device; shards are grouped by the device of the mount they are on
+SHRED_WORKERS_PER_DEVICE = 1
+
+# Number of jobs each worker processes at once within a stage, so a job waiting on a lease, on its workers as
+# leader, or on a slow HDFS request does not hold up the others; shreds still share SHRED_WORKERS_PER_DEVICE
+MAX_JOBS_IN_FLIGHT = 4
+
+# Format of the shard dicts written to the job store for each worker, read back whichever was used
+# 'json' for a JSON dict, or 'table' for sorted block ids with a byte per status compressed with zlib, which is
+# far smaller to write and quicker to read back for jobs of many shards
+SHARD_DICT_FORMAT = 'json'
+
+# Progress checkpoints in stages 3 and 5, so a restarted worker redoes at most the shards since the last one
+# Shard dicts are persisted after this many shards or seconds, whichever comes first
+CHECKPOINT_SHARDS = 1000
+CHECKPOINT_SECONDS = 60
+# Minimum seconds between checkpoints, bounding the rate of HDFS writes however fast shards complete
+CHECKPOINT_MIN_INTERVAL = 10
+
+# Shred rate governor, so the shredder can run alongside DataNode reads
+# Limit in bytes per second of shred writes to each device, counting every pass; 0 is unlimited
+SHRED_RATE_LIMIT = 0
+# Limits for times of day as (start hour, end hour, bytes per second), in local time, overriding SHRED_RATE_LIMIT
+# A period may run over midnight, such as (22, 6, 0) to shred unlimited overnight; e.g. [(8, 18, 20 * 1024 * 1024)]
+SHRED_RATE_SCHEDULE = []
+# While a device is busier than this share of the time, per /proc/diskstats, its limit is halved, down to the minimum
+# share of the limit below; it recovers by a tenth of the limit per sample once the device is less busy
+SHRED_UTIL_THRESHOLD = 0.6
+SHRED_MIN_RATE_FACTOR = 0.05
+SHRED_UTIL_SAMPLE_SECONDS = 2
+# Shred in the idle I/O class, so shred writes are only served when a disk is otherwise idle; uses ionice for the
+# coreutils engine
+SHRED_IDLE_PRIORITY = True
+
 # Duration in minutes
 # Worker wait is delay between checks of worker activity
 WORKER_WAIT = 1
 # Leader wait is how long the each leader should wait for workers to complete distributed tasks
-LEADER_WAIT = 15
\ No newline at end of file
+LEADER_WAIT = 15
+# A worker showing no progress for this long while a stage 4 or 6 leader waits on it, such as an offline DataNode,
+# is deferred; the job goes on without it and the worker links and shreds its shards from a queue when it returns
+# Should be under LEADER_WAIT so the job goes on before the lease expires; 0 waits on every worker
+STRAGGLER_DEADLINE = 10
+# Seconds between the heartbeats a worker writes while linking or shredding a job, which the leader counts as progress
+# Should be well under STRAGGLER_DEADLINE so a worker busy in one long step is not taken for a straggler
+WORKER_HEARTBEAT = 60
+# Daemon mode reruns the stage list every DAEMON_INTERVAL seconds, plus up to DAEMON_JITTER seconds chosen at random
+# so workers do not all hit HDFS and ZooKeeper at once
+DAEMON_INTERVAL = 300
+DAEMON_JITTER = 60
+# Each run finding no work doubles the interval, up to this many seconds
+DAEMON_MAX_INTERVAL = 3600
+
+# Keep-alive HTTP connections kept open to each WebHDFS host, and the number of hosts to keep them for
+HDFS_POOL_SIZE = 16
+HDFS_POOL_HOSTS = 32
+# Concurrent requests made by batches of HDFS reads and writes, such as reading the status of every worker
+HDFS_BATCH_THREADS = 8
+# Concurrent deletes of a job's targets in stage 4; each is a recursive delete on the NameNode, so kept lower
+HDFS_DELETE_THREADS = 4
+
+# Overwrite rate in MB/s assumed by the plan mode for disks no shredder has recorded a rate for yet
+PLAN_DEFAULT_MB_PER_SECOND = 100
+
+# Source of the block locations of a job's files in stage 2; 'fsck' runs 'hdfs fsck', which starts a JVM and needs the
+# Hadoop client installed, 'webhdfs' asks the NameNode for them over WebHDFS with the HDFS client
+BLOCK_LOCATION_PROVIDER = 'fsck'
+
+# Directory of the node exporter textfile collector; each run writes its metrics to shred_<mode>.prom here
+# Set to None to disable writing metrics
+METRICS_TEXTFILE_DIR = '/var/lib/node_exporter/textfile_collector'
+# Upper bounds in seconds of the buckets of latency histograms
+METRICS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
@@ -7,26 +7,67 @@ See https://github.com/Chaffleson/hdfs-shred
 """
 
 import logging
-import logging.handlers
-from syslog_rfc5424_formatter import RFC5424Formatter
 import re
+import struct
+import zlib
+import fcntl
 import subprocess
 import sys
 import argparse
-from time import sleep
+import tempfile
+import cProfile
+import pstats
+from contextlib import contextmanager
+from functools import wraps
+from shutil import rmtree
+from time import sleep, time
+from random import uniform
+from signal import signal, SIGTERM, SIGINT
+from multiprocessing.pool import ThreadPool
+from threading import Thread, Lock, Event, BoundedSemaphore, local, current_thread
+from collections import OrderedDict
+from bisect import bisect_left
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
 from json import dumps, loads
 from datetime import timedelta as dttd
-from uuid import uuid4, UUID
+from hashlib import md5, sha512
 from socket import gethostname, gethostbyname
 from os.path import join as ospathjoin
 from os.path import split as ospathsplit
-from os.path import dirname, realpath, ismount, exists
-from os import link, makedirs
-from kazoo.client import KazooClient, KazooState
-from hdfs import Config, HdfsError
+from os.path import basename
+from fnmatch import fnmatchcase
+from os.path import dirname, realpath, ismount, exists, isdir, isfile
+from os import link, makedirs, listdir, rename, fstat, lseek, fdatasync, ftruncate, unlink, urandom
+from os import open as osopen, write as oswrite, close as osclose, O_WRONLY, SEEK_SET
+from os import stat as osstat
+from os.path import samestat
+from errno import EEXIST
+from os import major, minor
+from datetime import datetime
+from mmap import mmap
 
 from config import conf
 
+# The HDFS and ZooKeeper clients are imported by import_hdfs and import_kazoo when first used, as importing them
+# takes longer than a run with no work to do; until then these stand in for their exceptions in except clauses,
+# as nothing can raise them before the clients are imported
+Config = None
+HTTPAdapter = None
+KazooClient = None
+KazooState = None
+
+
+class HdfsError(Exception):
+    """Stands in for the HdfsError of hdfscli until import_hdfs replaces it"""
+
+
+class KazooException(Exception):
+    """Stands in for the KazooException of kazoo until import_kazoo replaces it"""
+
+
 # TODO: Build into an Ambari agent to handle distribution and monitoring perhaps?
 # Apologies to maintainers; I could not resist a few TMNT 1987 references for an application involving The Shredder...
 
@@ -38,17 +79,96 @@ except NameError:
     log = logging.getLogger('apriloneil')
 log_level = logging.getLevelName(conf.LOG_LEVEL)
 log.setLevel(log_level)
-handler = logging.handlers.SysLogHandler(address='/dev/log')
-handler.setFormatter(RFC5424Formatter())
-log.addHandler(handler)
 if conf.TEST_MODE:
     con_handler = logging.StreamHandler()
     log.addHandler(con_handler)
+# Set by setup_syslog, which the program calls as it starts rather than every import of this module
+syslog_available = None
+
+
+def setup_syslog():
+    """Adds the syslog handler to the log, or a console handler where there is no syslog socket"""
+    global syslog_available
+    if syslog_available is not None:
+        return
+    import logging.handlers
+    from syslog_rfc5424_formatter import RFC5424Formatter
+    try:
+        handler = logging.handlers.SysLogHandler(address='/dev/log')
+        handler.setFormatter(RFC5424Formatter())
+        log.addHandler(handler)
+        syslog_available = True
+    except (IOError, OSError):
+        # No syslog socket, as on a laptop or CI runner, so only the console is logged to
+        syslog_available = False
+        if not conf.TEST_MODE:
+            log.addHandler(logging.StreamHandler())
 
 # ###################     Global handles     ##########################
 
 zk = None
+zk_lock = Lock()
 hdfs = None
+shard_index = None
+shard_index_lock = Lock()
+
+# Job journal entries waiting to be appended, keyed by (job, journal name)
+# The lock also covers journal_sequence, as jobs are processed concurrently
+pending_job_info = {}
+pending_job_info_lock = Lock()
+# Read-through cache of job store files, keyed by HDFS path, as (version, time fetched, content) in LRU order
+# The version is the (modificationTime, length) of the file, or None if that was not known when it was read
+job_info_cache = OrderedDict()
+job_info_cache_lock = Lock()
+job_info_cache_stats = {'hits': 0, 'misses': 0, 'revalidations': 0, 'evictions': 0}
+# Orders journal entries written by this process within the same clock tick
+journal_sequence = 0
+# Set once the job index is known to exist in HDFS
+job_index_built = False
+# Set by SIGTERM in daemon mode; work stops at the next shard or job boundary
+shutdown_requested = Event()
+# Metrics of this process for the Prometheus textfile collector, keyed by (name, sorted label items)
+# Counters and gauges hold a number, histograms a list of bucket counts followed by the sum and count of observations
+metrics = {}
+metrics_lock = Lock()
+# Token buckets limiting the shred rate of each device, keyed by st_dev, with the last utilisation sample of the device
+device_buckets = {}
+device_buckets_lock = Lock()
+# Slots for conf.SHRED_WORKERS_PER_DEVICE shreds at once on each device, keyed by st_dev, shared by concurrent jobs
+device_slots = {}
+# File the spans of --profile are written to as JSON lines, or None while tracing is off
+trace_file = None
+trace_lock = Lock()
+# Job and stage of the work running on each thread, added to the spans it records
+trace_context = local()
+# Directory the cProfile statistics of each stage are written to by --profile-stats, or None
+profile_stats_dir = None
+# Profiles of the threads of the running stage, merged into its statistics once it completes
+stage_profiles = []
+stage_profiles_lock = Lock()
+# Aligned write buffer of the native shred engine, one per shredding thread and reused for each shard it shreds
+shred_buffers = local()
+# Random source of the native engine without the cryptography module, 'urandom' or 'hash' once timed in this process
+fallback_random_source = None
+# Mount table read by stage 3 to find the volume holding each data dir
+mountinfo_path = '/proc/self/mountinfo'
+# Source of device utilisation for the shred rate governor
+diskstats_path = '/proc/diskstats'
+# ioprio_set syscall numbers by machine, for running native shreds in the idle I/O class
+ioprio_set_syscalls = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'ppc64': 273, 'ppc64le': 273}
+metric_types = {
+    'shred_stage_runs_total': ('counter', "Runs of each stage by result"),
+    'shred_stage_duration_seconds': ('gauge', "Duration of the last run of each stage"),
+    'shred_stage_jobs_total': ('counter', "Jobs processed by each stage"),
+    'shred_hdfs_request_seconds': ('histogram', "Latency of job store reads and writes in HDFS"),
+    'shred_zookeeper_wait_seconds': ('histogram', "Time spent acquiring leader leases and waiting on barriers"),
+    'shred_shards_total': ('counter', "Shards linked in stage 3 and shredded in stage 5 by result"),
+    'shred_checkpoints_total': ('counter', "Shard dicts persisted part way through stages 3 and 5"),
+    'shred_deferred_workers_total': ('counter', "Workers a leader stopped waiting on and deferred, by stage resumed"),
+    'shred_shredded_bytes_total': ('counter', "Bytes of shard data shredded"),
+    'shred_shred_throughput_mb_per_second': ('gauge', "Shard data shredded per second by the last batch of shreds"),
+    'shred_device_utilisation': ('gauge', "Share of time a device was busy when last sampled by the shred governor"),
+}
 
 # ###################     Status and stage Flags    ##########################
 
@@ -62,6 +182,7 @@ status_success = "success"
 status_fail = "fail"
 status_is_leader = "isLeader"
 status_task_timeout = "timeout"
+status_deferred = "deferred"
 
 stage_1 = "s1"  # Init job and quarantine target HDFS files for later shredding. Tests user permissions also
 stage_2 = "s2"  # A single worker prepares central lists of shard files on nodes for later distributed processing
@@ -70,6 +191,173 @@ stage_4 = "s4"  # A single worker monitors for all worker s3 success, then delet
 stage_5 = "s5"  # All workers on each node containing shard files now shred the files
 stage_6 = "s6"  # A single worker monitors for all worker s5 success, then closes and archives the job
 
+# ###################     Parser patterns    ##########################
+
+# Compiled once as they are run against every line of fsck output
+# Block lines look like: 0. BP-929597290-192.168.0.1-1461159434758:blk_1073839025_98201 len=134217728 Live_repl=3
+# [DatanodeInfoWithStorage[172.16.0.80:50010,DS-0e5b2f33-...,DISK], DatanodeInfoWithStorage[...]]
+fsck_block_id_pattern = re.compile(":(.+?) ")
+# Captures only the IP of each location, avoiding a further split per replica
+fsck_location_ip_pattern = re.compile("DatanodeInfoWithStorage\\[([^:\\]]*)")
+# For the shred plan, which also needs the length of each block and the storage (disk) ID of each replica
+fsck_block_length_pattern = re.compile(" len=([0-9]+) ")
+fsck_location_storage_pattern = re.compile("DatanodeInfoWithStorage\\[([^:\\]]*):[^,\\]]*,([^,\\]]*)")
+# Octal escapes of characters like spaces in the paths of the mount table, e.g. \040
+mountinfo_escape_pattern = re.compile("\\\\([0-7]{3})")
+
+# ###################     Shard tables    ##########################
+
+# Shard dicts written with conf.SHARD_DICT_FORMAT = 'table' start with this in place of JSON
+shard_table_magic = b"SHRDTBL1"
+# Byte codes of shard statuses, by position
+shard_table_statuses = [status_no_init, status_init, status_skip, status_success, status_fail]
+shard_table_codes = dict((status, code) for code, status in enumerate(shard_table_statuses))
+
+
+class ShardTable(object):
+    """A compact shard dict, usable in place of a dict of shard file name or path to status in stages 3 and 5
+    Keys end in the id of a block file, e.g. blk_1073839025 or /grid/0/.shred/<job>/blk_1073839025, and are held
+    as the prefix, such as the shred dir of a volume, and the block id; the ids of each prefix are kept sorted and
+    found by bisection, beside a byte per shard for its status
+    Encoded as shard_table_magic followed by the tables compressed with zlib, ids delta encoded as int64
+    raises ValueError for a key not ending in a block id or an unknown status"""
+
+    def __init__(self, shard_dict=None):
+        self.prefixes = []
+        self.ids = []
+        self.statuses = []
+        if shard_dict:
+            grouped = {}
+            for shard, status in shard_dict.items():
+                prefix, block_id = self.split_key(shard)
+                if prefix not in grouped:
+                    grouped[prefix] = []
+                grouped[prefix].append((block_id, self.status_code(status)))
+            for prefix in sorted(grouped):
+                grouped[prefix].sort()
+                self.prefixes.append(prefix)
+                self.ids.append([block_id for block_id, _ in grouped[prefix]])
+                self.statuses.append(bytearray([code for _, code in grouped[prefix]]))
+
+    @staticmethod
+    def split_key(shard):
+        prefix, marker, block_id = shard.rpartition("blk_")
+        digits = block_id[1:] if block_id[:1] == "-" else block_id
+        # Only ids written the way str() writes them, so the key is given back unchanged
+        if not marker or not digits.isdigit() or (digits[0] == "0" and block_id != "0"):
+            raise ValueError("Shard [{0}] does not end in a block id".format(shard))
+        return prefix + marker, int(block_id)
+
+    @staticmethod
+    def status_code(status):
+        if status not in shard_table_codes:
+            raise ValueError("Status [{0}] can't be held in a shard table".format(status))
+        return shard_table_codes[status]
+
+    def locate(self, shard):
+        """returns the prefix index and position of a shard in its ids, and whether it is held"""
+        prefix, block_id = self.split_key(shard)
+        if prefix not in self.prefixes:
+            return None, 0, False
+        prefix_index = self.prefixes.index(prefix)
+        ids = self.ids[prefix_index]
+        position = bisect_left(ids, block_id)
+        return prefix_index, position, position < len(ids) and ids[position] == block_id
+
+    def __len__(self):
+        return sum(len(ids) for ids in self.ids)
+
+    def __iter__(self):
+        for prefix, ids in zip(self.prefixes, self.ids):
+            for block_id in ids:
+                yield prefix + str(block_id)
+
+    def __contains__(self, shard):
+        try:
+            return self.locate(shard)[2]
+        except ValueError:
+            return False
+
+    def __getitem__(self, shard):
+        try:
+            prefix_index, position, found = self.locate(shard)
+        except ValueError:
+            found = False
+        if not found:
+            raise KeyError(shard)
+        return shard_table_statuses[self.statuses[prefix_index][position]]
+
+    def __setitem__(self, shard, status):
+        code = self.status_code(status)
+        prefix_index, position, found = self.locate(shard)
+        if found:
+            self.statuses[prefix_index][position] = code
+            return
+        if prefix_index is None:
+            self.prefixes.append(self.split_key(shard)[0])
+            self.ids.append([])
+            self.statuses.append(bytearray())
+            prefix_index = len(self.prefixes) - 1
+        self.ids[prefix_index].insert(position, self.split_key(shard)[1])
+        self.statuses[prefix_index].insert(position, code)
+
+    def get(self, shard, default=None):
+        try:
+            return self[shard]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [shard_table_statuses[code] for statuses in self.statuses for code in statuses]
+
+    def items(self):
+        return list(zip(self.keys(), self.values()))
+
+    def update(self, shard_dict):
+        for shard, status in shard_dict.items():
+            self[shard] = status
+
+    def encode(self):
+        parts = [struct.pack("<I", len(self.prefixes))]
+        for prefix, ids, statuses in zip(self.prefixes, self.ids, self.statuses):
+            prefix_bytes = prefix.encode('utf-8')
+            # Sorted ids are stored as the difference from the one before, which compresses far better
+            deltas = [block_id - previous for block_id, previous in zip(ids, [0] + ids[:-1])]
+            parts.append(struct.pack("<II", len(prefix_bytes), len(ids)))
+            parts.append(prefix_bytes)
+            parts.append(struct.pack("<{0}q".format(len(deltas)), *deltas))
+            parts.append(bytes(statuses))
+        return shard_table_magic + zlib.compress(b"".join(parts))
+
+    @classmethod
+    def decode(cls, content):
+        """Creates a shard table from the output of encode"""
+        if content[:len(shard_table_magic)] != shard_table_magic:
+            raise ValueError("Content is not an encoded shard table")
+        payload = zlib.decompress(content[len(shard_table_magic):])
+        table = cls()
+        offset = 4
+        for _ in range(struct.unpack_from("<I", payload)[0]):
+            prefix_length, id_count = struct.unpack_from("<II", payload, offset)
+            offset += 8
+            table.prefixes.append(payload[offset:offset + prefix_length].decode('utf-8'))
+            offset += prefix_length
+            deltas = struct.unpack_from("<{0}q".format(id_count), payload, offset)
+            offset += 8 * id_count
+            ids = []
+            block_id = 0
+            for delta in deltas:
+                block_id += delta
+                ids.append(block_id)
+            table.ids.append(ids)
+            table.statuses.append(bytearray(payload[offset:offset + id_count]))
+            offset += id_count
+        return table
+
+
 # ###################          Functions           ##########################
 
 
@@ -79,49 +367,150 @@ def parse_user_args(user_args):
         description="Proof of Concept Hadoop to shred files deleted from HDFS for audit compliance."
     )
     parser.add_argument('-v', '--version', action='version', version='%(prog)s {0}'.format(conf.VERSION))
-    parser.add_argument('-m', '--mode', choices=('client', 'worker', 'shredder'),
+    parser.add_argument('-m', '--mode', choices=('client', 'worker', 'shredder', 'plan'),
                         help="Specify mode; 'client' submits a --filename to be deleted and shredded, "
                              "'worker' triggers this script to represent this Datanode when deleting a file from HDFS, "
-                             "'shredder' triggers this script to check for and shred blocks on this Datanode")
-    parser.add_argument('-f', '--filename', action="store", help="Specify a filename for the 'client' mode.")
+                             "'shredder' triggers this script to check for and shred blocks on this Datanode, "
+                             "'plan' estimates how long shredding a --filename would take without submitting it")
+    parser.add_argument('-f', '--filename', action="store",
+                        help="Specify a file, directory, or glob in the final path component for the 'client' or "
+                             "'plan' mode.")
+    parser.add_argument('-l', '--manifest', action="store",
+                        help="Specify a local file listing one HDFS path per line for the 'client' or 'plan' mode.")
+    parser.add_argument('-d', '--daemon', action="store_true",
+                        help="Keep running the 'worker' or 'shredder' stages on the interval set in the config file.")
     parser.add_argument('--debug', action="store_true", help='Increase logging verbosity.')
+    parser.add_argument('--profile', action="store", metavar='TRACE_FILE',
+                        help="Append a trace of timed operations to TRACE_FILE as JSON lines, one span per line with "
+                             "its operation, job, stage and duration.")
+    parser.add_argument('--profile-stats', action="store", metavar='DIR',
+                        help="Write the cProfile statistics of each stage run to DIR, for reading with pstats.")
     log.debug("Parsing commandline args [{0}]".format(user_args))
     result = parser.parse_args(user_args)
     if result.debug:
         log.setLevel(logging.DEBUG)
-    if result.mode is 'client' and result.filename is None:
+    if result.mode in ['client', 'plan'] and result.filename is None and result.manifest is None:
         log.error("Argparse found a bad arg combination, posting info and quitting")
-        parser.error("--mode 'client' requires a filename to register for shredding.")
-    if result.mode in ['worker', 'shredder'] and result.filename:
+        parser.error("--mode 'client' or 'plan' requires a filename or manifest to register for shredding.")
+    if result.mode in ['worker', 'shredder'] and (result.filename or result.manifest):
         log.error("Argparse found a bad arg combination, posting info and quitting")
         parser.error("--mode 'worker' or 'shredder' cannot be used to register a new filename for shredding."
                      " Please try '--mode client' instead.")
+    if result.mode in ['client', 'plan'] and result.daemon:
+        log.error("Argparse found a bad arg combination, posting info and quitting")
+        parser.error("--daemon can only be used with --mode 'worker' or 'shredder'.")
     log.debug("Argparsing complete, returning args to main function")
     # forcing target to absolute path for safety
     if result.filename:
         temp = realpath(result.filename)
         result.filename = temp
+    if result.manifest:
+        result.manifest = realpath(result.manifest)
+    if result.profile:
+        result.profile = realpath(result.profile)
+    if result.profile_stats:
+        result.profile_stats = realpath(result.profile_stats)
     return result
 
 
+def read_manifest(manifest_path):
+    """Reads a local manifest of HDFS paths to shred, one per line, ignoring blank lines and # comments
+    returns a list of absolute paths"""
+    targets = []
+    with open(manifest_path) as manifest:
+        for line in manifest:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                # forcing target to absolute path for safety
+                targets.append(realpath(line))
+    return targets
+
+
+def get_client_targets(parsed_args):
+    """Returns the list of targets submitted to the client mode, from the manifest and filename args"""
+    targets = []
+    if parsed_args.manifest:
+        targets.extend(read_manifest(parsed_args.manifest))
+    if parsed_args.filename:
+        targets.append(parsed_args.filename)
+    return targets
+
+
+def import_kazoo():
+    """Imports the kazoo ZooKeeper client the first time it is needed, replacing the stand-in KazooException"""
+    global KazooClient, KazooState, KazooException
+    if KazooClient is None:
+        from kazoo.client import KazooClient, KazooState
+        from kazoo.exceptions import KazooException
+
+
 def ensure_zk():
     """create global connection handle to ZooKeeper"""
     global zk
+    import_kazoo()
     zk_host = conf.ZOOKEEPER['HOST'] + ':' + str(conf.ZOOKEEPER['PORT'])
-    if not zk or zk.state != 'CONNECTED':
-        log.debug("Connecting to Zookeeper using host param [{0}]".format(zk_host))
-        zk = KazooClient(hosts=zk_host)
-        zk.start()
-    if zk.state is 'CONNECTED':
+    # Jobs run concurrently share the one client, so only one of them reconnects it
+    with zk_lock:
+        if not zk or zk.state != 'CONNECTED':
+            if zk:
+                # Release the threads of a lost session before replacing it, as daemon mode reconnects repeatedly
+                zk.stop()
+                zk.close()
+            log.debug("Connecting to Zookeeper using host param [{0}]".format(zk_host))
+            zk = KazooClient(hosts=zk_host)
+            zk.start()
+    if zk.state == 'CONNECTED':
         return
     else:
         raise EnvironmentError("Could not connect to ZooKeeper with configuration string [{0}],"
                                " resulting connection state was [{1}]".format(zk_host, zk.state))
 
 
+def tune_hdfs_session(client):
+    """Mounts a keep-alive connection pool on the requests session of an hdfscli client, sized for the concurrent
+    requests of hdfs_batch
+    WebHDFS redirects reads and writes to DataNodes, so a pool is kept for each of several hosts"""
+    adapter = HTTPAdapter(pool_connections=conf.HDFS_POOL_HOSTS, pool_maxsize=conf.HDFS_POOL_SIZE)
+    client._session.mount('http://', adapter)
+    client._session.mount('https://', adapter)
+
+
+def hdfs_batch(function, arg_list, threads=None):
+    """Calls function with each tuple of args in arg_list, concurrently on up to threads, or conf.HDFS_BATCH_THREADS,
+    threads
+    returns a list of results in the order of arg_list, with any HdfsError raised by a call in place of its result"""
+    if len(arg_list) < 2:
+        return [apply_hdfs_call(function, args) for args in arg_list]
+    pool = ThreadPool(min(threads or conf.HDFS_BATCH_THREADS, len(arg_list)))
+    try:
+        pending = [pool.apply_async(apply_hdfs_call, (function, args)) for args in arg_list]
+        return [async_result.get() for async_result in pending]
+    finally:
+        pool.close()
+        pool.join()
+
+
+def apply_hdfs_call(function, args):
+    """Calls function with args for hdfs_batch, returning any HdfsError raised rather than raising it"""
+    try:
+        return function(*args)
+    except HdfsError as e:
+        return e
+
+
+def import_hdfs():
+    """Imports the hdfscli HDFS client and requests the first time they are needed, replacing the stand-in HdfsError"""
+    global Config, HdfsError, HTTPAdapter
+    if Config is None:
+        from hdfs import Config, HdfsError
+        from requests.adapters import HTTPAdapter
+
+
 def ensure_hdfs():
-    """Uses HDFScli to connect to HDFS returns handle object"""
+    """Uses HDFScli to connect to HDFS returns handle object
+    The shred directories are created when first connected, unless the local setup marker shows they have been"""
     global hdfs
+    import_hdfs()
     if not hdfs:
         log.debug("Attempting to instantiate HDFS client")
         # TODO: Write try/catch for connection errors and states
@@ -133,30 +522,173 @@ def ensure_hdfs():
             except HdfsError:
                 log.error("Couldn't find HDFS config file")
                 exit(1)
+        tune_hdfs_session(hdfs)
+        if not is_setup_done('dirs'):
+            hdfs.makedirs(ospathjoin(conf.HDFS_SHRED_PATH, "jobs"))
+            hdfs.makedirs(ospathjoin(conf.HDFS_SHRED_PATH, "store"))
+            record_setup('dirs')
     if hdfs:
         return hdfs
     else:
         raise StandardError("Unable to connect to HDFS, please check your configuration and retry")
 
 
+def read_setup_marker():
+    """Reads the local setup marker, which records the setup steps done against an HDFS cluster and shred path so
+    each run need not check them again
+    returns the list of steps done against the current cluster and conf.HDFS_SHRED_PATH"""
+    try:
+        with open(conf.SETUP_MARKER_PATH) as marker_file:
+            marker = loads(marker_file.read())
+        if marker['url'] == getattr(hdfs, 'url', None) and marker['path'] == conf.HDFS_SHRED_PATH:
+            return marker['steps']
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+    return []
+
+
+def is_setup_done(step):
+    """Checks the local setup marker for a setup step done against the current cluster and shred path"""
+    return step in read_setup_marker()
+
+
+def record_setup(step):
+    """Adds a setup step to the local setup marker, replacing it atomically"""
+    steps = read_setup_marker()
+    if step in steps:
+        return
+    temp_path = conf.SETUP_MARKER_PATH + ".tmp"
+    try:
+        with open(temp_path, 'w') as marker_file:
+            marker_file.write(dumps({'url': getattr(hdfs, 'url', None), 'path': conf.HDFS_SHRED_PATH,
+                                     'steps': steps + [step]}))
+        rename(temp_path, conf.SETUP_MARKER_PATH)
+    except (IOError, OSError) as e:
+        log.warning("Could not write setup marker [{0}], setup will be checked again next run: {1}"
+                    .format(conf.SETUP_MARKER_PATH, e))
+
+
+def expand_hdfs_targets(targets):
+    """Expands globs in the final path component of each target against a listing of its parent directory in HDFS
+    returns a list of target paths, raising HdfsError if a glob's parent directory cannot be listed"""
+    expanded = []
+    for target in targets:
+        parent_path, pattern = ospathsplit(target)
+        if "*" in pattern or "?" in pattern or "[" in pattern:
+            matches = sorted([name for name in hdfs.list(parent_path) if fnmatchcase(name, pattern)])
+            log.debug("Target glob [{0}] matched [{1}] paths".format(target, len(matches)))
+            for name in matches:
+                expanded.append(ospathjoin(parent_path, name))
+        else:
+            expanded.append(target)
+    return expanded
+
+
+def get_job_targets(job):
+    """Returns the list of paths of a job's targets in its holding pen
+    Jobs submitted before bulk submission recorded a single path as a string"""
+    data_file_list = retrieve_job_info(job, "data_file_list")
+    if isinstance(data_file_list, list):
+        return data_file_list
+    return [data_file_list]
+
+
+def get_barrier_path(job, stage=None):
+    """Returns the ZooKeeper path of a job's completion barrier, or of the barrier for one of its stages"""
+    barrier_path = conf.ZOOKEEPER['PATH'] + "barrier/" + job
+    if stage is not None:
+        barrier_path += "/" + stage
+    return barrier_path
+
+
+def report_to_barrier(job, stage, worker, status):
+    """Registers a worker's result for a distributed stage on the job's barrier, waking any leader waiting on it
+    The worker status in HDFS remains the durable record, so failing to report is only logged"""
+    worker_path = get_barrier_path(job, stage) + "/" + worker
+    value = (stage + "-" + status).encode('utf-8')
+    try:
+        ensure_zk()
+        if zk.exists(worker_path):
+            zk.set(worker_path, value)
+        else:
+            zk.create(worker_path, value, makepath=True)
+    except (KazooException, EnvironmentError) as e:
+        log.warning("Worker [{0}] could not report [{1}] for stage [{2}] of job [{3}] to ZooKeeper: {4}"
+                    .format(worker, status, stage, job, e))
+
+
+def wait_for_barrier(job, stage, worker_list, timeout, reported=None):
+    """Blocks on a ZooKeeper watch until every worker in worker_list has reported to the job's barrier for the stage,
+    any worker has reported a failure, or timeout seconds have passed
+    reported, a dict of worker to report kept by the caller between calls, holds the reports it has already been woken
+    for, which do not wake it again; such as a failure left by an earlier attempt at the stage
+    Falls back to sleeping out the timeout if ZooKeeper is unavailable
+    returns True if woken by new reports from the workers"""
+    barrier_path = get_barrier_path(job, stage)
+    deadline = time() + timeout
+    woken = Event()
+    if reported is None:
+        reported = {}
+    try:
+        ensure_zk()
+        zk.ensure_path(barrier_path)
+        while True:
+            woken.clear()
+            children = zk.get_children(barrier_path, watch=lambda event: woken.set())
+            new_reports = [node for node in children if node not in reported]
+            for node in new_reports:
+                reported[node] = zk.get(barrier_path + "/" + node)[0].decode('utf-8')
+            if new_reports and (set(worker_list).issubset(reported) or
+                                any(reported[node].endswith(status_fail) for node in new_reports)):
+                return True
+            remaining = deadline - time()
+            if remaining <= 0:
+                return False
+            woken.wait(remaining)
+    except (KazooException, EnvironmentError) as e:
+        log.warning("Could not wait on ZooKeeper barrier for stage [{0}] of job [{1}], sleeping instead: {2}"
+                    .format(stage, job, e))
+        sleep(max(deadline - time(), 0))
+        return False
+
+
+def clear_barrier(job, stage=None):
+    """Removes a job's completion barrier, or that of one of its stages, from ZooKeeper"""
+    try:
+        ensure_zk()
+        zk.delete(get_barrier_path(job, stage), recursive=True)
+    except (KazooException, EnvironmentError) as e:
+        log.warning("Could not remove ZooKeeper barrier for job [{0}]: {1}".format(job, e))
+
+
 def run_shell_command(command, return_iter=True):
     """Read output of shell command
     returns an iterator or manages single line/null response"""
     log.debug("Running Shell command [{0}]".format(command))
-    # http://stackoverflow.com/a/13135985
-    p = subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT
-        )
+    span_attributes = {'command': command[0]}
     if return_iter:
-        return iter(p.stdout.readline, b'')
-    else:
+        start_time = time()
+        # http://stackoverflow.com/a/13135985
+        p = subprocess.Popen(
+                command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT
+            )
+        output = iter(p.stdout.readline, b'')
+        if trace_file is not None:
+            output = trace_iter('shell', output, span_attributes, start_time)
+        return output
+    with trace_span('shell', span_attributes):
+        p = subprocess.Popen(
+                command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT
+            )
         line = p.stdout.readline()
-        if line != '':
-            return line.rstrip()
-        else:
-            return None
+    if line != '':
+        return line.rstrip()
+    else:
+        return None
 
 
 def get_worker_identity():
@@ -166,14 +698,292 @@ def get_worker_identity():
     return worker_id
 
 
-def find_mount_point(file_path):
-    # http://stackoverflow.com/a/4453715
+def inc_metric(name, value=1, labels=None):
+    """Adds value to a counter metric"""
+    key = (name, tuple(sorted((labels or {}).items())))
+    with metrics_lock:
+        metrics[key] = metrics.get(key, 0) + value
+
+
+def set_metric(name, value, labels=None):
+    """Sets a gauge metric to value"""
+    with metrics_lock:
+        metrics[(name, tuple(sorted((labels or {}).items())))] = value
+
+
+def observe_metric(name, value, labels=None):
+    """Records an observation of value in a histogram metric with the buckets of conf.METRICS_BUCKETS"""
+    key = (name, tuple(sorted((labels or {}).items())))
+    with metrics_lock:
+        if key not in metrics:
+            metrics[key] = [0] * (len(conf.METRICS_BUCKETS) + 2)
+        histogram = metrics[key]
+        for index, bucket in enumerate(conf.METRICS_BUCKETS):
+            if value <= bucket:
+                histogram[index] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+def format_metric_labels(labels, extra_labels=None):
+    """Formats label items as a Prometheus label set, such as {mode="worker",stage="s2"}"""
+    label_items = sorted(list(labels) + list((extra_labels or {}).items()))
+    if not label_items:
+        return ""
+    return "{" + ",".join(['{0}="{1}"'.format(label, value) for label, value in label_items]) + "}"
+
+
+def format_metrics(mode):
+    """Renders the metrics of this process in the Prometheus text exposition format, labelled with the operating mode
+    returns a string"""
+    lines = []
+    with metrics_lock:
+        metric_items = sorted(metrics.items())
+    last_name = None
+    for (name, labels), value in metric_items:
+        if name != last_name:
+            metric_type, metric_help = metric_types[name]
+            lines.append("# HELP {0} {1}".format(name, metric_help))
+            lines.append("# TYPE {0} {1}".format(name, metric_type))
+            last_name = name
+        if isinstance(value, list):
+            for bucket, bucket_count in zip(conf.METRICS_BUCKETS, value):
+                lines.append("{0}_bucket{1} {2}".format(
+                    name, format_metric_labels(labels, {'mode': mode, 'le': str(bucket)}), bucket_count))
+            lines.append("{0}_bucket{1} {2}".format(
+                name, format_metric_labels(labels, {'mode': mode, 'le': "+Inf"}), value[-1]))
+            lines.append("{0}_sum{1} {2}".format(name, format_metric_labels(labels, {'mode': mode}), value[-2]))
+            lines.append("{0}_count{1} {2}".format(name, format_metric_labels(labels, {'mode': mode}), value[-1]))
+        else:
+            lines.append("{0}{1} {2}".format(name, format_metric_labels(labels, {'mode': mode}), value))
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(mode):
+    """Writes the metrics of this process to shred_<mode>.prom in conf.METRICS_TEXTFILE_DIR for the node exporter
+    The file is replaced by a rename so the collector never reads a partial file"""
+    if not conf.METRICS_TEXTFILE_DIR:
+        return
+    metrics_path = ospathjoin(conf.METRICS_TEXTFILE_DIR, "shred_" + mode + ".prom")
+    try:
+        with open(metrics_path + ".tmp", 'w') as metrics_file:
+            metrics_file.write(format_metrics(mode))
+        rename(metrics_path + ".tmp", metrics_path)
+    except (IOError, OSError) as e:
+        log.warning("Could not write metrics to [{0}]: {1}".format(metrics_path, e))
+
+
+def start_profiling(trace_path=None, stats_dir=None):
+    """Starts writing spans to the trace file at trace_path and cProfile statistics of each stage to stats_dir,
+    as set by --profile and --profile-stats"""
+    global trace_file, profile_stats_dir
+    if trace_path:
+        trace_file = open(trace_path, 'a')
+        log.info("Writing a trace of operations to [{0}]".format(trace_path))
+    if stats_dir:
+        if not isdir(stats_dir):
+            makedirs(stats_dir)
+        profile_stats_dir = stats_dir
+
+
+def stop_profiling():
+    """Closes the trace file, if one is being written"""
+    global trace_file
+    with trace_lock:
+        if trace_file is not None:
+            trace_file.close()
+            trace_file = None
+
+
+def set_trace_context(context):
+    """Sets the job and stage added to the spans recorded by this thread"""
+    trace_context.job = context.get('job')
+    trace_context.stage = context.get('stage')
+
+
+def get_trace_context():
+    """returns the job and stage of this thread's spans as a dict, to carry over to threads started for its work"""
+    return {'job': getattr(trace_context, 'job', None), 'stage': getattr(trace_context, 'stage', None)}
+
+
+def write_span(operation, start_time, duration, attributes=None, error=None):
+    """Writes a span of the trace as a JSON line"""
+    span = get_trace_context()
+    span.update(attributes or {})
+    span.update({'op': operation, 'start': round(start_time, 6), 'seconds': round(duration, 6),
+                 'thread': current_thread().name})
+    if error is not None:
+        span['error'] = error
+    with trace_lock:
+        if trace_file is not None:
+            trace_file.write(dumps(span, sort_keys=True) + "\n")
+            trace_file.flush()
+
+
+@contextmanager
+def trace_span(operation, attributes=None):
+    """Times the enclosed operation as a span of the trace when --profile is set, naming any error it raises"""
+    if trace_file is None:
+        yield
+        return
+    start_time = time()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        write_span(operation, start_time, time() - start_time, attributes, error)
+
+
+def trace_job_store(function):
+    """Decorates a job store function taking (job, component, ...) to record each call as a span of the trace, with
+    the job and component it was called for, as it may be called from threads of hdfs_batch"""
+    @wraps(function)
+    def traced_function(*args, **kwargs):
+        if trace_file is None:
+            return function(*args, **kwargs)
+        with trace_span(function.__name__, {'job': args[0], 'component': args[1]}):
+            return function(*args, **kwargs)
+    return traced_function
+
+
+def trace_iter(operation, iterator, attributes=None, start_time=None):
+    """Yields the items of an iterator, such as the output of a shell command, recording a span of the trace from
+    start_time, or the first item, until it is exhausted or abandoned"""
+    if start_time is None:
+        start_time = time()
+    error = None
+    try:
+        for item in iterator:
+            yield item
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        write_span(operation, start_time, time() - start_time, attributes, error)
+
+
+def run_traced(operation, function, args, context):
+    """Runs function with args as a span of the trace, with the job and stage in context set for this thread
+    Under --profile-stats the call is also profiled; cProfile only sees the thread it runs on, so each thread keeps
+    its own profile for write_stage_profile to merge"""
+    outer_context = get_trace_context()
+    set_trace_context(context)
+    try:
+        with trace_span(operation):
+            if profile_stats_dir is None:
+                return function(*args)
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(function, *args)
+            finally:
+                with stage_profiles_lock:
+                    stage_profiles.append(profiler)
+    finally:
+        set_trace_context(outer_context)
+
+
+def write_stage_profile(stage):
+    """Merges the profiles of the threads that ran a stage into one statistics file in the --profile-stats dir,
+    named shred_<stage>_<time>.prof"""
+    with stage_profiles_lock:
+        profiles = stage_profiles[:]
+        del stage_profiles[:]
+    if profile_stats_dir is None or not profiles:
+        return
+    stats_path = ospathjoin(profile_stats_dir, "shred_{0}_{1}.prof".format(
+        stage, datetime.now().strftime("%Y%m%dT%H%M%S")))
+    try:
+        stats = pstats.Stats(profiles[0])
+        for profiler in profiles[1:]:
+            stats.add(profiler)
+        stats.dump_stats(stats_path)
+        log.info("Wrote profile of stage [{0}] to [{1}]".format(stage, stats_path))
+    except (IOError, OSError) as e:
+        log.warning("Could not write profile of stage [{0}] to [{1}]: {2}".format(stage, stats_path, e))
+
+
+def read_mount_points():
+    """Reads the mount points of this process from the mount table at mountinfo_path
+    returns them longest first, so the first that prefixes a path is the mount holding it, or None if unreadable"""
+    mount_points = set()
+    try:
+        with open(mountinfo_path) as mountinfo:
+            for line in mountinfo:
+                fields = line.split(" ")
+                if len(fields) > 4:
+                    # Spaces and other awkward characters in paths are escaped as octal, e.g. \040
+                    mount_points.add(mountinfo_escape_pattern.sub(lambda match: chr(int(match.group(1), 8)),
+                                                                  fields[4]))
+    except (IOError, OSError) as e:
+        log.debug("Could not read mount table [{0}], mounts will be found with ismount: {1}"
+                  .format(mountinfo_path, e))
+        return None
+    return sorted(mount_points, key=len, reverse=True)
+
+
+def find_mount_point(file_path, mount_points=None):
+    """Finds the mount point of the volume holding file_path, from a list given by read_mount_points if available"""
     file_path = realpath(file_path)
+    if mount_points is not None:
+        for mount_point in mount_points:
+            if file_path == mount_point or file_path.startswith(mount_point.rstrip("/") + "/"):
+                return mount_point
+    # http://stackoverflow.com/a/4453715
     while not ismount(file_path):
         file_path = dirname(file_path)
     return file_path
 
 
+def get_volume_map():
+    """Maps each local data dir to the mount point of the volume holding it, reading the mount table once
+    returns a list of (data dir, mount point), longest data dir first"""
+    mount_points = read_mount_points()
+    volume_map = []
+    for data_dir in get_data_dirs():
+        volume_map.append((data_dir.rstrip("/"), find_mount_point(data_dir, mount_points)))
+    return sorted(volume_map, key=lambda volume: len(volume[0]), reverse=True)
+
+
+def find_shard_volume(shard_file_path, volume_map):
+    """Finds the mount point of a shard file from the data dir holding it, per a map from get_volume_map"""
+    for data_dir, mount_point in volume_map:
+        if shard_file_path.startswith(data_dir + "/"):
+            return mount_point
+    return find_mount_point(shard_file_path)
+
+
+def iter_fsck_blocks(raw_fsck):
+    """
+    Streaming parser for FSCK output
+    Takes an iterator of the hdfs fsck output
+    Yields a (datanode IP, blk id) tuple for each replica of each block
+    example: ('172.16.0.80', 'blk_1073839025')
+    """
+    for current_line in raw_fsck:
+        if current_line[:1].isdigit():
+            block_id = fsck_block_id_pattern.search(current_line).group(1).rpartition("_")[0]
+            for dn_ip in fsck_location_ip_pattern.findall(current_line):
+                yield dn_ip, block_id
+
+
+def iter_fsck_replicas(raw_fsck):
+    """
+    Streaming parser for FSCK output giving the detail needed for a shred plan
+    Takes an iterator of the hdfs fsck output
+    Yields a (datanode IP, storage ID, blk id, block length) tuple for each replica of each block
+    example: ('172.16.0.80', 'DS-0e5b2f33-7c4e-4d6b-9c47-5a2f0f6d8f7e', 'blk_1073839025', 500)
+    """
+    for current_line in raw_fsck:
+        if current_line[:1].isdigit():
+            block_id = fsck_block_id_pattern.search(current_line).group(1).rpartition("_")[0]
+            block_length = int(fsck_block_length_pattern.search(current_line).group(1))
+            for dn_ip, storage_id in fsck_location_storage_pattern.findall(current_line):
+                yield dn_ip, storage_id, block_id, block_length
+
+
 def parse_fsck_iter(raw_fsck):
     """
     Separate parser for FSCK output to make maintenance easier
@@ -181,23 +991,289 @@ def parse_fsck_iter(raw_fsck):
     Returns a dict keyed by IP of each datanode with a list of blk ids
     example: {'172.16.0.80': ['blk_1073839025'], '172.16.0.40': ['blk_1073839025'], '172.16.0.50': ['blk_1073839025']}
     """
+    return group_block_locations(iter_fsck_blocks(raw_fsck))
+
+
+def group_block_locations(block_locations):
+    """Groups an iterator of (datanode IP, blk id) tuples from a block location provider by datanode
+    Returns a dict keyed by IP of each datanode with a list of blk ids"""
     output = {}
-    for current_line in raw_fsck:
-        if current_line[0].isdigit():
-            output_split = current_line.split("[", 1)
-            block_id = re.search(':(.+?) ', output_split[0]).group(1).rpartition("_")
-            block_by_data_nodes = re.findall("DatanodeInfoWithStorage\[(.*?)\]", output_split[1])
-            for block in block_by_data_nodes:
-                dn_ip = block.split(":", 1)
-                if dn_ip[0] not in output:
-                    output[dn_ip[0]] = []
-                output[dn_ip[0]].append(block_id[0])
-    log.debug("FSCK parser output [{0}]".format(output))
+    block_count = 0
+    for dn_ip, block_id in block_locations:
+        if dn_ip not in output:
+            output[dn_ip] = []
+        output[dn_ip].append(block_id)
+        block_count += 1
+    log.debug("Block locations found [{0}] block replicas across [{1}] datanodes".format(block_count, len(output)))
     return output
 
 
+def spool_fsck_iter(raw_fsck, spool_dir):
+    """
+    Streams FSCK output into one local file per datanode, one blk id per line, so the block lists of very large
+    targets never have to be held in memory together
+    Returns a dict keyed by IP of each datanode with the path of its spool file
+    """
+    return spool_block_locations(iter_fsck_blocks(raw_fsck), spool_dir)
+
+
+def spool_block_locations(block_locations, spool_dir):
+    """Writes an iterator of (datanode IP, blk id) tuples from a block location provider to one local file per datanode
+    Returns a dict keyed by IP of each datanode with the path of its spool file"""
+    spool_files = {}
+    block_count = 0
+    try:
+        for dn_ip, block_id in block_locations:
+            if dn_ip not in spool_files:
+                spool_files[dn_ip] = open(ospathjoin(spool_dir, dn_ip), 'w')
+            spool_files[dn_ip].write(block_id + "\n")
+            block_count += 1
+    finally:
+        for spool_file in spool_files.values():
+            spool_file.close()
+    log.debug("Spooled [{0}] block replicas across [{1}] datanodes".format(block_count, len(spool_files)))
+    output = {}
+    for dn_ip in spool_files:
+        output[dn_ip] = ospathjoin(spool_dir, dn_ip)
+    return output
+
+
+def get_block_locations_request(hdfs_path, **params):
+    """Sends the WebHDFS GET_BLOCK_LOCATIONS operation, which is not one of the HDFS client's own methods, for a path
+    Made from the client's public urls and resolve, through its requests session, trying each NameNode in turn as the
+    client does, so it doesn't depend on the client's private request handlers
+    returns the response, or raises HdfsError"""
+    import requests
+    try:
+        from urllib import quote
+    except ImportError:
+        from urllib.parse import quote
+    # The client's session carries its authentication, such as the user.name of an InsecureClient
+    session = getattr(hdfs, '_session', requests)
+    params['op'] = 'GET_BLOCK_LOCATIONS'
+    if getattr(hdfs, '_proxy', None) is not None:
+        params['doas'] = hdfs._proxy
+    error = None
+    for namenode_url in hdfs.urls:
+        url = namenode_url.rstrip('/') + '/webhdfs/v1' + quote(hdfs.resolve(hdfs_path), '/= ')
+        try:
+            response = session.request('GET', url, params=params, timeout=getattr(hdfs, '_timeout', None))
+        except requests.exceptions.RequestException as e:
+            error = HdfsError("GET_BLOCK_LOCATIONS of [{0}] failed: {1}".format(hdfs_path, e))
+            continue
+        if response.ok:
+            return response
+        try:
+            remote_exception = response.json()['RemoteException']
+            error = HdfsError(remote_exception['message'])
+            if remote_exception.get('exception') in ['RetriableException', 'StandbyException']:
+                continue
+        except (ValueError, KeyError, TypeError):
+            error = HdfsError("GET_BLOCK_LOCATIONS of [{0}] failed with HTTP status [{1}]"
+                              .format(hdfs_path, response.status_code))
+        raise error
+    raise error
+
+
+def iter_webhdfs_file_replicas(file_path, file_length):
+    """Fetches the block locations of a single file from the NameNode over WebHDFS
+    returns a list of (datanode IP, storage ID, blk id, block length) tuples, one for each replica of each block"""
+    if file_length == 0:
+        return []
+    response = get_block_locations_request(file_path, offset=0, length=file_length)
+    replicas = []
+    for located_block in response.json()['LocatedBlocks']['locatedBlocks']:
+        block_id = "blk_" + str(located_block['block']['blockId'])
+        for location in located_block['locations']:
+            replicas.append((location['ipAddr'], location.get('storageID'), block_id,
+                             located_block['block']['numBytes']))
+    return replicas
+
+
+def iter_webhdfs_file_blocks(file_path, file_length):
+    """Fetches the block locations of a single file from the NameNode over WebHDFS
+    returns a list of (datanode IP, blk id) tuples, one for each replica of each block"""
+    return [(dn_ip, block_id) for dn_ip, _, block_id, _ in iter_webhdfs_file_replicas(file_path, file_length)]
+
+
+def iter_hdfs_file_runs(dir_path):
+    """Walks a directory in HDFS depth first in listing order, as fsck does
+    Yields lists of (path, length) for each run of files between subdirectories"""
+    file_run = []
+    for name, item_status in hdfs.list(dir_path, status=True):
+        item_path = ospathjoin(dir_path, name)
+        if item_status['type'] == 'DIRECTORY':
+            if file_run:
+                yield file_run
+                file_run = []
+            for sub_run in iter_hdfs_file_runs(item_path):
+                yield sub_run
+        else:
+            file_run.append((item_path, item_status['length']))
+    if file_run:
+        yield file_run
+
+
+def iter_webhdfs_blocks(target, file_function=iter_webhdfs_file_blocks):
+    """
+    Block location provider using WebHDFS in place of hdfs fsck, so no JVM is started
+    Walks the target in the order of fsck, fetching the block locations of each run of files concurrently
+    Yields the same (datanode IP, blk id) tuples as iter_fsck_blocks, or those of file_function for each file
+    """
+    target_status = hdfs.status(target)
+    if target_status['type'] == 'FILE':
+        file_lists = [[(target, target_status['length'])]]
+    else:
+        file_lists = iter_hdfs_file_runs(target)
+    for file_list in file_lists:
+        for replicas in hdfs_batch(file_function, file_list):
+            if isinstance(replicas, HdfsError):
+                raise replicas
+            for replica in replicas:
+                yield replica
+
+
+def get_block_location_provider():
+    """Gets the block location provider set by conf.BLOCK_LOCATION_PROVIDER, falling back to fsck if it is webhdfs
+    but the HDFS client doesn't expose the NameNode urls that GET_BLOCK_LOCATIONS is sent to"""
+    if conf.BLOCK_LOCATION_PROVIDER == 'webhdfs' and not (hasattr(hdfs, 'urls') and hasattr(hdfs, 'resolve')):
+        log.warning("HDFS client [{0}] has no NameNode urls for GET_BLOCK_LOCATIONS, using fsck for block locations"
+                    .format(type(hdfs).__name__))
+        return 'fsck'
+    return conf.BLOCK_LOCATION_PROVIDER
+
+
+def get_block_locations(target):
+    """Gets the block locations of every file in the target from the provider set by conf.BLOCK_LOCATION_PROVIDER
+    returns an iterator of (datanode IP, blk id) tuples"""
+    provider = get_block_location_provider()
+    if provider == 'webhdfs':
+        return iter_webhdfs_blocks(target)
+    elif provider == 'fsck':
+        return iter_fsck_blocks(run_shell_command(["hdfs", "fsck", target, "-files", "-blocks", "-locations"]))
+    else:
+        raise StandardError("Unrecognised block location provider [{0}] in configuration"
+                            .format(conf.BLOCK_LOCATION_PROVIDER))
+
+
+def get_block_replicas(target):
+    """Gets the replicas of every block in the target, with their sizes and disks, from the provider set by
+    conf.BLOCK_LOCATION_PROVIDER
+    returns an iterator of (datanode IP, storage ID, blk id, block length) tuples"""
+    provider = get_block_location_provider()
+    if provider == 'webhdfs':
+        return iter_webhdfs_blocks(target, iter_webhdfs_file_replicas)
+    elif provider == 'fsck':
+        return iter_fsck_replicas(run_shell_command(["hdfs", "fsck", target, "-files", "-blocks", "-locations"]))
+    else:
+        raise StandardError("Unrecognised block location provider [{0}] in configuration"
+                            .format(conf.BLOCK_LOCATION_PROVIDER))
+
+
+def update_job_index(job, old_status, new_status):
+    """Moves the marker for a job in the job index from the directory of its old master status to the new one
+    The index holds an empty file at index/<stage>-<status>/<job> for every job, grouping them by master status"""
+    index_path = ospathjoin(conf.HDFS_SHRED_PATH, "index")
+    new_marker = ospathjoin(index_path, new_status, job)
+    if old_status == new_status:
+        return
+    if old_status is not None:
+        old_marker = ospathjoin(index_path, old_status, job)
+        try:
+            hdfs.rename(old_marker, new_marker)
+            return
+        except HdfsError:
+            # The old marker is missing, or this is the first job to reach the new status
+            pass
+    hdfs.write(new_marker, "", overwrite=True)
+    if old_status is not None:
+        hdfs.delete(old_marker)
+
+
+def scan_job_master(job_file, rebuild_index=False):
+    """Reads the master status of a job from its listing in the job list, optionally adding it to the job index"""
+    job_status = retrieve_job_info(job_file[0], "master", strict=False, file_status=job_file[1])
+    if rebuild_index and job_status is not None:
+        hdfs.write(ospathjoin(conf.HDFS_SHRED_PATH, "index", job_status, job_file[0]), "", overwrite=True)
+    return job_status
+
+
+def is_abandoned(file_status):
+    """Checks whether a master status, by the file status of its file in the job list, was written longer ago than a
+    leader lease lasts, so a leader that set it is gone or has timed out and another worker may take the job over"""
+    return time() * 1000 - file_status['modificationTime'] > conf.LEADER_WAIT * 60000
+
+
+def order_leader_jobs(job_list, worker):
+    """Orders jobs by a hash of each job with the worker, as in rendezvous hashing, so that every worker tries the
+    leases of leader tasks in its own order and workers lead different jobs at once rather than queueing for one"""
+    return sorted(job_list, key=lambda job: md5((worker + job).encode('utf-8')).hexdigest())
+
+
+def parse_job_id(name):
+    """Validates the name of a file in the job list or job index as a job ID
+    uuid is imported on first use as it loads ctypes, which a run finding no jobs has no need of
+    returns the job UUID4 string, or None if name is not one"""
+    from uuid import UUID
+    try:
+        return str(UUID(name, version=4))
+    except ValueError:
+        return None
+
+
+def scan_jobs(target_status, rebuild_index=False, abandoned_status=None):
+    """Finds jobs in any of the target status by reading the master status of every job in the job list
+    Jobs in any abandoned status are only found once is_abandoned
+    Master files are read a page of conf.JOB_SCAN_PAGE_SIZE at a time with conf.JOB_SCAN_THREADS concurrent reads
+    returns list of job UUID4 strings"""
+    worker_job_list = []
+    if abandoned_status is None:
+        abandoned_status = []
+    # check if dir exists as worker my load before client is ever used
+    job_path = ospathjoin(conf.HDFS_SHRED_PATH, "jobs")
+    job_dir_exists = None
+    try:
+        # hdfscli strict=False returns None rather than an Error if Dir not found
+        job_dir_exists = hdfs.content(job_path, strict=False)
+    except AttributeError:
+        log.error("HDFS Client not connected")
+    if job_dir_exists is not None:
+        # if job dir exists, get listing and any files
+        job_files = [item for item in hdfs.list(job_path, status=True) if item[1]['type'] == 'FILE']
+        pool = ThreadPool(conf.JOB_SCAN_THREADS)
+        try:
+            for page_start in range(0, len(job_files), conf.JOB_SCAN_PAGE_SIZE):
+                page = job_files[page_start:page_start + conf.JOB_SCAN_PAGE_SIZE]
+                page_status = pool.map(lambda item: scan_job_master(item, rebuild_index), page)
+                for item, job_status in zip(page, page_status):
+                    if job_status in target_status or (job_status in abandoned_status and is_abandoned(item[1])):
+                        # item[0] is the filename, which for master status' is the job ID as a string
+                        # we shall be OCD about things and validate it however.
+                        job_id = parse_job_id(item[0])
+                        if job_id is not None:
+                            worker_job_list.append(job_id)
+        finally:
+            pool.close()
+            pool.join()
+    return worker_job_list
+
+
+def ensure_job_index():
+    """Checks the job index exists, building it from a scan of the job list the first time it is used"""
+    global job_index_built
+    if not job_index_built and not is_setup_done('job_index'):
+        built_marker = ospathjoin(conf.HDFS_SHRED_PATH, "index", "_built")
+        if hdfs.status(built_marker, strict=False) is None:
+            log.info("Job index not found, building it from a scan of the job list")
+            scan_jobs([], rebuild_index=True)
+            hdfs.write(built_marker, "", overwrite=True)
+        record_setup('job_index')
+    job_index_built = True
+
+
 def get_jobs(stage):
     """Prepares a cleaned job list suitable for the stage requested from all active jobs
+    Jobs are looked up in the job index by master status, or found by a scan of all jobs if it is disabled
     returns list of job UUID4 strings"""
     worker_job_list = []
     target_status = []
@@ -216,81 +1292,1003 @@ def get_jobs(stage):
             stage_4 + "-" + status_success,
             stage_6 + "-" + status_task_timeout
         ]
-    # check if dir exists as worker my load before client is ever used
-    job_path = ospathjoin(conf.HDFS_SHRED_PATH, "jobs")
-    job_dir_exists = None
-    try:
-        # hdfscli strict=False returns None rather than an Error if Dir not found
-        job_dir_exists = hdfs.content(job_path, strict=False)
-    except AttributeError:
-        log.error("HDFS Client not connected")
-    if job_dir_exists is not None:
-        # if job dir exists, get listing and any files
-        dir_listing = hdfs.list(job_path, status=True)
-        for item in dir_listing:
-            if item[1]['type'] == 'FILE':
-                # item[0] is the filename, which for master status' is the job ID as a string
-                # we shall be OCD about things and validate it however.
-                job_status = retrieve_job_info(item[0], "master")
-                if job_status in target_status:
-                    try:
-                        job_id = UUID(item[0], version=4)
-                        worker_job_list.append(str(job_id))
-                    except ValueError:
-                        pass
+        if stage == stage_6:
+            # Jobs kept open for deferred workers are checked again until they have shredded their shards
+            target_status.append(stage_6 + "-" + status_deferred)
+    abandoned_status = []
+    if stage in [stage_2, stage_4, stage_6]:
+        # Leader tasks started by a worker that has since died are taken over once its lease must have expired
+        abandoned_status = [stage + "-" + status_init]
+    if not conf.JOB_INDEX:
+        return scan_jobs(target_status, abandoned_status=abandoned_status)
+    ensure_job_index()
+    for status in target_status + abandoned_status:
+        status_path = ospathjoin(conf.HDFS_SHRED_PATH, "index", status)
+        try:
+            indexed_jobs = hdfs.list(status_path)
+        except HdfsError:
+            # No job has reached this status yet
+            continue
+        if status in abandoned_status:
+            # Markers keep their time through renames, so the age is taken from the master status of each job
+            master_status_list = hdfs_batch(hdfs.status, [
+                (ospathjoin(conf.HDFS_SHRED_PATH, "jobs", job), False) for job in indexed_jobs
+            ])
+            indexed_jobs = [job for job, master_status in zip(indexed_jobs, master_status_list)
+                            if isinstance(master_status, dict) and is_abandoned(master_status)]
+        # The master status is authoritative, markers left behind by an interrupted update are removed
+        job_status_list = hdfs_batch(retrieve_job_info, [(job, "master", False) for job in indexed_jobs])
+        stale_markers = []
+        for job, job_status in zip(indexed_jobs, job_status_list):
+            if job_status != status:
+                log.debug("Removing stale job index marker [{0}] from [{1}]".format(job, status))
+                stale_markers.append((ospathjoin(status_path, job),))
+                continue
+            job_id = parse_job_id(job)
+            if job_id is not None:
+                worker_job_list.append(job_id)
+        hdfs_batch(hdfs.delete, stale_markers)
     return worker_job_list
 
 
+def get_data_dirs():
+    """Returns the list of local DataNode data dirs, conf.HDFS_ROOT may be comma separated like dfs.datanode.data.dir"""
+    return [data_dir.strip() for data_dir in conf.HDFS_ROOT.split(",") if data_dir.strip()]
+
+
+def load_shard_index():
+    """Loads the local block file index from disk, or returns an empty index if it is missing or unusable
+    The index holds [mtime, subdirs, block files] for every directory under the data dirs, and a derived
+    lookup of block id to block file path"""
+    index = {'roots': get_data_dirs(), 'dirs': {}, 'blocks': {}}
+    try:
+        with open(conf.SHARD_INDEX_PATH) as index_file:
+            stored = loads(index_file.read())
+        if stored.get('roots') == index['roots']:
+            index['dirs'] = stored['dirs']
+    except (IOError, OSError, ValueError, KeyError, AttributeError) as e:
+        log.debug("Could not load shard index from [{0}], a full walk will be made: {1}"
+                  .format(conf.SHARD_INDEX_PATH, e))
+    for dir_path in index['dirs']:
+        add_dir_to_shard_index(index, dir_path)
+    return index
+
+
+def save_shard_index(index):
+    """Persists the directory listings of the block file index to local disk, replacing the old copy atomically"""
+    temp_path = conf.SHARD_INDEX_PATH + ".tmp"
+    try:
+        with open(temp_path, 'w') as index_file:
+            index_file.write(dumps({'roots': index['roots'], 'dirs': index['dirs']}))
+        rename(temp_path, conf.SHARD_INDEX_PATH)
+    except (IOError, OSError) as e:
+        log.warning("Could not save shard index to [{0}], it will be rebuilt next run: {1}"
+                    .format(conf.SHARD_INDEX_PATH, e))
+
+
+def add_dir_to_shard_index(index, dir_path):
+    """Adds the block files of an indexed directory to the block lookup
+    A block id seen in two places is marked ambiguous with None so that find_shard falls back to a find"""
+    for block in index['dirs'][dir_path][2]:
+        block_path = ospathjoin(dir_path, block)
+        if block in index['blocks'] and index['blocks'][block] != block_path:
+            index['blocks'][block] = None
+        else:
+            index['blocks'][block] = block_path
+
+
+def remove_dir_from_shard_index(index, dir_path):
+    """Removes the block files of an indexed directory from the block lookup"""
+    for block in index['dirs'][dir_path][2]:
+        if index['blocks'].get(block) == ospathjoin(dir_path, block):
+            del index['blocks'][block]
+
+
+def refresh_shard_index(index):
+    """Walks the data dirs, relisting only directories whose mtime has changed since the last walk
+    Unchanged directories cost a single stat, as their subdirs and block files are taken from the index
+    returns the number of directories added, relisted or removed"""
+    changed = 0
+    seen = set()
+    pending = list(index['roots'])
+    while pending:
+        dir_path = pending.pop()
+        try:
+            dir_mtime = osstat(dir_path).st_mtime
+        except OSError:
+            continue
+        seen.add(dir_path)
+        entry = index['dirs'].get(dir_path)
+        if entry is None or entry[0] != dir_mtime:
+            subdirs = []
+            blocks = []
+            for name in listdir(dir_path):
+                # DataNode block files are named blk_<id>, with a blk_<id>_<genstamp>.meta file alongside
+                if name.startswith("blk_") and not name.endswith(".meta"):
+                    blocks.append(name)
+                elif isdir(ospathjoin(dir_path, name)):
+                    subdirs.append(name)
+            if entry is not None:
+                remove_dir_from_shard_index(index, dir_path)
+            entry = [dir_mtime, subdirs, blocks]
+            index['dirs'][dir_path] = entry
+            add_dir_to_shard_index(index, dir_path)
+            changed += 1
+        for subdir in entry[1]:
+            pending.append(ospathjoin(dir_path, subdir))
+    for dir_path in [indexed for indexed in index['dirs'] if indexed not in seen]:
+        remove_dir_from_shard_index(index, dir_path)
+        del index['dirs'][dir_path]
+        changed += 1
+    log.debug("Shard index refresh updated [{0}] directories, now tracking [{1}] block files"
+              .format(changed, len(index['blocks'])))
+    return changed
+
+
+def ensure_shard_index(refresh=False):
+    """Loads the global block file index, refreshing it on first use in this run or when asked"""
+    global shard_index
+    if shard_index is None:
+        shard_index = load_shard_index()
+        refresh = True
+    if refresh:
+        with trace_span('refresh_shard_index'):
+            changed = refresh_shard_index(shard_index)
+        if changed > 0:
+            save_shard_index(shard_index)
+    return shard_index
+
+
 def find_shard(shard):
-    """Finds a file in the local node filesystem, used to find shards in the local HDFS directory"""
-    find_iter = run_shell_command(["find", conf.HDFS_ROOT, "-name", shard])
-    found_files = []
-    for line in find_iter:
-        found_files.append(line.rstrip('\n'))
-    # TODO: Handle multiple files found or file missing
-    if len(found_files) == 1:
-        this_file = found_files[0]
-        return this_file
+    """Finds a file in the local node filesystem, used to find shards in the local HDFS directory
+    Looks the shard up in the block file index, rescanning changed directories once on a miss"""
+    # The index is shared by jobs run concurrently and refreshed in place
+    with shard_index_lock:
+        ensure_shard_index()
+        this_file = shard_index['blocks'].get(shard)
+        if this_file is None or not isfile(this_file):
+            ensure_shard_index(refresh=True)
+            this_file = shard_index['blocks'].get(shard)
+        if this_file is not None:
+            return this_file
+        ambiguous = shard in shard_index['blocks']
+    if ambiguous:
+        # Ambiguous entries fall back to searching the filesystem directly
+        find_iter = run_shell_command(["find"] + get_data_dirs() + ["-name", shard])
+        found_files = []
+        for line in find_iter:
+            found_files.append(line.rstrip('\n'))
+        # TODO: Handle multiple files found or file missing
+        if len(found_files) == 1:
+            this_file = found_files[0]
+            return this_file
+    raise StandardError("Failed to retrieve path to shard [{0}]".format(shard))
+
+
+def hash_stream():
+    """Returns a function producing random data of any size per call from SHA-512 in counter mode, keyed once from
+    os.urandom; the stdlib stream for when the cryptography module is not installed"""
+    key = sha512(urandom(64))
+    pack_counter = struct.Struct(">Q").pack
+    counter = [0]
+
+    def next_random(size):
+        start = counter[0]
+        blocks = []
+        for block_number in range(start, start + (size + 63) // 64):
+            block = key.copy()
+            block.update(pack_counter(block_number))
+            blocks.append(block.digest())
+        counter[0] = start + len(blocks)
+        return b"".join(blocks)[:size]
+    return next_random
+
+
+def get_fallback_random_source(sample_size):
+    """Times a sample of os.urandom against hash_stream, once per process, as /dev/urandom is far slower than hashing
+    on older kernels but faster on recent ones
+    returns 'urandom' or 'hash'"""
+    global fallback_random_source
+    if fallback_random_source is None:
+        start_time = time()
+        urandom(sample_size)
+        urandom_seconds = time() - start_time
+        start_time = time()
+        hash_stream()(sample_size)
+        hash_seconds = time() - start_time
+        fallback_random_source = 'urandom' if urandom_seconds <= hash_seconds else 'hash'
+        log.debug("cryptography module not available, native shred engine using [{0}] for random data"
+                  .format(fallback_random_source))
+    return fallback_random_source
+
+
+def random_stream(buffer_size):
+    """Returns a function producing up to buffer_size bytes of random data per call from a single CSPRNG stream
+    Uses AES-256 in CTR mode from the optional cryptography module, seeded once from os.urandom, when available;
+    otherwise the quicker of os.urandom and hash_stream on this node"""
+    try:
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        from cryptography.hazmat.backends import default_backend
+    except ImportError:
+        if get_fallback_random_source(min(buffer_size, 1024 * 1024)) == 'urandom':
+            return urandom
+        return hash_stream()
+    encryptor = Cipher(
+        algorithms.AES(urandom(32)), modes.CTR(urandom(16)), backend=default_backend()
+    ).encryptor()
+    zeros = b'\0' * buffer_size
+
+    def next_random(size):
+        if size == buffer_size:
+            return encryptor.update(zeros)
+        return encryptor.update(zeros[:size])
+    return next_random
+
+
+def buffer_slice(buf, size):
+    """Zero-copy view of the start of a buffer, so writes from an aligned buffer stay aligned for O_DIRECT"""
+    try:
+        return buffer(buf, 0, size)
+    except NameError:
+        return memoryview(buf)[:size]
+
+
+def get_scheduled_shred_rate(now=None):
+    """Returns the shred rate limit in bytes per second for each device at the time now, or the current local time
+    The first entry of conf.SHRED_RATE_SCHEDULE covering the hour applies, otherwise conf.SHRED_RATE_LIMIT; 0 is
+    unlimited"""
+    hour = (now or datetime.now()).hour
+    for start_hour, end_hour, rate in conf.SHRED_RATE_SCHEDULE:
+        if start_hour <= end_hour and start_hour <= hour < end_hour:
+            return rate
+        # Periods ending before they start run over midnight
+        if start_hour > end_hour and (hour >= start_hour or hour < end_hour):
+            return rate
+    return conf.SHRED_RATE_LIMIT
+
+
+def read_device_io_ticks(device):
+    """Reads the milliseconds a device has spent doing I/O from /proc/diskstats
+    returns the count, or None if the device is not listed"""
+    device_numbers = (str(major(device)), str(minor(device)))
+    try:
+        with open(diskstats_path) as diskstats:
+            for line in diskstats:
+                fields = line.split()
+                if (fields[0], fields[1]) == device_numbers:
+                    return int(fields[12])
+    except (IOError, OSError, IndexError, ValueError) as e:
+        log.debug("Could not read device utilisation from [{0}]: {1}".format(diskstats_path, e))
+    return None
+
+
+def update_device_rate_factor(bucket, device, now):
+    """Samples the utilisation of a device every conf.SHRED_UTIL_SAMPLE_SECONDS, halving the share of the rate limit
+    it is shredded at while busier than conf.SHRED_UTIL_THRESHOLD and recovering a tenth at a time once it is not"""
+    elapsed = now - bucket['sampled']
+    if elapsed <= 0 or elapsed < conf.SHRED_UTIL_SAMPLE_SECONDS:
+        return
+    io_ticks = read_device_io_ticks(device)
+    if io_ticks is not None and bucket['io_ticks'] is not None:
+        utilisation = (io_ticks - bucket['io_ticks']) / 1000.0 / elapsed
+        if utilisation > conf.SHRED_UTIL_THRESHOLD:
+            bucket['factor'] = max(bucket['factor'] / 2, conf.SHRED_MIN_RATE_FACTOR)
+        else:
+            bucket['factor'] = min(bucket['factor'] + 0.1, 1.0)
+        device_label = "{0}:{1}".format(major(device), minor(device))
+        set_metric('shred_device_utilisation', round(utilisation, 3), {'device': device_label})
+    bucket['io_ticks'] = io_ticks
+    bucket['sampled'] = now
+
+
+def throttle_device(device, byte_count):
+    """Takes byte_count tokens from the bucket of a device, sleeping for as long as the bucket is in debt
+    Buckets refill at the scheduled shred rate, scaled down while the device is busy, and hold a second of tokens"""
+    rate = get_scheduled_shred_rate()
+    if not rate:
+        return
+    with device_buckets_lock:
+        now = time()
+        if device not in device_buckets:
+            device_buckets[device] = {'tokens': rate, 'updated': now, 'factor': 1.0,
+                                      'io_ticks': read_device_io_ticks(device), 'sampled': now}
+        bucket = device_buckets[device]
+        update_device_rate_factor(bucket, device, now)
+        device_rate = rate * bucket['factor']
+        bucket['tokens'] = min(device_rate, bucket['tokens'] + (now - bucket['updated']) * device_rate)
+        bucket['updated'] = now
+        bucket['tokens'] -= byte_count
+        wait = max(-bucket['tokens'] / device_rate, 0)
+    if wait > 0:
+        sleep(wait)
+
+
+def set_idle_io_priority():
+    """Puts the calling thread in the idle I/O scheduling class, so its I/O is only served when a disk is otherwise
+    idle; needs a scheduler honouring I/O priorities, such as CFQ or BFQ
+    returns True if the priority was set"""
+    import platform
+    syscall_number = ioprio_set_syscalls.get(platform.machine())
+    if syscall_number is None:
+        return False
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        # ioprio_set(IOPRIO_WHO_PROCESS, 0 for the calling thread, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+        return libc.syscall(syscall_number, 1, 0, 3 << 13) == 0
+    except (ImportError, OSError, AttributeError):
+        return False
+
+
+def get_shred_buffer(buffer_size):
+    """returns the write buffer of the calling thread, allocated on its first shard or when the size changes
+    Anonymous mmaps are page aligned, as O_DIRECT requires"""
+    buf = getattr(shred_buffers, 'buf', None)
+    if buf is None or len(buf) != buffer_size:
+        if buf is not None:
+            buf.close()
+        buf = mmap(-1, buffer_size)
+        shred_buffers.buf = buf
+    return buf
+
+
+def native_shred_shard(shard):
+    """Overwrites a shard file in-process, equivalent to 'shred -n SHRED_COUNT -z -u'
+    Makes conf.SHRED_COUNT passes of random data and a final pass of zeros through the page aligned buffer of the
+    thread, calling fdatasync after every pass, then truncates and removes the file
+    Writes are throttled by the shred rate governor of the device
+    returns None on success or the error message"""
+    buffer_size = conf.SHRED_BUFFER_SIZE
+    if conf.SHRED_IDLE_PRIORITY:
+        set_idle_io_priority()
+    flags = O_WRONLY
+    if conf.SHRED_O_DIRECT:
+        from os import O_DIRECT
+        flags |= O_DIRECT
+    try:
+        fd = osopen(shard, flags)
+    except OSError as e:
+        return str(e)
+    try:
+        # Like shred without --exact, whole 4KiB blocks are overwritten, which keeps O_DIRECT writes aligned
+        shard_stat = fstat(fd)
+        write_size = (shard_stat.st_size + 4095) // 4096 * 4096
+        buf = get_shred_buffer(buffer_size)
+        next_random = random_stream(buffer_size)
+        for pass_number in range(conf.SHRED_COUNT + 1):
+            zero_pass = pass_number == conf.SHRED_COUNT
+            if zero_pass:
+                buf.seek(0)
+                buf.write(b'\0' * buffer_size)
+            lseek(fd, 0, SEEK_SET)
+            remaining = write_size
+            while remaining > 0:
+                chunk = min(buffer_size, remaining)
+                throttle_device(shard_stat.st_dev, chunk)
+                if not zero_pass:
+                    buf.seek(0)
+                    buf.write(next_random(chunk))
+                if chunk == buffer_size:
+                    written = oswrite(fd, buf)
+                else:
+                    written = oswrite(fd, buffer_slice(buf, chunk))
+                remaining -= written
+            fdatasync(fd)
+        ftruncate(fd, 0)
+        fdatasync(fd)
+    except (OSError, IOError) as e:
+        return str(e)
+    finally:
+        osclose(fd)
+    try:
+        unlink(shard)
+    except OSError as e:
+        return str(e)
+    return None
+
+
+def shred_shard(shard):
+    """Shreds a single shard file with the engine selected by conf.SHRED_ENGINE
+    returns None on success or the error output of the engine"""
+    if conf.SHRED_ENGINE == 'native':
+        return native_shred_shard(shard)
+    elif conf.SHRED_ENGINE == 'coreutils':
+        try:
+            shard_stat = osstat(shard)
+        except OSError as e:
+            return str(e)
+        command = ['shred', '-n', str(conf.SHRED_COUNT), '-z', '-u', shard]
+        if conf.SHRED_IDLE_PRIORITY:
+            command = ['ionice', '-c', '3'] + command
+        # Shred returns 0 on success and a 'failed' message on error
+        # run_shell_command handles this behavior for us
+        shred_result = run_shell_command(command, return_iter=False)
+        # The shred command can't be throttled as it writes, so the next shard on the device waits out its writes
+        throttle_device(shard_stat.st_dev, shard_stat.st_size * (conf.SHRED_COUNT + 1))
+        return shred_result
     else:
-        raise StandardError("Failed to retrieve path to shard [{0}]".format(shard))
+        raise StandardError("Unrecognised shred engine [{0}] in configuration".format(conf.SHRED_ENGINE))
+
+
+def get_device_slots(device):
+    """returns the semaphore limiting the shreds running at once on a device across all jobs"""
+    with device_buckets_lock:
+        if device not in device_slots:
+            device_slots[device] = BoundedSemaphore(conf.SHRED_WORKERS_PER_DEVICE)
+        return device_slots[device]
+
+
+def shred_queued_shard(shard, shard_size, device, completed, context=None):
+    """Shreds a shard from the queue of shred_shards once a slot on its device is free, unless shutdown has been
+    requested; puts the shard, its size and result on the completed queue, the result is status_skip for shards
+    left unshredded, otherwise that of shred_shard
+    context is the trace context of the job the shard belongs to"""
+    shred_result = "Shred of shard did not complete"
+    if context is not None:
+        set_trace_context(context)
+    try:
+        with get_device_slots(device):
+            if shutdown_requested.is_set():
+                shred_result = status_skip
+            else:
+                with trace_span('shred_shard', {'shard': shard, 'bytes': shard_size}):
+                    shred_result = shred_shard(shard)
+    except (OSError, IOError) as e:
+        shred_result = str(e)
+    finally:
+        completed.put((shard, shard_size, device, shred_result))
+
+
+def shred_shards(shards, on_result=None):
+    """Shreds a list of shard files in parallel, grouped by the device (st_dev) of the mount holding them
+    Each device gets its own pool of conf.SHRED_WORKERS_PER_DEVICE workers so every disk is kept busy
+    without several shreds competing for the same spindle
+    on_result, if given, is called with each shard and its status as the shard completes, so progress can be saved
+    Shards not yet started when shutdown is requested are left out of the results
+    returns a dict of shard file to status"""
+    results = {}
+    device_shards = {}
+    for shard in shards:
+        try:
+            shard_stat = osstat(shard)
+        except OSError as e:
+            log.critical("Could not stat shard [{0}] for shredding: {1}".format(shard, e))
+            results[shard] = status_fail
+            if on_result is not None:
+                on_result(shard, status_fail)
+            continue
+        if shard_stat.st_dev not in device_shards:
+            device_shards[shard_stat.st_dev] = []
+        device_shards[shard_stat.st_dev].append((shard, shard_stat.st_size))
+    start_time = time()
+    pools = []
+    completed = Queue()
+    queued_count = 0
+    context = get_trace_context()
+    for device in device_shards:
+        pool = ThreadPool(conf.SHRED_WORKERS_PER_DEVICE)
+        pools.append(pool)
+        for shard, shard_size in device_shards[device]:
+            pool.apply_async(shred_queued_shard, (shard, shard_size, device, completed, context))
+            queued_count += 1
+    shredded_bytes = 0
+    # Bytes shredded and the time of the last shred on each device, for its overwrite rate
+    device_progress = {}
+    for _ in range(queued_count):
+        # Taken in the order shards complete, whichever device they are on
+        shard, shard_size, device, shred_result = completed.get()
+        if shred_result == status_skip:
+            # Not started before shutdown was requested, so left for the next run
+            continue
+        elif shred_result is not None:
+            log.critical("Failed to shred shard [{0}] with error: {1}".format(shard, shred_result))
+            results[shard] = status_fail
+        else:
+            results[shard] = status_success
+            shredded_bytes += shard_size
+            device_bytes = device_progress.get(device, (0, None))[0]
+            device_progress[device] = (device_bytes + shard_size, time())
+        if on_result is not None:
+            on_result(shard, results[shard])
+    for pool in pools:
+        pool.close()
+        pool.join()
+    elapsed = max(time() - start_time, 0.001)
+    megabytes = shredded_bytes / 1048576.0
+    log.info("Shredded [{0}] shards totalling [{1:.1f}] MB across [{2}] devices in [{3:.1f}]s; "
+             "[{4:.1f}] MB/s of shard data, [{5:.1f}] MB/s written over [{6}] passes"
+             .format(queued_count, megabytes, len(device_shards), elapsed, megabytes / elapsed,
+                     megabytes * (conf.SHRED_COUNT + 1) / elapsed, conf.SHRED_COUNT + 1))
+    for status in [status_success, status_fail]:
+        inc_metric('shred_shards_total', list(results.values()).count(status), {'stage': stage_5, 'status': status})
+    inc_metric('shred_shredded_bytes_total', shredded_bytes)
+    set_metric('shred_shred_throughput_mb_per_second', round(megabytes / elapsed, 3))
+    device_rates = {}
+    for device, (device_bytes, finish_time) in device_progress.items():
+        if finish_time > start_time:
+            device_rates[device] = device_bytes * (conf.SHRED_COUNT + 1) / 1048576.0 / (finish_time - start_time)
+    record_shred_throughput(device_rates)
+    return results
+
+
+def get_device_storage_ids():
+    """Maps the device (st_dev) of each local data dir to the storage ID the DataNode gave the disk, as shown in block
+    locations, from the VERSION file the DataNode keeps in the data dir"""
+    storage_ids = {}
+    for data_dir in get_data_dirs():
+        try:
+            with open(ospathjoin(data_dir, "current", "VERSION")) as version_file:
+                for line in version_file:
+                    if line.startswith("storageID="):
+                        storage_ids[osstat(data_dir).st_dev] = line.strip().split("=", 1)[1]
+        except (IOError, OSError):
+            continue
+    return storage_ids
+
+
+def record_shred_throughput(device_rates):
+    """Records the overwrite rate in MB/s measured on each device by storage ID in throughput/<worker> in HDFS, for
+    shred plans; each is averaged with the rate recorded before, so one unusual run doesn't dominate"""
+    storage_ids = get_device_storage_ids()
+    storage_rates = dict((storage_ids[device], rate) for device, rate in device_rates.items() if device in storage_ids)
+    if not storage_rates:
+        return
+    throughput_path = ospathjoin(conf.HDFS_SHRED_PATH, "throughput", get_worker_identity())
+    try:
+        try:
+            recorded = loads(read_job_file(throughput_path))
+        except HdfsError:
+            recorded = {}
+        for storage_id, rate in storage_rates.items():
+            if storage_id in recorded:
+                rate = (recorded[storage_id] + rate) / 2
+            recorded[storage_id] = round(rate, 3)
+        content = dumps(recorded)
+        hdfs.write(throughput_path, content, overwrite=True)
+        cache_job_info(throughput_path, None, content)
+    except HdfsError as e:
+        log.warning("Could not record shred throughput to [{0}]: {1}".format(throughput_path, e))
+
+
+def link_shard(shard_file_path, linked_shard_path):
+    """Hard links a shard file to its shred location, keeping its blocks allocated once HDFS deletes the file
+    A link already made to the same inode, by a run that stopped before its checkpoint, counts as linked"""
+    try:
+        link(shard_file_path, linked_shard_path)
+    except OSError as e:
+        if e.errno != EEXIST or not samestat(osstat(shard_file_path), osstat(linked_shard_path)):
+            raise
+
+
+def link_volume_shards(shred_dir, volume_shards, completed, context=None):
+    """Links the shards of one volume into its shred dir in turn, creating the dir first if needed
+    puts each shard, its linked path and the result on the completed queue; the result is status_skip for shards
+    left unlinked as shutdown was requested, otherwise None on success or the error
+    context is the trace context of the job the shards belong to"""
+    if context is not None:
+        set_trace_context(context)
+    try:
+        if not exists(shred_dir):
+            # apparently the exists_ok flag is only in Python2.7+
+            makedirs(shred_dir)
+        dir_error = None
+    except OSError as e:
+        dir_error = str(e)
+    for shard, shard_file_path in volume_shards:
+        linked_shard_path = ospathjoin(shred_dir, shard)
+        link_result = "Link of shard did not complete"
+        try:
+            if shutdown_requested.is_set():
+                link_result = status_skip
+            elif dir_error is not None:
+                link_result = dir_error
+            else:
+                with trace_span('link_shard', {'shard': shard}):
+                    link_shard(shard_file_path, linked_shard_path)
+                link_result = None
+        except OSError as e:
+            link_result = str(e)
+        finally:
+            completed.put((shard, linked_shard_path, link_result))
+
+
+def link_shards(job, shards, on_result=None):
+    """Links a list of (shard, shard file path) into the shred dir of the job on the volume holding each shard
+    Shards are grouped by volume using one read of the mount table, each volume's shred dir is created once, and
+    the volumes are linked in parallel with a worker each
+    on_result, if given, is called with each shard, its linked path and its status as the shard completes
+    Shards not yet linked when shutdown is requested are left out of the results
+    returns a dict of shard to status"""
+    results = {}
+    volume_map = get_volume_map()
+    volume_shards = {}
+    for shard, shard_file_path in shards:
+        shred_dir = ospathjoin(find_shard_volume(shard_file_path, volume_map), conf.LINUXFS_SHRED_PATH, job)
+        if shred_dir not in volume_shards:
+            volume_shards[shred_dir] = []
+        volume_shards[shred_dir].append((shard, shard_file_path))
+    if not volume_shards:
+        return results
+    shard_file_paths = dict(shards)
+    completed = Queue()
+    pool = ThreadPool(len(volume_shards))
+    for shred_dir in volume_shards:
+        pool.apply_async(link_volume_shards, (shred_dir, volume_shards[shred_dir], completed, get_trace_context()))
+    for _ in range(len(shards)):
+        shard, linked_shard_path, link_result = completed.get()
+        if link_result == status_skip:
+            # Not started before shutdown was requested, so left for the next run
+            continue
+        elif link_result is not None:
+            log.critical("Failed to link shard file [{0}] at loc [{1}] to shred loc [{2}]: {3}"
+                         .format(shard, shard_file_paths[shard], linked_shard_path, link_result))
+            results[shard] = status_fail
+        else:
+            results[shard] = status_success
+        inc_metric('shred_shards_total', labels={'stage': stage_3, 'status': results[shard]})
+        if on_result is not None:
+            on_result(shard, linked_shard_path, results[shard])
+    pool.close()
+    pool.join()
+    log.debug("Linked [{0}] shards across [{1}] volumes for job [{2}]".format(len(results), len(volume_shards), job))
+    return results
+
+
+def new_checkpoint():
+    """Starts counting the shards completed since the shard dicts of a worker were last persisted"""
+    return {'shards': 0, 'written': time()}
+
+
+def checkpoint_due(checkpoint, now=None):
+    """Counts a completed shard against a checkpoint from new_checkpoint
+    returns True once conf.CHECKPOINT_SHARDS shards or conf.CHECKPOINT_SECONDS seconds have passed since it was last
+    written, but never within conf.CHECKPOINT_MIN_INTERVAL seconds of that, to bound the rate of HDFS writes"""
+    if now is None:
+        now = time()
+    checkpoint['shards'] += 1
+    since_written = now - checkpoint['written']
+    if since_written < conf.CHECKPOINT_MIN_INTERVAL:
+        return False
+    return checkpoint['shards'] >= conf.CHECKPOINT_SHARDS or since_written >= conf.CHECKPOINT_SECONDS
+
+
+def persist_shard_dicts(job, worker, stage, targets_dict, linked_shard_dict=None, checkpoint=None):
+    """Persists the shard dicts of a worker for stage 3 or 5, and resets the checkpoint if given
+    A restart resumes from the last of these, redoing at most the shards completed since"""
+    if stage == stage_3:
+        persist_job_info(job, "worker_" + worker + "_source_shard_dict", stage, targets_dict)
+        persist_job_info(job, "worker_" + worker + "_linked_shard_dict", stage, linked_shard_dict)
+    elif stage == stage_5:
+        persist_job_info(job, "worker_" + worker + "_linked_shard_dict", stage, targets_dict)
+    else:
+        raise StandardError("Shard dicts are only kept for stages 3 and 5, not [{0}]".format(stage))
+    if checkpoint is not None:
+        log.debug("Worker [{0}] checkpointed [{1}] shards for stage [{2}] of job [{3}]"
+                  .format(worker, checkpoint['shards'], stage, job))
+        inc_metric('shred_checkpoints_total', labels={'stage': stage})
+        checkpoint['shards'] = 0
+        checkpoint['written'] = time()
+
+
+def persist_spooled_shard_dict(job, worker, spool_path):
+    """Persists the source shard dict of a worker for stage 2 from the local spool file of its shards"""
+    worker_shard_dict = {}
+    with open(spool_path) as spool:
+        for shard_file in spool:
+            worker_shard_dict[shard_file.rstrip("\n")] = status_no_init
+    persist_job_info(job, "worker_" + worker + "_source_shard_dict", stage_2, worker_shard_dict)
+
+
+def cache_job_info(file_path, version, content):
+    """Adds or replaces a job store file in the job info cache, evicting the least recently used beyond the limit"""
+    with job_info_cache_lock:
+        job_info_cache.pop(file_path, None)
+        job_info_cache[file_path] = (version, time(), content)
+        while len(job_info_cache) > conf.JOB_INFO_CACHE_SIZE:
+            job_info_cache.popitem(last=False)
+            job_info_cache_stats['evictions'] += 1
+
+
+def read_job_file(file_path, file_status=None, parser=None):
+    """Reads a file of the job store through the job info cache
+    Cached content is trusted for conf.JOB_INFO_CACHE_TTL seconds, then revalidated against the modification time and
+    length of the file; file_status may be passed from a directory listing to revalidate without another request
+    The content is passed through parser, if given, before being cached
+    raises HdfsError if the file can't be read"""
+    with job_info_cache_lock:
+        cached = job_info_cache.get(file_path)
+        if cached is not None and file_status is None and time() - cached[1] < conf.JOB_INFO_CACHE_TTL:
+            job_info_cache_stats['hits'] += 1
+            return cached[2]
+    if cached is not None:
+        if file_status is None:
+            with job_info_cache_lock:
+                job_info_cache_stats['revalidations'] += 1
+            file_status = hdfs.status(file_path, strict=False)
+        if file_status is not None and cached[0] == (file_status['modificationTime'], file_status['length']):
+            with job_info_cache_lock:
+                job_info_cache_stats['hits'] += 1
+            cache_job_info(file_path, cached[0], cached[2])
+            return cached[2]
+    with job_info_cache_lock:
+        job_info_cache_stats['misses'] += 1
+    start_time = time()
+    with hdfs.read(file_path) as reader:
+        content = reader.read()
+    observe_metric('shred_hdfs_request_seconds', time() - start_time, {'operation': 'read'})
+    if parser is not None:
+        content = parser(content)
+    version = None
+    if file_status is not None:
+        version = (file_status['modificationTime'], file_status['length'])
+    cache_job_info(file_path, version, content)
+    return content
+
+
+def log_job_info_cache_stats():
+    """Logs how many job store reads were served from the job info cache"""
+    log.info("Job info cache hits [{0}], misses [{1}], revalidations [{2}], evictions [{3}]"
+             .format(job_info_cache_stats['hits'], job_info_cache_stats['misses'],
+                     job_info_cache_stats['revalidations'], job_info_cache_stats['evictions']))
+
+
+def get_journal_name(stage):
+    """Names the job journal this process appends to for a stage
+    There is one journal per worker and operating mode, written under journal_lock so that overlapping runs of the
+    same mode take turns"""
+    if stage == stage_1:
+        role = "client"
+    elif stage in [stage_5, stage_6]:
+        role = "shredder"
+    else:
+        role = "worker"
+    return get_worker_identity() + "_" + role
+
+
+def is_journal_component(component):
+    """Status and job metadata components are recorded in the job journals, shard dicts keep a file each"""
+    return 'shard_dict' not in component
+
+
+def parse_journal(content):
+    """Parses journal file content into a list of entries, ignoring a partially appended last line"""
+    entries = []
+    for line in content.splitlines():
+        try:
+            entries.append(loads(line))
+        except ValueError:
+            log.warning("Skipping unreadable job journal line [{0}]".format(line))
+    return entries
+
+
+def get_journal_state(entries):
+    """Reconstructs current job state from journal entries, keeping the latest entry for each component"""
+    state = {}
+    for entry in entries:
+        current = state.get(entry['c'])
+        if current is None or (entry['t'], entry['s']) >= (current['t'], current['s']):
+            state[entry['c']] = entry
+    return state
 
 
+def read_job_journals(job):
+    """Reads all the journals of a job from HDFS, rereading only journals changed since they were last read
+    returns a list of entries, or None if the job has no journals as it was created before they were used"""
+    journal_dir = ospathjoin(conf.HDFS_SHRED_PATH, "store", job, "journal")
+    try:
+        listing = hdfs.list(journal_dir, status=True)
+    except HdfsError:
+        return None
+    if not listing:
+        return None
+    entries = []
+    journal_paths = [ospathjoin(journal_dir, journal_name) for journal_name, _ in listing]
+    journal_contents = hdfs_batch(
+        read_job_file, [(journal_path, item[1], parse_journal) for journal_path, item in zip(journal_paths, listing)]
+    )
+    for journal_path, journal_entries in zip(journal_paths, journal_contents):
+        if isinstance(journal_entries, HdfsError):
+            # The journal may be mid compaction by its writer; its entries will be picked up on the next read
+            log.warning("Could not read job journal [{0}]: {1}".format(journal_path, journal_entries))
+        else:
+            entries.extend(journal_entries)
+    return entries
+
+
+@contextmanager
+def journal_lock():
+    """Holds the local lock on writing job journals at conf.JOURNAL_LOCK_PATH
+    Scheduled runs of the same worker and mode may overlap, as they can while a leader waits on its workers, and
+    would otherwise append to and compact the same journals at once"""
+    with open(conf.JOURNAL_LOCK_PATH, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def flush_job_info(job=None):
+    """Appends the pending journal entries of a job, or of all jobs, to HDFS as one append per journal
+    A journal not seen by this process is created with its first entries instead, and one grown past
+    conf.JOURNAL_COMPACT_ENTRIES is rewritten with the latest entry per component"""
+    with pending_job_info_lock:
+        keys = [key for key in pending_job_info if job is None or key[0] == job]
+    for key in keys:
+        with pending_job_info_lock:
+            entries = pending_job_info.pop(key, None)
+        if not entries:
+            continue
+        journal_path = ospathjoin(conf.HDFS_SHRED_PATH, "store", key[0], "journal", key[1])
+        with journal_lock():
+            with job_info_cache_lock:
+                cached = job_info_cache.get(journal_path)
+            if cached is not None and len(cached[2]) + len(entries) > conf.JOURNAL_COMPACT_ENTRIES:
+                # Compacted from the journal as it is in HDFS, which an overlapping run may have appended to since
+                # this one read it
+                journal_entries = read_job_file(journal_path, hdfs.status(journal_path), parse_journal)
+                compacted = get_journal_state(journal_entries + entries).values()
+                entries = sorted(compacted, key=lambda entry: (entry['t'], entry['s']))
+                log.debug("Compacting job journal [{0}] to [{1}] entries".format(journal_path, len(entries)))
+                start_time = time()
+                hdfs.write(journal_path, "".join([dumps(entry) + "\n" for entry in entries]), overwrite=True)
+                observe_metric('shred_hdfs_request_seconds', time() - start_time, {'operation': 'write'})
+                cache_job_info(journal_path, None, entries)
+                continue
+            content = "".join([dumps(entry) + "\n" for entry in entries])
+            start_time = time()
+            if cached is None:
+                # Not in a listing of the job's journals read by this process, so most likely the first entries of
+                # this worker and mode for the job
+                try:
+                    hdfs.write(journal_path, content)
+                    observe_metric('shred_hdfs_request_seconds', time() - start_time, {'operation': 'write'})
+                    cache_job_info(journal_path, None, entries)
+                    continue
+                except HdfsError:
+                    # Created by an earlier run
+                    start_time = time()
+            hdfs.write(journal_path, content, append=True)
+            observe_metric('shred_hdfs_request_seconds', time() - start_time, {'operation': 'append'})
+            if cached is not None:
+                # Keeps the entries for compaction; the changed version forces a reread on the next listing
+                cache_job_info(journal_path, cached[0], cached[2] + entries)
+
+
+@trace_job_store
 def persist_job_info(job, component, stage, info):
-    """Writes data to our directory structure in the HDFS shred directory"""
+    """Writes data to our directory structure in the HDFS shred directory
+    Master status is written straight to the job list and job index, as they are used to find jobs
+    Other status and job metadata is queued for the job journal until flush_job_info is called,
+    and shard dicts are written as a file each"""
+    global journal_sequence
+    old_status = None
     if component == "master":
         file_path = ospathjoin(conf.HDFS_SHRED_PATH, "jobs", job)
         content = dumps(stage + "-" + info)
+        if conf.JOB_INDEX:
+            # The last status seen by this process locates the job's current marker in the job index
+            with job_info_cache_lock:
+                cached = job_info_cache.get(file_path)
+            if cached is not None:
+                old_status = loads(cached[2])
     elif 'worker' in component or 'data' in component:
         file_path = ospathjoin(conf.HDFS_SHRED_PATH, "store", job, component)
         if 'status' in component:
-            content = dumps(stage + "-" + info)
+            content = stage + "-" + info
         else:
-            content = dumps(info)
+            content = info
+        if is_journal_component(component):
+            key = (job, get_journal_name(stage))
+            with pending_job_info_lock:
+                journal_sequence += 1
+                if key not in pending_job_info:
+                    pending_job_info[key] = []
+                pending_job_info[key].append({'c': component, 'v': content, 't': time(), 's': journal_sequence})
+            return
+        content = encode_shard_dict(content) if component.endswith("_shard_dict") else dumps(content)
     else:
         raise StandardError("Function persist_job_info was passed an unrecognised component name")
     if file_path is not None:
+        start_time = time()
         try:
             hdfs.write(file_path, content, overwrite=True)
         except HdfsError as e:
             raise e
+        observe_metric('shred_hdfs_request_seconds', time() - start_time, {'operation': 'write'})
+        # Without the new version this is only trusted until the cache TTL expires
+        cache_job_info(file_path, None, content)
+        if component == "master" and conf.JOB_INDEX:
+            update_job_index(job, old_status, stage + "-" + info)
     else:
         raise ValueError()
 
 
-def retrieve_job_info(job, component, strict=True):
-    """Retrieves data stored in our HDFS Shred directory"""
+def encode_shard_dict(shard_dict):
+    """Serialises a shard dict, or ShardTable, for the job store in the format set by conf.SHARD_DICT_FORMAT
+    Falls back to JSON for a shard dict that can't be held in a shard table"""
+    if conf.SHARD_DICT_FORMAT == 'table':
+        try:
+            if not isinstance(shard_dict, ShardTable):
+                shard_dict = ShardTable(shard_dict)
+            return shard_dict.encode()
+        except ValueError as e:
+            log.warning("Writing shard dict as JSON as it can't be held in a shard table: {0}".format(e))
+    if isinstance(shard_dict, ShardTable):
+        shard_dict = dict(shard_dict.items())
+    return dumps(shard_dict)
+
+
+def get_pending_job_info(job):
+    """returns the journal entries of a job waiting to be flushed by this process"""
+    pending_entries = []
+    with pending_job_info_lock:
+        for key in pending_job_info:
+            if key[0] == job:
+                pending_entries.extend(pending_job_info[key])
+    return pending_entries
+
+
+@trace_job_store
+def retrieve_job_infos(job, components, strict=True):
+    """Retrieves several components of a job, reading its journals once for all of them and any files concurrently
+    returns a dict of component to content"""
+    results = {}
+    file_components = [component for component in components
+                       if component == "master" or not is_journal_component(component)]
+    journal_components = [component for component in components if component not in file_components]
+    if journal_components:
+        entries = read_job_journals(job)
+        pending_entries = get_pending_job_info(job)
+        if entries is not None or pending_entries:
+            state = get_journal_state((entries or []) + pending_entries)
+            for component in journal_components:
+                if component in state:
+                    results[component] = state[component]['v']
+                elif strict:
+                    raise StandardError("No entry for component [{0}] found in journals of job [{1}]"
+                                        .format(component, job))
+                else:
+                    results[component] = None
+        else:
+            # Jobs without journals predate them and are read from a file per component
+            file_components.extend(journal_components)
+    file_contents = hdfs_batch(retrieve_job_info, [(job, component, strict) for component in file_components])
+    for component, content in zip(file_components, file_contents):
+        results[component] = content
+    return results
+
+
+@trace_job_store
+def retrieve_job_info(job, component, strict=True, file_status=None):
+    """Retrieves data stored in our HDFS Shred directory
+    Files are read through the job info cache, file_status from a directory listing of the file saves revalidating"""
     file_content = None
     if component == "master":
         # The master component always updates the state of the job in the master job list
         file_path = ospathjoin(conf.HDFS_SHRED_PATH, "jobs", job)
     elif 'worker' in component or 'data' in component:
         file_path = ospathjoin(conf.HDFS_SHRED_PATH, "store", job, component)
+        if is_journal_component(component):
+            entries = read_job_journals(job)
+            pending_entries = get_pending_job_info(job)
+            # Jobs without journals predate them and are read from a file per component below
+            if entries is not None or pending_entries:
+                state = get_journal_state((entries or []) + pending_entries)
+                if component in state:
+                    get_result = state[component]['v']
+                    log.debug("Retrieved content [{1}] for component [{0}] from job journal"
+                              .format(component, get_result))
+                    return get_result
+                elif strict:
+                    raise StandardError("No entry for component [{0}] found in journals of job [{1}]"
+                                        .format(component, job))
+                return None
     else:
         raise ValueError("Invalid option passed to function get_hdfs_file")
     try:
-        with hdfs.read(file_path) as reader:
-            # expecting all content by this program to be serialised as json
-            file_content = reader.read()
+        # expecting all content by this program to be serialised as json
+        file_content = read_job_file(file_path, file_status)
     except HdfsError as e:
         if strict:
             raise StandardError("HDFSCli couldn't read a file from path [{0}] with details: {1}"
@@ -298,7 +2296,10 @@ def retrieve_job_info(job, component, strict=True):
         else:
             pass
             # if not strict mode then we will return None
-    if file_content:
+    if file_content and file_content[:len(shard_table_magic)] == shard_table_magic:
+        get_result = ShardTable.decode(file_content)
+        log.debug("Retrieved shard table of [{1}] shards from component file [{0}]".format(component, len(get_result)))
+    elif file_content:
         get_result = loads(file_content)
         log.debug("Retrieved content [{2}] from component file [{0}] at path [{1}]"
                   .format(component, file_path, get_result))
@@ -307,10 +2308,233 @@ def retrieve_job_info(job, component, strict=True):
     return get_result
 
 
+def delete_job_targets(job):
+    """Deletes every target of a job from HDFS through the client API, conf.HDFS_DELETE_THREADS at a time
+    WebHDFS deletes bypass the trash, as 'hdfs dfs -rm -skipTrash' did; a target already gone counts as deleted,
+    as it will be when a timed out leader's delete completed
+    returns a dict of target path to status"""
+    delete_targets = get_job_targets(job)
+    start_time = time()
+    with trace_span('delete_job_targets', {'targets': len(delete_targets)}):
+        delete_results = hdfs_batch(hdfs.delete, [(target, True) for target in delete_targets],
+                                    threads=conf.HDFS_DELETE_THREADS)
+    results = {}
+    for target, delete_result in zip(delete_targets, delete_results):
+        if isinstance(delete_result, HdfsError):
+            log.critical("Failed to delete target [{0}] of job [{1}] from HDFS: {2}".format(target, job, delete_result))
+            results[target] = status_fail
+        else:
+            if delete_result is False:
+                log.warning("Target [{0}] of job [{1}] was already deleted from HDFS".format(target, job))
+            results[target] = status_success
+    log.info("Deleted [{0}] of [{1}] targets of job [{2}] from HDFS in [{3:.2f}]s"
+             .format(list(results.values()).count(status_success), len(delete_targets), job, time() - start_time))
+    return results
+
+
+def find_stragglers(job, waiting_nodes, wait_start, now=None):
+    """Finds the workers a leader is waiting on that have shown no progress on a job for conf.STRAGGLER_DEADLINE
+    minutes, counted from when the leader started waiting, or from the last heartbeat or checkpoint of the worker
+    returns list of worker identities"""
+    if not conf.STRAGGLER_DEADLINE or not waiting_nodes:
+        return []
+    if now is None:
+        now = time()
+    deadline = conf.STRAGGLER_DEADLINE * 60
+    if now - wait_start < deadline:
+        return []
+    # Stages 3 and 5 both write the linked shard dict at each checkpoint, and a heartbeat between, so the age of the
+    # newer shows the worker is still going
+    progress_files = ["_heartbeat", "_linked_shard_dict"]
+    progress_status_list = hdfs_batch(hdfs.status, [
+        (ospathjoin(conf.HDFS_SHRED_PATH, "store", job, "worker_" + node + progress_file), False)
+        for node in waiting_nodes for progress_file in progress_files
+    ])
+    stragglers = []
+    for node_index, node in enumerate(waiting_nodes):
+        last_progress = wait_start
+        for progress_status in progress_status_list[node_index * len(progress_files):][:len(progress_files)]:
+            if isinstance(progress_status, dict):
+                last_progress = max(last_progress, progress_status['modificationTime'] / 1000.0)
+        if now - last_progress >= deadline:
+            stragglers.append(node)
+    return stragglers
+
+
+@contextmanager
+def worker_heartbeat(job, worker, stage):
+    """Writes a heartbeat for a worker's part of a job every conf.WORKER_HEARTBEAT seconds while it runs, which the
+    leader counts as progress through phases that checkpoint nothing for a long time, such as the first walk of the
+    block file index or the shred of a large, throttled shard"""
+    heartbeat_path = ospathjoin(conf.HDFS_SHRED_PATH, "store", job, "worker_" + worker + "_heartbeat")
+    stopped = Event()
+
+    def beat():
+        while not stopped.is_set():
+            try:
+                hdfs.write(heartbeat_path, dumps(stage), overwrite=True)
+            except HdfsError as e:
+                log.warning("Could not write heartbeat of worker [{0}] for job [{1}]: {2}".format(worker, job, e))
+            stopped.wait(conf.WORKER_HEARTBEAT)
+
+    heartbeat_thread = Thread(target=beat)
+    heartbeat_thread.daemon = True
+    heartbeat_thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        heartbeat_thread.join()
+
+
+def defer_workers(job, stage, workers):
+    """Moves workers a leader has stopped waiting on into their deferred queues, from which each runs its part of the
+    job from the given stage when it returns, and records them in the job so its leaders wait on the rest
+    The queue of each worker holds a file at deferred/<worker>/<job> naming the stage to run"""
+    deferred_workers = retrieve_job_info(job, "deferred_worker_list", strict=False) or []
+    for node in workers:
+        hdfs.write(ospathjoin(conf.HDFS_SHRED_PATH, "deferred", node, job), dumps(stage), overwrite=True)
+    persist_job_info(job, "deferred_worker_list", stage,
+                     sorted(set(deferred_workers) | set(workers)))
+    inc_metric('shred_deferred_workers_total', len(workers), {'stage': stage})
+
+
+def get_deferred_jobs(stage, worker):
+    """Finds the jobs in a worker's deferred queue waiting on it to run the stage
+    returns list of job UUID4 strings"""
+    deferred_path = ospathjoin(conf.HDFS_SHRED_PATH, "deferred", worker)
+    try:
+        deferred_list = hdfs.list(deferred_path)
+    except HdfsError:
+        # Nothing has been deferred to this worker
+        return []
+    deferred_stages = hdfs_batch(read_job_file, [
+        (ospathjoin(deferred_path, job), None, loads) for job in deferred_list
+    ])
+    return [job for job, deferred_stage in zip(deferred_list, deferred_stages) if deferred_stage == stage]
+
+
+def get_pending_deferred_workers(job, workers):
+    """Finds which of a job's deferred workers still hold it in their deferred queues
+    returns list of worker identities"""
+    queue_status_list = hdfs_batch(hdfs.status, [
+        (ospathjoin(conf.HDFS_SHRED_PATH, "deferred", node, job), False) for node in workers
+    ])
+    return [node for node, queue_status in zip(workers, queue_status_list) if queue_status is not None]
+
+
+def advance_deferred_job(job, stage, worker, worker_result):
+    """Moves a job on in a worker's deferred queue once the worker has run the stage for it
+    Linking in stage 3 is followed by shredding in stage 5, after which the job leaves the queue; a shred that failed
+    stays queued to be retried, while shards that could not be linked are most likely already removed by the DataNode"""
+    deferred_path = ospathjoin(conf.HDFS_SHRED_PATH, "deferred", worker, job)
+    if worker_result == status_init:
+        # Interrupted by shutdown, resumed on the next run
+        return
+    if stage == stage_3:
+        if worker_result == status_fail:
+            log.critical("Worker [{0}] could not link all shards of deferred job [{1}], shredding those it did"
+                         .format(worker, job))
+        hdfs.write(deferred_path, dumps(stage_5), overwrite=True)
+        cache_job_info(deferred_path, None, stage_5)
+    elif worker_result in [status_success, status_skip]:
+        hdfs.delete(deferred_path)
+        log.info("Worker [{0}] completed deferred job [{1}]".format(worker, job))
+    else:
+        log.critical("Worker [{0}] failed deferred job [{1}] at stage [{2}], it stays queued for the next run"
+                     .format(worker, job, stage))
+
+
+def read_shred_throughputs():
+    """Reads the overwrite rates recorded by the shredders of every worker
+    returns a dict of storage ID to MB/s"""
+    throughput_dir = ospathjoin(conf.HDFS_SHRED_PATH, "throughput")
+    try:
+        workers = hdfs.list(throughput_dir)
+    except HdfsError:
+        # No shredder has recorded a rate yet
+        return {}
+    rates = {}
+    for content in hdfs_batch(read_job_file, [(ospathjoin(throughput_dir, worker),) for worker in workers]):
+        if not isinstance(content, HdfsError):
+            rates.update(loads(content))
+    return rates
+
+
+def plan_shred(targets):
+    """Estimates how long shredding targets would take, without creating a job
+    Block replicas are summed per datanode and per storage (disk), and each disk is costed at the overwrite rate last
+    recorded for it by a shredder over conf.SHRED_COUNT + 1 passes, or conf.PLAN_DEFAULT_MB_PER_SECOND if it has none,
+    within the current shred rate limit; disks are shredded in parallel, so a node takes as long as its busiest disk
+    and the whole shred as long as the slowest, critical path, node
+    returns a dict of the plan"""
+    ensure_hdfs()
+    target_list = expand_hdfs_targets(targets)
+    passes = conf.SHRED_COUNT + 1
+    rates = read_shred_throughputs()
+    rate_limit = get_scheduled_shred_rate()
+    nodes = {}
+    for target in target_list:
+        for dn_ip, storage_id, block_id, block_length in get_block_replicas(target):
+            if dn_ip not in nodes:
+                nodes[dn_ip] = {'bytes': 0, 'blocks': 0, 'storages': {}}
+            node = nodes[dn_ip]
+            node['bytes'] += block_length
+            node['blocks'] += 1
+            if storage_id not in node['storages']:
+                node['storages'][storage_id] = {'bytes': 0, 'blocks': 0}
+            node['storages'][storage_id]['bytes'] += block_length
+            node['storages'][storage_id]['blocks'] += 1
+    for node in nodes.values():
+        node['seconds'] = 0
+        for storage_id, storage in node['storages'].items():
+            storage['measured'] = storage_id in rates
+            storage['mb_per_second'] = rates.get(storage_id, conf.PLAN_DEFAULT_MB_PER_SECOND)
+            if rate_limit:
+                storage['mb_per_second'] = min(storage['mb_per_second'], rate_limit / 1048576.0)
+            storage['seconds'] = storage['bytes'] * passes / 1048576.0 / storage['mb_per_second']
+            node['seconds'] = max(node['seconds'], storage['seconds'])
+    critical_node = None
+    if nodes:
+        critical_node = max(nodes, key=lambda dn_ip: nodes[dn_ip]['seconds'])
+    return {
+        'targets': target_list,
+        'passes': passes,
+        'bytes': sum(node['bytes'] for node in nodes.values()),
+        'nodes': nodes,
+        'critical_node': critical_node,
+        'seconds': nodes[critical_node]['seconds'] if critical_node else 0,
+    }
+
+
+def format_shred_plan(plan):
+    """Formats a plan from plan_shred as a report for the console, slowest node first"""
+    lines = [
+        "Shred plan for [{0}] targets: [{1:.1f}] GB of block replicas on [{2}] datanodes, each overwritten [{3}] times"
+        .format(len(plan['targets']), plan['bytes'] / 1073741824.0, len(plan['nodes']), plan['passes']),
+        "Projected time [{0}] on critical path datanode [{1}]"
+        .format(dttd(seconds=int(round(plan['seconds']))), plan['critical_node']),
+    ]
+    for dn_ip in sorted(plan['nodes'], key=lambda node_ip: plan['nodes'][node_ip]['seconds'], reverse=True):
+        node = plan['nodes'][dn_ip]
+        lines.append("  {0}: [{1:.1f}] GB in [{2}] blocks, [{3}]"
+                     .format(dn_ip, node['bytes'] / 1073741824.0, node['blocks'],
+                             dttd(seconds=int(round(node['seconds'])))))
+        for storage_id in sorted(node['storages'], key=lambda storage: node['storages'][storage]['seconds'],
+                                 reverse=True):
+            storage = node['storages'][storage_id]
+            lines.append("    {0}: [{1:.1f}] GB at [{2:.1f}] MB/s{3}, [{4}]"
+                         .format(storage_id or "unknown storage", storage['bytes'] / 1073741824.0,
+                                 storage['mb_per_second'], "" if storage['measured'] else " (default)",
+                                 dttd(seconds=int(round(storage['seconds'])))))
+    return "\n".join(lines) + "\n"
+
+
 # ###################          Main Workflows           ##########################
 
 
 def init_program(passed_args):
+    setup_syslog()
     log.info("shred.py called with args [{0}]".format(passed_args))
     parsed_args = parse_user_args(passed_args)
     # TODO: Further configuration file validation tests
@@ -319,16 +2543,346 @@ def init_program(passed_args):
         raise StandardError(
             "Version number in config.py not found, please check configuration file is available and try again."
         )
-    # Test necessary connections
-    ensure_hdfs()
-    # Check directories etc. are setup
-    hdfs.makedirs(ospathjoin(conf.HDFS_SHRED_PATH, "jobs"))
-    hdfs.makedirs(ospathjoin(conf.HDFS_SHRED_PATH, "store"))
+    # HDFS and ZooKeeper are connected to, and the shred directories set up, once a stage needs them
     # TODO: Further Application setup tests
     return parsed_args
 
 
 def run_stage(stage, params=None):
+    """Runs a stage, recording its duration and result in the metrics
+    returns the result of run_stage_tasks"""
+    start_time = time()
+    stage_result = run_traced('stage', run_stage_tasks, (stage, params), {'stage': stage})
+    write_stage_profile(stage)
+    if stage == stage_1:
+        status = stage_result[0]
+    else:
+        status = stage_result
+    set_metric('shred_stage_duration_seconds', round(time() - start_time, 3), {'stage': stage})
+    inc_metric('shred_stage_runs_total', labels={'stage': stage, 'status': status})
+    return stage_result
+
+
+def run_job_stage(stage, job, worker, deferred=False):
+    """Runs the work of one of stages 2 to 6 for a job, as its leader or as one of its workers
+    Called concurrently for the jobs of a stage by run_stage_tasks, so all state is kept to the job
+    A job deferred to the worker by a leader that stopped waiting on it is moved on in the worker's deferred queue"""
+    if shutdown_requested.is_set():
+        # Not started before shutdown was requested, so left for the next run
+        return
+    if stage in [stage_2, stage_4, stage_6]:
+        # Leader Jobs for stages 2, 4, and 6
+        # We use the absence of a leader_result to control activity within leader tasks
+        leader_result = None
+        # Worker may not yet have status file initialised for s2 of job
+        worker_status = (retrieve_job_info(job, "worker_" + worker + "_status", strict=False))
+        # TODO: Move worker state validation to a seperate function returning a t/f against worker/stage
+        if (
+            (worker_status is None and stage != stage_2) or
+            (worker_status is not None and worker_status not in [
+                stage_3 + "-" + status_success, stage_3 + "-" + status_skip, stage_4 + "-" + status_task_timeout,
+                stage_5 + "-" + status_success, stage_5 + "-" + status_skip, stage_6 + "-" + status_task_timeout,
+                # A worker that lost or abandoned an earlier try at this leader task may take it over
+                stage + "-" + status_skip, stage + "-" + status_init,
+                # As may the leader that kept the job open for deferred workers
+                stage_6 + "-" + status_deferred,
+        ])):
+            log.critical(
+                "Worker [{0}] is in status [{1}] for job [{2}], which is not valid to be [{3}] leader."
+                .format(worker, worker_status, job, stage)
+            )
+            leader_result = status_fail
+        persist_job_info(job, "worker_" + worker + "_status", stage, status_init)
+        ensure_zk()
+        lease_path = conf.ZOOKEEPER['PATH'] + job
+        lease_start = time()
+        with trace_span('lease'):
+            lease = zk.NonBlockingLease(
+                path=lease_path,
+                duration=dttd(minutes=conf.LEADER_WAIT),
+                identifier="Worker [{0}] running stage [{1}]".format(worker, stage)
+            )
+        observe_metric('shred_zookeeper_wait_seconds', time() - lease_start, {'operation': 'lease'})
+        if not lease:
+            leader_result = status_skip
+        else:
+            # Only the leader marks the job started, so the job index shows which jobs have a leader
+            # and when it started, for another worker to take over should it be abandoned
+            persist_job_info(job, 'master', stage, status_init)
+            while lease:
+                while leader_result is None:
+                    if zk.state != KazooState.CONNECTED:
+                        log.critical("ZooKeeper disconnected from worker [{0}] during stage [{1}] of job"
+                                     "[{2}], expiring activity"
+                                     .format(worker, stage, job))
+                        leader_result = status_task_timeout
+                    persist_job_info(job, "worker_" + worker + "_status", stage, status_is_leader)
+                    if stage == stage_2:
+                        # A single recursive block lookup of the holding pen covers every target in the job
+                        target = ospathjoin(conf.HDFS_SHRED_PATH, "store", job, "data")
+                        # Shard lists are spooled to local disk per worker rather than held in memory
+                        spool_dir = tempfile.mkdtemp(prefix="shred_" + job)
+                        try:
+                            with trace_span('get_block_locations'):
+                                worker_spools = spool_block_locations(get_block_locations(target), spool_dir)
+                            target_workers = sorted(worker_spools.keys())
+                            # Shard lists are written concurrently, each read from its spool as it goes
+                            for write_result in hdfs_batch(persist_spooled_shard_dict, [
+                                (job, this_worker, worker_spools[this_worker])
+                                for this_worker in target_workers
+                            ]):
+                                if isinstance(write_result, HdfsError):
+                                    raise write_result
+                        finally:
+                            rmtree(spool_dir)
+                        persist_job_info(job, "worker_list", stage, target_workers)
+                        leader_result = status_success
+                    elif stage in [stage_4, stage_6]:
+                        worker_list = retrieve_job_info(job, "worker_list")
+                        # Workers deferred by an earlier leader finish the job from their deferred queues
+                        deferred_workers = retrieve_job_info(job, "deferred_worker_list", strict=False) or []
+                        wait_start = time()
+                        barrier_reports = {}
+                        wait = True
+                        while wait is True:
+                            # TODO: Do stuff to validate count and expected names of workers are all correct
+                            nodes_finished = True
+                            waiting_nodes = []
+                            active_nodes = [node for node in worker_list if node not in deferred_workers]
+                            # The status of every worker is read from one pass over the job journals
+                            worker_status_dict = retrieve_job_infos(
+                                job, ["worker_" + node + "_status" for node in active_nodes], strict=False
+                            )
+                            for node in active_nodes:
+                                node_worker_status = worker_status_dict["worker_" + node + "_status"]
+                                if (node_worker_status is None or
+                                        node_worker_status.split("-")[0] < (stage_3 if stage == stage_4 else stage_5)):
+                                    # Not yet started on the stage, as with a DataNode that is offline
+                                    nodes_finished = False
+                                    waiting_nodes.append(node)
+                                    continue
+                                node_stage, node_status = node_worker_status.split("-")
+                                if node_stage == stage and node_status != status_fail:
+                                    # This or an earlier leader of the stage, which had finished the one awaited
+                                    # to be eligible to lead it
+                                    continue
+                                if (
+                                    node_status == status_fail or  # some node failed something
+                                    stage == stage_4 and node_stage != stage_3 or  # bad stage combo
+                                    stage == stage_6 and node_stage != stage_5  # stage combo breaker!
+                                ):
+                                    # This should crash the outer while loop to fail this process
+                                    leader_result = status_fail
+                                elif node_status not in [status_success, status_skip]:
+                                    nodes_finished = False
+                                    waiting_nodes.append(node)
+                            if leader_result == status_fail:
+                                log.critical("Worker [{0}] found a worker of job [{1}] failed or in a bad state, "
+                                             "failing stage [{2}]".format(worker, job, stage))
+                                break
+                            if nodes_finished is True:
+                                wait = False
+                                continue
+                            stragglers = find_stragglers(job, waiting_nodes, wait_start)
+                            if stragglers and len(stragglers) < len(active_nodes):
+                                # The job goes on with the workers that respond, so an offline DataNode does
+                                # not stall it; unless none do, when there is no one to go on with
+                                log.warning("Worker [{0}] deferring workers [{1}] of job [{2}], which showed no "
+                                            "progress on stage [{3}] in [{4}] minutes"
+                                            .format(worker, ", ".join(stragglers), job, stage,
+                                                    conf.STRAGGLER_DEADLINE))
+                                defer_workers(job, stage_3 if stage == stage_4 else stage_5, stragglers)
+                                deferred_workers.extend(stragglers)
+                            else:
+                                # Woken as soon as the last worker reports, the status files in HDFS
+                                # are then checked again as the durable record
+                                barrier_start = time()
+                                with trace_span('barrier'):
+                                    wait_for_barrier(
+                                        job, stage_3 if stage == stage_4 else stage_5, active_nodes,
+                                        60 * conf.WORKER_WAIT, barrier_reports
+                                    )
+                                observe_metric('shred_zookeeper_wait_seconds', time() - barrier_start,
+                                               {'operation': 'barrier'})
+                        else:
+                            # We only stop 'wait'ing to start Stage 4/6 if all workers report success
+                            # before the leader lease times out
+                            if stage == stage_4:
+                                persist_job_info(job, 'data_status', stage, status_init)
+                                # TODO: Validate against fresh blocklist in case of changes?
+                                delete_results = delete_job_targets(job)
+                                if status_fail not in delete_results.values():
+                                    persist_job_info(job, 'data_status', stage, status_success)
+                                    leader_result = status_success
+                                else:
+                                    log.critical("Deletion of targets from HDFS failed for job [{0}], "
+                                                 "bailing".format(job))
+                                    persist_job_info(job, 'data_status', stage, status_fail)
+                                    leader_result = status_fail
+                            elif stage == stage_6:
+                                # All workers have completed shredding, shut down job and clean up
+                                # TODO: Test that job completed as expected
+                                pending_workers = get_pending_deferred_workers(job, deferred_workers)
+                                if pending_workers:
+                                    # Checked again by the next leader until the deferred queues are drained
+                                    log.warning("Keeping job [{0}] open until deferred workers [{1}] shred their "
+                                                "shards".format(job, ", ".join(pending_workers)))
+                                    leader_result = status_deferred
+                                else:
+                                    leader_result = status_success
+                    else:
+                        raise StandardError("Bad stage passed to run_stage")
+                lease = False
+        if leader_result is None or leader_result == status_task_timeout:
+            log.warning(
+                "Worker [{0}] timed out on stage [{1}] leader task, "
+                "resetting status for another worker attempt"
+                .format(worker, stage))
+            persist_job_info(job, "worker_" + worker + "_status", stage, status_task_timeout)
+            persist_job_info(job, 'master', stage, status_task_timeout)
+            if stage in [stage_4, stage_6]:
+                # The next leader starts from the durable worker statuses, not reports left from this attempt
+                clear_barrier(job, stage_3 if stage == stage_4 else stage_5)
+        elif leader_result in [status_success, status_fail, status_deferred]:
+            # Cleanup lease
+            # TODO: Test if this breaks when the worker test says the worker is in a bad state
+            _ = zk.NonBlockingLease(
+                path=lease_path,
+                duration=dttd(seconds=1),
+                identifier="Worker [{0}] running stage [{1}]".format(worker, stage)
+            )
+            sleep(2)
+            persist_job_info(job, "worker_" + worker + "_status", stage, leader_result)
+            persist_job_info(job, 'master', stage, leader_result)
+            if leader_result == status_success:
+                clear_barrier(job, stage_3 if stage == stage_4 else None)
+            elif leader_result == status_fail and stage in [stage_4, stage_6]:
+                clear_barrier(job, stage_3 if stage == stage_4 else stage_5)
+        elif leader_result == status_skip:
+            persist_job_info(job, "worker_" + worker + "_status", stage, status_skip)
+        else:
+            raise StandardError("Bad leader_result returned from ZooKeeper wrapper")
+    elif stage in [stage_3, stage_5]:
+        # Distributed worker jobs for stage 3 and 5
+        worker_result = None
+        persist_job_info(job, "worker_" + worker + "_status", stage, status_init)
+        # Flushed now, so a waiting leader sees the worker has started
+        flush_job_info(job)
+        # Heartbeats show a waiting leader the worker is still going between checkpoints
+        with worker_heartbeat(job, worker, stage):
+            if stage == stage_3:
+                targets_dict = retrieve_job_info(job, "worker_" + worker + "_source_shard_dict", strict=False)
+                # allowing for restart of job where shard linking was partially completed.
+                linked_shard_dict = retrieve_job_info(
+                    job, "worker_" + worker + "_linked_shard_dict", strict=False
+                )
+                if linked_shard_dict is None:
+                    linked_shard_dict = ShardTable() if conf.SHARD_DICT_FORMAT == 'table' else {}
+            elif stage == stage_5:
+                targets_dict = retrieve_job_info(job, "worker_" + worker + "_linked_shard_dict", strict=False)
+                linked_shard_dict = None
+            else:
+                raise StandardError("Bad code pathway")
+            if targets_dict is None or len(targets_dict) == 0:
+                log.debug("Worker [{0}] found no shards for stage [{1}] in job [{2}]"
+                          .format(worker, stage, job))
+                worker_result = status_skip
+            else:
+                checkpoint = new_checkpoint()
+                link_queue = []
+                shred_queue = []
+                for shard in targets_dict:
+                    if shutdown_requested.is_set():
+                        # Remaining shards keep their status for the next run to pick up
+                        break
+                    if (targets_dict[shard] in [status_no_init, status_init] or
+                            # A deferred worker retries the shreds that failed on an earlier run
+                            deferred and stage == stage_5 and targets_dict[shard] == status_fail):
+                        if stage == stage_3:
+                            targets_dict[shard] = status_init
+                            try:
+                                with trace_span('find_shard', {'shard': shard}):
+                                    shard_file_path = find_shard(shard)
+                            except StandardError as e:
+                                # Most likely removed by the DataNode, as happens to the blocks of a deferred worker
+                                # that returns too late; the rest of the job's shards go on
+                                log.critical("Worker [{0}] could not find shard [{1}] of job [{2}]: {3}"
+                                             .format(worker, shard, job, e))
+                                targets_dict[shard] = status_fail
+                                inc_metric('shred_shards_total', labels={'stage': stage_3, 'status': status_fail})
+                                continue
+                            # Shards are queued here and linked in parallel per volume below
+                            link_queue.append((shard, shard_file_path))
+                        elif stage == stage_5:
+                            if targets_dict[shard] == status_init and not exists(shard):
+                                # Queued and shredded since the last checkpoint by a run that did not finish
+                                targets_dict[shard] = status_success
+                                continue
+                            targets_dict[shard] = status_init
+                            # TODO: Insert final sanity check before shredding files
+                            # Shards are queued here and shredded in parallel per device below
+                            shred_queue.append(shard)
+                    elif targets_dict[shard] == status_success or deferred and targets_dict[shard] == status_fail:
+                        # Already done, or for a deferred worker not found on an earlier run, therefore skip
+                        pass
+                    else:
+                        raise StandardError(
+                            "Shard control for worker [{0}] on job [{1}] in unexpected state: [{1}]"
+                            .format(worker, job, dumps(dict(targets_dict.items())))
+                        )
+                if stage == stage_3 and link_queue:
+
+                    def record_link(shard, linked_shard_path, shard_status):
+                        targets_dict[shard] = shard_status
+                        if shard_status == status_success:
+                            linked_shard_dict[linked_shard_path] = status_no_init
+                        if checkpoint_due(checkpoint):
+                            persist_shard_dicts(job, worker, stage, targets_dict, linked_shard_dict,
+                                                checkpoint)
+
+                    link_shards(job, link_queue, record_link)
+                if stage == stage_5 and shred_queue:
+                    log.info("Worker [{0}] shredding [{1}] shards for job [{2}]"
+                             .format(worker, len(shred_queue), job))
+                    # Shards are marked init before shredding starts, so a restart knows which of any
+                    # missing shards it had already shredded
+                    persist_shard_dicts(job, worker, stage, targets_dict, checkpoint=checkpoint)
+
+                    def record_shred(shard, shard_status):
+                        targets_dict[shard] = shard_status
+                        if checkpoint_due(checkpoint):
+                            persist_shard_dicts(job, worker, stage, targets_dict, checkpoint=checkpoint)
+
+                    shred_shards(shred_queue, record_shred)
+                persist_shard_dicts(job, worker, stage, targets_dict, linked_shard_dict)
+                # sanity test if task is completed successfully
+                target_status = []
+                for shard in targets_dict:
+                    target_status.append(targets_dict[shard])
+                if len(set(target_status)) == 1 and status_success in set(target_status):
+                    worker_result = status_success
+                elif shutdown_requested.is_set() and (deferred or status_fail not in target_status):
+                    # Interrupted rather than failed; the job is resumed from the shard dict on the next run
+                    worker_result = status_init
+                else:
+                    worker_result = status_fail
+        persist_job_info(job, "worker_" + worker + "_status", stage, worker_result)
+    else:
+        # Shouldn't be able to get here
+        raise StandardError("Bad stage definition passed to run_stage: {0}".format(stage))
+    # One journal append per job records all the status changes made while processing it
+    with trace_span('flush_job_info'):
+        flush_job_info(job)
+    inc_metric('shred_stage_jobs_total', labels={'stage': stage})
+    if deferred:
+        # No leader is waiting on a deferred worker
+        advance_deferred_job(job, stage, worker, worker_result)
+    elif stage in [stage_3, stage_5] and worker_result != status_init:
+        # Reported once the durable status is written, so a woken leader finds it in HDFS
+        report_to_barrier(job, stage, worker, worker_result)
+
+
+def run_stage_tasks(stage, params=None):
     """
     Main program logic
     As many stages share a lot of similar functionality, they are interleved using the 'stage' parameter as a selector
@@ -337,262 +2891,117 @@ def run_stage(stage, params=None):
     ensure_hdfs()
     if stage == stage_1:
         # Stage 1 returns a result and a an ID for the job and has no job list
-        target = params
-        # TODO: Validate passed file target(s) further, for ex trailing slashes or actually a directory in arg parse
+        # Targets may be a single path or a list of paths, directories, or globs, which all go in one job
+        if isinstance(params, list):
+            targets = params
+        else:
+            targets = [params]
+        from uuid import uuid4
         job = str(uuid4())
         log.debug("Generated uuid4 [{0}] for job identification".format(job))
         persist_job_info(job, 'master', stage, status_init)
         persist_job_info(job, 'data_status', stage, status_init)
         holding_pen_path = ospathjoin(conf.HDFS_SHRED_PATH, "store", job, 'data')
-        source_path, source_filename = ospathsplit(target)
-        expected_target_real_path = ospathjoin(holding_pen_path, source_filename)
+        moved_targets = []
         try:
-            # TODO: Update to handle list of input files instead of single file as a string
-            target_details = hdfs.status(target)
-            if target_details['type'] == u'FILE':
+            target_list = expand_hdfs_targets(targets)
+            # Validate every target before moving any, so a bad submission leaves everything in place
+            target_problem = None
+            if not target_list:
+                target_problem = "no targets were found"
+            elif len(set([basename(target) for target in target_list])) != len(target_list):
+                target_problem = "targets share names, which would collide in the holding pen"
+            for target in target_list:
+                target_details = hdfs.status(target)
+                if target_details['type'] not in [u'FILE', u'DIRECTORY']:
+                    target_problem = "type returned for [{0}] was [{1}]".format(target, target_details['type'])
+            if target_problem is None:
                 # We need to ensure the directory is created, or the rename command will dump the data into the file
                 hdfs.makedirs(holding_pen_path)
                 # Using the HDFS module's rename function to move the target files to test permissions
-                log.debug("Moving target file [{0}] to shredder holding pen [{1}]".format(target, holding_pen_path))
                 # TODO: Do an are-you-sure, then return status_skip if they don't accept
-                hdfs.rename(target, holding_pen_path)
+                for target in target_list:
+                    log.debug("Moving target [{0}] to shredder holding pen [{1}]".format(target, holding_pen_path))
+                    hdfs.rename(target, holding_pen_path)
+                    moved_targets.append(target)
                 # TODO: Write more sanity checks for ingest process
-                persist_job_info(job, "data_file_list", stage_1, expected_target_real_path)
-                log.debug("Job [{0}] prepared, exiting with success".format(job))
+                persist_job_info(job, "data_file_list", stage_1,
+                                 [ospathjoin(holding_pen_path, basename(target)) for target in target_list])
+                log.debug("Job [{0}] prepared with [{1}] targets, exiting with success".format(job, len(target_list)))
                 persist_job_info(job, 'master', stage, status_success)
                 persist_job_info(job, 'data_status', stage, status_success)
+                flush_job_info(job)
                 return status_success, job
             else:
-                log.critical("Target is not valid, type returned was [{0}]".format(target_details['type']))
+                log.critical("Targets are not valid, {0}".format(target_problem))
                 persist_job_info(job, 'master', stage, status_fail)
                 persist_job_info(job, 'data_status', stage, status_fail)
+                flush_job_info(job)
                 return status_fail, job
         except HdfsError as e:
+            # Return anything already moved so the submission can be corrected and retried
+            for target in moved_targets:
+                try:
+                    hdfs.rename(ospathjoin(holding_pen_path, basename(target)), target)
+                except HdfsError as rollback_error:
+                    log.critical("Could not return target [{0}] from holding pen [{1}]: {2}"
+                                 .format(target, holding_pen_path, rollback_error))
             persist_job_info(job, 'master', stage, status_fail)
             persist_job_info(job, 'data_status', stage, status_fail)
-            log.critical("Ingestion failed for file [{0}] for job [{1}] with details: {2}"
-                         .format(target, job, e))
+            log.critical("Ingestion failed for targets [{0}] for job [{1}] with details: {2}"
+                         .format(targets, job, e))
+            flush_job_info(job)
             return status_fail, job
     elif stage in [stage_2, stage_3, stage_4, stage_5, stage_6]:
         # stages 2 - 6 operate from an active job list predicated by success of the last master stage
         worker = get_worker_identity()
         job_list = get_jobs(stage)
+        deferred_jobs = []
+        if stage in [stage_2, stage_4, stage_6]:
+            job_list = order_leader_jobs(job_list, worker)
+        else:
+            # Jobs that leaders went on with while this worker was unavailable are drained from its deferred queue
+            deferred_jobs = get_deferred_jobs(stage, worker)
+            if deferred_jobs:
+                log.info("Worker [{0}] found [{1}] deferred jobs for stage [{2}]"
+                         .format(worker, len(deferred_jobs), stage))
+            job_list = job_list + [job for job in deferred_jobs if job not in job_list]
         log.info("Worker [{0}] found [{1}] jobs for stage [{2}]".format(worker, len(job_list), stage))
         if len(job_list) > 0:
-            for job in job_list:
-                if stage in [stage_2, stage_4, stage_6]:
-                    # Leader Jobs for stages 2, 4, and 6
-                    # We use the absence of a leader_result to control activity within leader tasks
-                    leader_result = None
-                    # Worker may not yet have status file initialised for s2 of job
-                    worker_status = (retrieve_job_info(job, "worker_" + worker + "_status", strict=False))
-                    # TODO: Move worker state validation to a seperate function returning a t/f against worker/stage
-                    if (
-                        (worker_status is None and stage != stage_2) or
-                        (worker_status is not None and worker_status not in [
-                            stage_3 + "-" + status_success, stage_3 + "-" + status_skip, stage_4 + "-" + status_task_timeout,
-                            stage_5 + "-" + status_success, stage_5 + "-" + status_skip, stage_6 + "-" + status_task_timeout,
-                    ])):
-                        log.critical(
-                            "Worker [{0}] is in status [{1}] for job [{2}], which is not valid to be [{3}] leader."
-                            .format(worker, worker_status, job, stage)
-                        )
-                        leader_result = status_fail
-                    persist_job_info(job, 'master', stage, status_init)
-                    persist_job_info(job, "worker_" + worker + "_status", stage, status_init)
-                    ensure_zk()
-                    lease_path = conf.ZOOKEEPER['PATH'] + job
-                    lease = zk.NonBlockingLease(
-                        path=lease_path,
-                        duration=dttd(minutes=conf.LEADER_WAIT),
-                        identifier="Worker [{0}] running stage [{1}]".format(worker, stage)
-                    )
-                    if not lease:
-                        leader_result = status_skip
-                    else:
-                        while lease:
-                            while leader_result is None:
-                                if zk.state != KazooState.CONNECTED:
-                                    log.critical("ZooKeeper disconnected from worker [{0}] during stage [{1}] of job"
-                                                 "[{2}], expiring activity"
-                                                 .format(worker, stage, job))
-                                    leader_result = status_task_timeout
-                                persist_job_info(job, "worker_" + worker + "_status", stage, status_is_leader)
-                                if stage == stage_2:
-                                    target = retrieve_job_info(job, "data_file_list")
-                                    master_shard_dict = {}
-                                    fsck_iter = run_shell_command(
-                                        ["hdfs", "fsck", target, "-files", "-blocks", "-locations"]
-                                    )
-                                    master_shard_dict.update(parse_fsck_iter(fsck_iter))
-                                    target_workers = master_shard_dict.keys()
-                                    for this_worker in target_workers:
-                                        worker_shard_dict = {}
-                                        for shard_file in master_shard_dict[this_worker]:
-                                            worker_shard_dict[shard_file] = status_no_init
-                                        persist_job_info(
-                                            job, "worker_" + worker + "_source_shard_dict", stage, worker_shard_dict
-                                        )
-                                    persist_job_info(job, "worker_list", stage, target_workers)
-                                    leader_result = status_success
-                                elif stage in [stage_4, stage_6]:
-                                    worker_list = retrieve_job_info(job, "worker_list")
-                                    wait = True
-                                    while wait is True:
-                                        # TODO: Do stuff to validate count and expected names of workers are all correct
-                                        nodes_finished = True
-                                        for node in worker_list:
-                                            node_stage, node_status = (
-                                                retrieve_job_info(job, "worker_" + node + "_status")).split("-")
-                                            if (
-                                                node_status == status_fail or  # some node failed something
-                                                stage == stage_4 and node_stage != stage_3 or  # bad stage combo
-                                                stage == stage_6 and node_stage != stage_5  # stage combo breaker!
-                                            ):
-                                                # This should crash the outer while loop to fail this process
-                                                leader_result = status_fail
-                                            elif node_status not in [status_success, status_skip]:
-                                                nodes_finished = False
-                                        if nodes_finished is True:
-                                            wait = False
-                                        else:
-                                            sleep(60 * conf.WORKER_WAIT)
-                                    else:
-                                        # We only stop 'wait'ing to start Stage 4/6 if all workers report success
-                                        # before the leader lease times out
-                                        persist_job_info(job, 'master', stage, status_init)
-                                        if stage == stage_4:
-                                            persist_job_info(job, 'data_status', stage, status_init)
-                                            # TODO: Handle multiple files instead of a single file as string
-                                            # TODO: Validate against fresh blocklist in case of changes?
-                                            delete_target = retrieve_job_info(job, "data_file_list")
-                                            delete_cmd_result = next(
-                                                run_shell_command(['hdfs', 'dfs', '-rm', '-skipTrash', delete_target])
-                                            )
-                                            if "Deleted" in delete_cmd_result:
-                                                persist_job_info(job, 'data_status', stage, status_success)
-                                                leader_result = status_success
-                                            else:
-                                                log.critical(
-                                                    "Deletion of file from HDFS returned bad result of [{0}], bailing"
-                                                    .format(delete_cmd_result))
-                                                persist_job_info(job, 'data_status', stage, status_fail)
-                                                leader_result = status_fail
-                                        elif stage == stage_6:
-                                            # All workers have completed shredding, shut down job and clean up
-                                            # TODO: Test that job completed as expected
-                                            leader_result = status_success
-                                else:
-                                    raise StandardError("Bad stage passed to run_stage")
-                            lease = False
-                    if leader_result is None or leader_result == status_task_timeout:
-                        log.warning(
-                            "Worker [{0}] timed out on stage [{1}] leader task, "
-                            "resetting status for another worker attempt"
-                            .format(worker, stage))
-                        persist_job_info(job, "worker_" + worker + "_status", stage, status_task_timeout)
-                        persist_job_info(job, 'master', stage, status_task_timeout)
-                    elif leader_result in [status_success, status_fail]:
-                        # Cleanup lease
-                        # TODO: Test if this breaks when the worker test says the worker is in a bad state
-                        _ = zk.NonBlockingLease(
-                            path=lease_path,
-                            duration=dttd(seconds=1),
-                            identifier="Worker [{0}] running stage [{1}]".format(worker, stage)
-                        )
-                        sleep(2)
-                        persist_job_info(job, "worker_" + worker + "_status", stage, leader_result)
-                        persist_job_info(job, 'master', stage, leader_result)
-                    elif leader_result == status_skip:
-                        persist_job_info(job, "worker_" + worker + "_status", stage, status_skip)
-                    else:
-                        raise StandardError("Bad leader_result returned from ZooKeeper wrapper")
-                elif stage in [stage_3, stage_5]:
-                    # Distributed worker jobs for stage 3 and 5
-                    persist_job_info(job, "worker_" + worker + "_status", stage, status_init)
-                    if stage == stage_3:
-                        targets_dict = retrieve_job_info(job, "worker_" + worker + "_source_shard_dict", strict=False)
-                        # allowing for restart of job where shard linking was partially completed.
-                        linked_shard_dict = retrieve_job_info(
-                            job, "worker_" + worker + "_linked_shard_dict", strict=False
-                        )
-                        if linked_shard_dict is None:
-                            linked_shard_dict = {}
-                    elif stage == stage_5:
-                        targets_dict = retrieve_job_info(job, "worker_" + worker + "_linked_shard_dict", strict=False)
-                    else:
-                        raise StandardError("Bad code pathway")
-                    if targets_dict is None:
-                        log.debug("Worker [{0}] found no shard list for stage [{1}] in job [{2}]"
-                                  .format(worker, stage, job))
-                        persist_job_info(job, "worker_" + worker + "_status", stage, status_skip)
-                    else:
-                        for shard in targets_dict:
-                            if targets_dict[shard] in [status_no_init, status_init]:
-                                targets_dict[shard] = status_init
-                                if stage == stage_3:
-                                    shard_file_path = find_shard(shard)
-                                    shard_file_mount = find_mount_point(shard_file_path)
-                                    this_mount_shred_dir = ospathjoin(shard_file_mount, conf.LINUXFS_SHRED_PATH, job)
-                                    linked_shard_path = ospathjoin(this_mount_shred_dir, shard)
-                                    try:
-                                        if not exists(this_mount_shred_dir):
-                                            # apparently the exists_ok flag is only in Python2.7+
-                                            makedirs(this_mount_shred_dir)
-                                        link(shard_file_path, linked_shard_path)
-                                        linked_shard_dict[linked_shard_path] = status_no_init
-                                        targets_dict[shard] = status_success
-                                    except OSError as e:
-                                        log.critical("Failed to link shard file [{0}] at loc [{1}] to shred loc [{2}]"
-                                                     .format(shard, shard_file_path, linked_shard_path))
-                                        targets_dict[shard] = status_fail
-                                elif stage == stage_5:
-                                    # Shred returns 0 on success and a 'failed' message on error
-                                    # run_shell_command handles this behavior for us
-                                    # TODO: Insert final sanity check before shredding files
-                                    shred_result = run_shell_command(
-                                        ['shred', '-n', str(conf.SHRED_COUNT), '-z', '-u', shard],
-                                        return_iter=False
-                                    )
-                                    if shred_result is not None:
-                                        log.critical("Worker [{0}] failed to shred shard [{1}] with error: {2}"
-                                                     .format(worker, shard, shred_result))
-                                        targets_dict[shard] = status_fail
-                                    else:
-                                        targets_dict[shard] = status_success
-                            elif targets_dict[shard] == status_success:
-                                # Already done, therefore skip
-                                pass
-                            else:
-                                raise StandardError(
-                                    "Shard control for worker [{0}] on job [{1}] in unexpected state: [{1}]"
-                                    .format(worker, job, dumps(targets_dict))
-                                )
-                        if stage == stage_3:
-                            persist_job_info(job, "worker_" + worker + "_source_shard_dict", stage, targets_dict)
-                            persist_job_info(job, "worker_" + worker + "_linked_shard_dict", stage, linked_shard_dict)
-                        if stage == stage_5:
-                            persist_job_info(job, "worker_" + worker + "_linked_shard_dict", stage, targets_dict)
-                        # sanity test if task is completed successfully
-                        target_status = []
-                        for shard in targets_dict:
-                            target_status.append(targets_dict[shard])
-                        if len(set(target_status)) == 1 and status_success in set(target_status):
-                            persist_job_info(job, "worker_" + worker + "_status", stage, status_success)
-                        else:
-                            persist_job_info(job, "worker_" + worker + "_status", stage, status_fail)
-                else:
-                    # Shouldn't be able to get here
-                    raise StandardError("Bad stage definition passed to run_stage: {0}".format(stage))
+            # Jobs run concurrently up to conf.MAX_JOBS_IN_FLIGHT, so one waiting on a lease, on a barrier or on a slow
+            # read of HDFS holds up no others
+            pool = ThreadPool(max(1, min(conf.MAX_JOBS_IN_FLIGHT, len(job_list))))
+            job_results = [
+                pool.apply_async(run_traced, ('job', run_job_stage, (stage, job, worker, job in deferred_jobs),
+                                              {'job': job, 'stage': stage}))
+                for job in job_list
+            ]
+            pool.close()
+            for job_result in job_results:
+                # Waits with a timeout, as an untimed wait in Python 2 holds off signal handlers until it returns, so
+                # SIGTERM can set shutdown_requested and stop the jobs at their next shard
+                while not job_result.ready():
+                    job_result.wait(1)
+            pool.join()
+            for job_result in job_results:
+                # Raises any error of a job now all have finished
+                job_result.get()
+            if shutdown_requested.is_set():
+                log.warning("Worker [{0}] stopping stage [{1}] as shutdown was requested".format(worker, stage))
+                return status_skip
             # Now all jobs for stage have run, check all jobs completed successfully before returning
-            for job in job_list:
-                if stage in [stage_2, stage_4, stage_6]:
-                    component = "master"
-                else:
-                    # must be stage 3 or 5
-                    component = "worker_" + worker + "_status"
-                job_status = (retrieve_job_info(job, component)).split("-")[1]
-                if job_status not in [status_success, status_skip]:
+            if stage in [stage_2, stage_4, stage_6]:
+                component = "master"
+            else:
+                # must be stage 3 or 5
+                component = "worker_" + worker + "_status"
+            job_status_list = hdfs_batch(retrieve_job_info, [(job, component) for job in job_list])
+            for job_status in job_status_list:
+                if isinstance(job_status, HdfsError):
+                    raise job_status
+                job_status = job_status.split("-")[1]
+                # A job kept open for its deferred workers is finished with as far as this worker is concerned
+                if job_status not in [status_success, status_skip, status_deferred]:
                     log.critical("Worker [{0}] failed or timed out one or more of [{1}] jobs for stage [{2}]"
                                  .format(worker, len(job_list), stage))
                     return status_fail
@@ -606,26 +3015,95 @@ def run_stage(stage, params=None):
         raise StandardError("Bad stage definition passed to run_stage: {0}".format(stage))
 
 
+def run_stage_list(stage_list):
+    """Runs each of a mode's distributed stages once, in order
+    returns status_fail if any stage failed, status_success if any stage found work, or status_skip"""
+    list_result = status_skip
+    for this_stage in stage_list:
+        stage_result = run_stage(this_stage)
+        if stage_result == status_fail:
+            list_result = status_fail
+        elif stage_result == status_success and list_result == status_skip:
+            list_result = status_success
+        if shutdown_requested.is_set():
+            break
+    return list_result
+
+
+def request_shutdown(signum, frame):
+    """Signal handler for daemon mode, stopping work at the next shard or job boundary"""
+    log.warning("Received signal [{0}], shutting down once the current shard completes".format(signum))
+    shutdown_requested.set()
+
+
+def get_daemon_delay(idle_runs):
+    """Returns the seconds to wait before the next daemon run, doubling the interval for each run that found no work
+    and adding jitter to spread the workers out"""
+    interval = min(conf.DAEMON_INTERVAL * 2 ** min(idle_runs, 16), conf.DAEMON_MAX_INTERVAL)
+    return interval + uniform(0, conf.DAEMON_JITTER)
+
+
+def run_daemon(stage_list, mode):
+    """Reruns the stage list until shutdown is requested, reusing the ZooKeeper and HDFS handles between runs
+    Metrics accumulate across runs and are written after each one
+    returns the result of the last run"""
+    signal(SIGTERM, request_shutdown)
+    signal(SIGINT, request_shutdown)
+    idle_runs = 0
+    list_result = status_skip
+    # Initial jitter so workers started together by a deployment do not run in step
+    shutdown_requested.wait(uniform(0, conf.DAEMON_JITTER))
+    while not shutdown_requested.is_set():
+        try:
+            list_result = run_stage_list(stage_list)
+        except (StandardError, EnvironmentError, HdfsError, KazooException) as e:
+            # Connections are reestablished by the next run, so one bad run should not stop the daemon
+            log.critical("Daemon run of stages [{0}] failed with error: {1}".format(stage_list, e))
+            list_result = status_fail
+        if list_result == status_skip:
+            idle_runs += 1
+        else:
+            idle_runs = 0
+        log_job_info_cache_stats()
+        write_metrics(mode)
+        delay = get_daemon_delay(idle_runs)
+        log.info("Daemon run of stages [{0}] returned [{1}], next run in [{2:.0f}]s"
+                 .format(stage_list, list_result, delay))
+        shutdown_requested.wait(delay)
+    if zk:
+        zk.stop()
+        zk.close()
+    log.info("Daemon stopped")
+    return list_result
+
+
 # ###################          main program           ##########################
 
 if __name__ == "__main__":
     args = init_program(sys.argv[1:])
-    stage_list = []
-    if args.mode is 'client':
-        stage_list = [stage_1, ]
-    elif args.mode is 'worker':
-        stage_list = [stage_2, stage_3, stage_4]
-    elif args.mode is 'shredder':
-        stage_list = [stage_5, stage_6]
+    start_profiling(args.profile, args.profile_stats)
+    if args.mode == 'client':
+        stage_result, new_job_id = run_stage(stage=stage_1, params=get_client_targets(args))
+    elif args.mode == 'plan':
+        sys.stdout.write(format_shred_plan(plan_shred(get_client_targets(args))))
+        stage_result = status_success
+    elif args.mode == 'worker' or args.mode == 'shredder':
+        if args.mode == 'worker':
+            stage_list = [stage_2, stage_3, stage_4]
+        else:
+            stage_list = [stage_5, stage_6]
+        if args.daemon:
+            stage_result = run_daemon(stage_list, args.mode)
+        else:
+            stage_result = run_stage_list(stage_list)
     else:
-        StandardError("Bad operating mode [{0}] detected. Please consult program help and try again.".format(args.mode))
-    stage_result = status_skip
-    while stage_result in [status_skip, status_success]:
-        for this_stage in stage_list:
-            if this_stage == stage_1:
-                stage_result, new_job_id = run_stage(stage=stage_1, params=args.filename)
-            else:
-                stage_result = run_stage(this_stage)
+        raise StandardError("Bad operating mode [{0}] detected. Please consult program help and try again."
+                            .format(args.mode))
+    log_job_info_cache_stats()
+    if args.mode != 'plan':
+        write_metrics(args.mode)
+    stop_profiling()
+    if stage_result in [status_skip, status_success]:
         sys.exit(0)
     else:
         sys.exit(1)
@@ -0,0 +1,477 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the hot paths of shred.py; run directly rather than through py.test, for example:
+    python tests/bench_shred.py shred_engines --dir /hadoop/hdfs/data --sizes 128 1024
+Benchmarks of the job store and worker stages use the in-memory HDFS and ZooKeeper of tests/fakes.py, so need
+no cluster.
+Each result is written as a line of JSON so runs can be compared over time.
+"""
+
+import sys
+import argparse
+import logging
+import tempfile
+import subprocess
+from time import time
+from uuid import uuid4
+from json import dumps, loads
+from shutil import rmtree
+from os import fsync, makedirs
+from os.path import join as ospathjoin
+from os.path import dirname, realpath
+
+sys.path.insert(0, dirname(dirname(realpath(__file__))))
+import shred
+from hdfs import InsecureClient
+from stub_namenode import StubNameNode, synthetic_files
+from fakes import FakeHdfs, FakeZooKeeper
+
+
+# ###################          Helpers            ##########################
+
+
+def make_block_file(file_path, size_mb):
+    """Writes a block file of size_mb megabytes of non-zero data and syncs it to disk"""
+    chunk = b'\xa5' * 1048576
+    with open(file_path, 'wb') as block_file:
+        for _ in range(size_mb):
+            block_file.write(chunk)
+        block_file.flush()
+        fsync(block_file.fileno())
+
+
+def synthetic_fsck(block_count, datanode_count=12, replication=3):
+    """Generates lines in the format of 'hdfs fsck -files -blocks -locations' for a file of block_count blocks"""
+    yield "/tmp/testshred/store/job/data/part-m-00000 {0} bytes, {1} block(s):  OK\n".format(
+        block_count * 134217728, block_count)
+    for block in range(block_count):
+        locations = []
+        for replica in range(replication):
+            datanode = (block + replica) % datanode_count
+            locations.append("DatanodeInfoWithStorage[172.16.{0}.{1}:50010,DS-{2:08x}-0000-0000-0000-000000000000,DISK]"
+                             .format(datanode // 250, datanode % 250 + 1, datanode))
+        yield "{0}. BP-929597290-192.168.0.1-1461159434758:blk_{1}_{2} len=134217728 Live_repl={3} [{4}]\n".format(
+            block, 1073741825 + block, 1001 + block, replication, ", ".join(locations))
+    yield "\n"
+    yield "Status: HEALTHY\n"
+
+
+# The configuration and functions of shred.py as they were before any benchmark changed them, see restore_settings
+saved_settings = dict(vars(shred.conf))
+saved_functions = dict(hdfs=shred.hdfs, zk=shred.zk, find_mount_point=shred.find_mount_point)
+# Scratch dirs made by use_fakes, removed by restore_settings
+scratch_dirs = []
+
+
+def use_fakes():
+    """Points shred.py at a new in-memory HDFS and ZooKeeper and a scratch dir for every local path it writes, so the
+    setup marker, shard index and journal lock of a real install on this host are left alone, and clears its state
+    returns the fake HDFS client, which counts requests by operation"""
+    scratch_dir = tempfile.mkdtemp(prefix="bench_state_")
+    scratch_dirs.append(scratch_dir)
+    shred.conf.SETUP_MARKER_PATH = ospathjoin(scratch_dir, "setup.json")
+    shred.conf.SHARD_INDEX_PATH = ospathjoin(scratch_dir, "shard_index.json")
+    shred.conf.JOURNAL_LOCK_PATH = ospathjoin(scratch_dir, "journal.lock")
+    shred.conf.HDFS_ROOT = ospathjoin(scratch_dir, "data")
+    makedirs(shred.conf.HDFS_ROOT)
+    shred.import_hdfs()
+    shred.hdfs = FakeHdfs()
+    shred.zk = FakeZooKeeper()
+    shred.pending_job_info.clear()
+    shred.job_info_cache.clear()
+    shred.job_index_built = False
+    shred.conf.METRICS_TEXTFILE_DIR = None
+    return shred.hdfs
+
+
+def restore_settings():
+    """Puts back the configuration and functions of shred.py changed by the benchmarks and removes their scratch dirs"""
+    for name in set(vars(shred.conf)) - set(saved_settings):
+        delattr(shred.conf, name)
+    for name, value in saved_settings.items():
+        setattr(shred.conf, name, value)
+    for name, value in saved_functions.items():
+        setattr(shred, name, value)
+    while scratch_dirs:
+        rmtree(scratch_dirs.pop(), ignore_errors=True)
+
+
+def make_data_dir(data_dir, shard_count, shard_kb):
+    """Writes shard_count block files of shard_kb kilobytes in the layout of a DataNode data dir
+    returns the list of blk ids"""
+    shards = []
+    finalized = ospathjoin(data_dir, "current", "BP-929597290-192.168.0.1-1461159434758", "current", "finalized")
+    chunk = b'\xa5' * 1024 * shard_kb
+    for shard_number in range(shard_count):
+        subdir = ospathjoin(finalized, "subdir{0}".format(shard_number // 65536),
+                            "subdir{0}".format(shard_number // 256 % 256))
+        if shard_number % 256 == 0:
+            makedirs(subdir)
+        shard = "blk_{0}".format(1073741825 + shard_number)
+        with open(ospathjoin(subdir, shard), 'wb') as block_file:
+            block_file.write(chunk)
+        shards.append(shard)
+    return shards
+
+
+# ###################          Benchmarks            ##########################
+
+
+def bench_shred_engines(args):
+    """Times the coreutils shred binary against the native overwrite engine on block files of each size"""
+    results = []
+    work_dir = tempfile.mkdtemp(prefix="bench_shred_", dir=args.dir)
+    try:
+        for size_mb in args.sizes:
+            for engine in ['coreutils', 'native']:
+                shred.conf.SHRED_ENGINE = engine
+                block_path = ospathjoin(work_dir, "blk_{0}_{1}".format(engine, size_mb))
+                make_block_file(block_path, size_mb)
+                start_time = time()
+                shred_result = shred.shred_shard(block_path)
+                elapsed = time() - start_time
+                passes = shred.conf.SHRED_COUNT + 1
+                results.append({
+                    'benchmark': 'shred_engines',
+                    'engine': engine,
+                    'size_mb': size_mb,
+                    'passes': passes,
+                    'o_direct': shred.conf.SHRED_O_DIRECT,
+                    'seconds': round(elapsed, 3),
+                    'mb_per_sec': round(size_mb * passes / elapsed, 1),
+                    'error': shred_result,
+                })
+    finally:
+        rmtree(work_dir)
+    return results
+
+
+def bench_parse_fsck(args):
+    """Times the fsck parsers over synthetic fsck output of args.blocks block lines"""
+    results = []
+    fsck_lines = list(synthetic_fsck(args.blocks))
+    for parser_name in ['iter_fsck_blocks', 'parse_fsck_iter', 'spool_fsck_iter']:
+        spool_dir = tempfile.mkdtemp(prefix="bench_fsck_", dir=args.dir)
+        try:
+            start_time = time()
+            if parser_name == 'iter_fsck_blocks':
+                replicas = sum(1 for _ in shred.iter_fsck_blocks(iter(fsck_lines)))
+            elif parser_name == 'parse_fsck_iter':
+                replicas = sum(len(blocks) for blocks in shred.parse_fsck_iter(iter(fsck_lines)).values())
+            else:
+                spools = shred.spool_fsck_iter(iter(fsck_lines), spool_dir)
+                replicas = 0
+                for spool_path in spools.values():
+                    with open(spool_path) as spool:
+                        replicas += sum(1 for _ in spool)
+            elapsed = time() - start_time
+        finally:
+            rmtree(spool_dir)
+        results.append({
+            'benchmark': 'parse_fsck',
+            'parser': parser_name,
+            'block_lines': args.blocks,
+            'seconds': round(elapsed, 3),
+            'lines_per_sec': int(args.blocks / elapsed),
+            'result_count': replicas,
+        })
+    return results
+
+
+def bench_webhdfs_blocks(args):
+    """Times the WebHDFS block location provider against a local stub NameNode, for files of 100 blocks each"""
+    file_count = max(args.blocks // 100, 1)
+    namenode = StubNameNode(synthetic_files("/tmp/testshred/store/job/data", file_count, 100))
+    try:
+        shred.hdfs = InsecureClient(namenode.url)
+        start_time = time()
+        replicas = sum(1 for _ in shred.iter_webhdfs_blocks("/tmp/testshred/store/job/data"))
+        elapsed = time() - start_time
+    finally:
+        namenode.stop()
+    return [{
+        'benchmark': 'webhdfs_blocks',
+        'files': file_count,
+        'block_lines': file_count * 100,
+        'requests': len(namenode.requests),
+        'seconds': round(elapsed, 3),
+        'lines_per_sec': int(file_count * 100 / elapsed),
+        'result_count': replicas,
+    }]
+
+
+def bench_job_info(args):
+    """Times persist_job_info, flush_job_info and retrieve_job_info for args.jobs jobs with a dozen workers each"""
+    fake_hdfs = use_fakes()
+    jobs = [str(uuid4()) for _ in range(args.jobs)]
+    workers = ["172.16.0.{0}".format(worker) for worker in range(1, 13)]
+    start_time = time()
+    for job in jobs:
+        shred.persist_job_info(job, "master", shred.stage_2, shred.status_success)
+        shred.persist_job_info(job, "worker_list", shred.stage_2, workers)
+        for worker in workers:
+            shred.persist_job_info(job, "worker_" + worker + "_status", shred.stage_3, shred.status_success)
+        shred.flush_job_info(job)
+    persist_elapsed = time() - start_time
+    persist_ops = dict(fake_hdfs.ops)
+    fake_hdfs.ops.clear()
+    start_time = time()
+    for job in jobs:
+        shred.retrieve_job_info(job, "master")
+        shred.retrieve_job_infos(job, ["worker_" + worker + "_status" for worker in workers])
+    retrieve_elapsed = time() - start_time
+    return [{
+        'benchmark': 'job_info',
+        'operation': 'persist',
+        'jobs': args.jobs,
+        'seconds': round(persist_elapsed, 3),
+        'jobs_per_sec': int(args.jobs / persist_elapsed),
+        'hdfs_ops': persist_ops,
+    }, {
+        'benchmark': 'job_info',
+        'operation': 'retrieve',
+        'jobs': args.jobs,
+        'seconds': round(retrieve_elapsed, 3),
+        'jobs_per_sec': int(args.jobs / retrieve_elapsed),
+        'hdfs_ops': dict(fake_hdfs.ops),
+    }]
+
+
+def bench_get_jobs(args):
+    """Times get_jobs for stage 3 among args.jobs jobs at every stage, from the job index and from a scan of all jobs"""
+    results = []
+    fake_hdfs = use_fakes()
+    statuses = [
+        (shred.stage_1, shred.status_success), (shred.stage_2, shred.status_success),
+        (shred.stage_4, shred.status_success), (shred.stage_6, shred.status_success)
+    ]
+    for job_number in range(args.jobs):
+        shred.persist_job_info(str(uuid4()), "master", *statuses[job_number % len(statuses)])
+    # Measures the index as it is used after its one-off build
+    shred.ensure_job_index()
+    for job_index in [True, False]:
+        shred.conf.JOB_INDEX = job_index
+        shred.job_info_cache.clear()
+        fake_hdfs.ops.clear()
+        start_time = time()
+        job_list = shred.get_jobs(shred.stage_3)
+        elapsed = time() - start_time
+        results.append({
+            'benchmark': 'get_jobs',
+            'job_index': job_index,
+            'jobs': args.jobs,
+            'jobs_found': len(job_list),
+            'seconds': round(elapsed, 3),
+            'hdfs_ops': dict(fake_hdfs.ops),
+        })
+    return results
+
+
+def bench_leader_jobs(args):
+    """Times the stage 4 leader of args.leader_jobs ready jobs processed one at a time and conf.MAX_JOBS_IN_FLIGHT at
+    once; each job holds its lease for the two seconds taken to release it, as against ZooKeeper"""
+    results = []
+    for jobs_in_flight in sorted(set([1, shred.conf.MAX_JOBS_IN_FLIGHT])):
+        use_fakes()
+        shred.conf.MAX_JOBS_IN_FLIGHT = jobs_in_flight
+        worker = shred.get_worker_identity()
+        for _ in range(args.leader_jobs):
+            job = str(uuid4())
+            target = ospathjoin(shred.conf.HDFS_SHRED_PATH, "store", job, "data", "part-m-00000")
+            shred.hdfs.write(target, "x")
+            shred.persist_job_info(job, "data_file_list", shred.stage_1, [target])
+            shred.persist_job_info(job, "worker_list", shred.stage_2, [worker])
+            shred.persist_job_info(job, "worker_" + worker + "_status", shred.stage_3, shred.status_success)
+            shred.persist_job_info(job, "master", shred.stage_2, shred.status_success)
+            shred.flush_job_info(job)
+        start_time = time()
+        stage_result = shred.run_stage(shred.stage_4)
+        elapsed = time() - start_time
+        results.append({
+            'benchmark': 'leader_jobs',
+            'jobs': args.leader_jobs,
+            'jobs_in_flight': jobs_in_flight,
+            'result': stage_result,
+            'seconds': round(elapsed, 3),
+        })
+    return results
+
+
+def bench_worker_stages(args):
+    """Times stage 3 linking and stage 5 shredding of one job of args.shards block files in a scratch data dir"""
+    use_fakes()
+    work_dir = tempfile.mkdtemp(prefix="bench_stages_", dir=args.dir)
+    try:
+        data_dir = ospathjoin(work_dir, "data")
+        shards = make_data_dir(data_dir, args.shards, args.shard_kb)
+        shred.conf.HDFS_ROOT = data_dir
+        shred.conf.SHRED_ENGINE = args.engine
+        # Keeps the linked shards inside the scratch dir rather than at the root of its mount
+        shred.find_mount_point = lambda file_path, mount_points=None: work_dir
+        worker = shred.get_worker_identity()
+        job = str(uuid4())
+        shred.persist_job_info(job, "worker_" + worker + "_source_shard_dict", shred.stage_2,
+                               dict((shard, shred.status_no_init) for shard in shards))
+        shred.persist_job_info(job, "worker_list", shred.stage_2, [worker])
+        shred.persist_job_info(job, "master", shred.stage_2, shred.status_success)
+        shred.flush_job_info(job)
+        results = []
+        for stage, next_master in [(shred.stage_3, None), (shred.stage_5, shred.stage_4)]:
+            if next_master:
+                shred.persist_job_info(job, "master", next_master, shred.status_success)
+            start_time = time()
+            stage_result = shred.run_stage(stage)
+            elapsed = time() - start_time
+            results.append({
+                'benchmark': 'worker_stages',
+                'stage': stage,
+                'engine': args.engine if stage == shred.stage_5 else None,
+                'shards': args.shards,
+                'shard_kb': args.shard_kb,
+                'result': stage_result,
+                'seconds': round(elapsed, 3),
+                'shards_per_sec': int(args.shards / elapsed),
+            })
+    finally:
+        rmtree(work_dir)
+    return results
+
+
+def bench_shard_dict(args):
+    """Times writing and reading back a linked shard dict of args.shards shards in each format, with its size"""
+    results = []
+    use_fakes()
+    shard_dict = dict(("/grid/{0}/.shred/job/blk_{1}".format(shard % 12, 1073741825 + shard), shred.status_no_init)
+                      for shard in range(args.shards))
+    job = str(uuid4())
+    for shard_dict_format in ['json', 'table']:
+        shred.conf.SHARD_DICT_FORMAT = shard_dict_format
+        start_time = time()
+        shred.persist_job_info(job, "worker_a_linked_shard_dict", shred.stage_3, shard_dict)
+        persist_elapsed = time() - start_time
+        shred.job_info_cache.clear()
+        start_time = time()
+        shred.retrieve_job_info(job, "worker_a_linked_shard_dict")
+        retrieve_elapsed = time() - start_time
+        results.append({
+            'benchmark': 'shard_dict',
+            'format': shard_dict_format,
+            'shards': args.shards,
+            'bytes': len(shred.hdfs.files[shred.ospathjoin(shred.conf.HDFS_SHRED_PATH, "store", job,
+                                                           "worker_a_linked_shard_dict")]),
+            'persist_seconds': round(persist_elapsed, 3),
+            'retrieve_seconds': round(retrieve_elapsed, 3),
+        })
+    return results
+
+
+def bench_startup(args):
+    """Times importing shred.py in a new interpreter args.runs times, noting which client libraries the import loaded,
+    then a worker and a shredder run finding no work in an empty job store, with the HDFS requests each made"""
+    import_script = ("import sys, time, json; start_time = time.time(); import shred; "
+                     "print(json.dumps([time.time() - start_time, "
+                     "[name for name in ['hdfs', 'kazoo', 'requests'] if name in sys.modules]]))")
+    import_times = []
+    loaded = []
+    for _ in range(args.runs):
+        output = subprocess.check_output([sys.executable, "-c", import_script],
+                                         cwd=dirname(dirname(realpath(__file__))))
+        import_time, loaded = loads(output.decode('utf-8'))
+        import_times.append(import_time)
+    import_times.sort()
+    results = [{
+        'benchmark': 'startup',
+        'operation': 'import',
+        'runs': args.runs,
+        'min_ms': round(import_times[0] * 1000, 1),
+        'median_ms': round(import_times[len(import_times) // 2] * 1000, 1),
+        'clients_imported': loaded,
+    }]
+    for mode, stage_list in [('worker', [shred.stage_2, shred.stage_3, shred.stage_4]),
+                             ('shredder', [shred.stage_5, shred.stage_6])]:
+        fake_hdfs = use_fakes()
+        # The setup of a new cluster is recorded by the first run, as it is on a DataNode
+        shred.run_stage_list(stage_list)
+        shred.job_index_built = False
+        fake_hdfs.ops.clear()
+        start_time = time()
+        stage_result = shred.run_stage_list(stage_list)
+        elapsed = time() - start_time
+        results.append({
+            'benchmark': 'startup',
+            'operation': mode + '_idle_run',
+            'result': stage_result,
+            'ms': round(elapsed * 1000, 1),
+            'hdfs_ops': dict(fake_hdfs.ops),
+        })
+    return results
+
+
+benchmarks = {
+    'get_jobs': bench_get_jobs,
+    'job_info': bench_job_info,
+    'leader_jobs': bench_leader_jobs,
+    'parse_fsck': bench_parse_fsck,
+    'shard_dict': bench_shard_dict,
+    'webhdfs_blocks': bench_webhdfs_blocks,
+    'worker_stages': bench_worker_stages,
+    'shred_engines': bench_shred_engines,
+    'startup': bench_startup,
+}
+
+
+# ###################          main program           ##########################
+
+
+def parse_bench_args(user_args):
+    parser = argparse.ArgumentParser(description="Benchmarks for the hot paths of shred.py")
+    parser.add_argument('names', nargs='*',
+                        help="Benchmarks to run from [{0}], defaults to all of them."
+                        .format(", ".join(sorted(benchmarks.keys()))))
+    parser.add_argument('--dir', action="store", default=None,
+                        help="Directory for benchmark block files, ideally on a DataNode data disk.")
+    parser.add_argument('--sizes', action="store", type=int, nargs='+', default=[128, 1024],
+                        help="Block file sizes in MB for the shred engine benchmark.")
+    parser.add_argument('--blocks', action="store", type=int, default=1000000,
+                        help="Number of synthetic block lines for the block location benchmarks.")
+    parser.add_argument('--jobs', action="store", type=int, default=10000,
+                        help="Number of jobs in the job store for the job info and get_jobs benchmarks.")
+    parser.add_argument('--leader-jobs', action="store", type=int, default=8,
+                        help="Number of jobs ready for the stage 4 leader in the leader jobs benchmark.")
+    parser.add_argument('--shards', action="store", type=int, default=10000,
+                        help="Number of block files in the job for the worker stages benchmark.")
+    parser.add_argument('--shard-kb', action="store", type=int, default=64,
+                        help="Size in KB of each block file for the worker stages benchmark.")
+    parser.add_argument('--engine', action="store", default='native', choices=['native', 'coreutils'],
+                        help="Shred engine for stage 5 of the worker stages benchmark.")
+    parser.add_argument('--runs', action="store", type=int, default=5,
+                        help="Number of interpreters started to time the import of shred.py in the startup benchmark.")
+    parser.add_argument('--debug', action="store_true", help="Log from shred.py at its configured level.")
+    parser.add_argument('--output', action="store", default=None,
+                        help="Append JSON results to this file as well as printing them.")
+    result = parser.parse_args(user_args)
+    for name in result.names:
+        if name not in benchmarks:
+            parser.error("Unknown benchmark [{0}]".format(name))
+    return result
+
+
+if __name__ == "__main__":
+    bench_args = parse_bench_args(sys.argv[1:])
+    if not bench_args.debug:
+        # Logging at the debug level would dominate the timings
+        shred.log.setLevel(logging.WARNING)
+    output_lines = []
+    for name in bench_args.names or sorted(benchmarks.keys()):
+        try:
+            for result in benchmarks[name](bench_args):
+                output_lines.append(dumps(result, sort_keys=True))
+                print(output_lines[-1])
+        finally:
+            # Each benchmark starts from the configuration as it was, whatever the one before changed
+            restore_settings()
+    if bench_args.output:
+        with open(bench_args.output, 'a') as output_file:
+            output_file.write("\n".join(output_lines) + "\n")
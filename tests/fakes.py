@@ -0,0 +1,270 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+In-memory stand-ins for the HDFS and ZooKeeper clients used by shred.py, so its workflows can be run and measured
+without a cluster, for example by tests/bench_shred.py
+Only the parts of the hdfscli and kazoo APIs that shred.py uses are provided
+"""
+
+import threading
+from uuid import uuid4
+from posixpath import dirname, basename
+from posixpath import join as posixjoin
+from hdfs import HdfsError
+from kazoo.exceptions import NoNodeError
+
+
+class FakeReader(object):
+    """Context manager returned by FakeHdfs.read, like the one of hdfscli"""
+
+    def __init__(self, content):
+        self.content = content
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def read(self):
+        return self.content
+
+
+class FakeHdfs(object):
+    """An in-memory hdfscli client; files are held as strings and every request is counted by operation in ops
+    The names in each directory are indexed so listings cost the same however many files are held
+    Each is a new cluster with a url of its own, so setup recorded in shred.py's local setup marker is redone"""
+
+    def __init__(self):
+        self.url = "fake://" + str(uuid4())
+        self.files = {}
+        self.children = {'/': set()}
+        self.mtimes = {}
+        self.clock = 0
+        self.ops = {}
+        self.lock = threading.RLock()
+
+    def count(self, operation):
+        self.ops[operation] = self.ops.get(operation, 0) + 1
+
+    def tick(self):
+        self.clock += 1
+        return self.clock
+
+    def add_dirs(self, path):
+        if path in self.children:
+            return
+        self.add_dirs(dirname(path))
+        self.children[path] = set()
+        self.children[dirname(path)].add(basename(path))
+        self.mtimes[path] = self.tick()
+
+    def add_file(self, path, content):
+        self.add_dirs(dirname(path))
+        self.files[path] = content
+        self.children[dirname(path)].add(basename(path))
+        self.mtimes[path] = self.tick()
+
+    def remove(self, path):
+        if path in self.children:
+            for name in list(self.children[path]):
+                self.remove(posixjoin(path, name))
+            del self.children[path]
+        else:
+            del self.files[path]
+        del self.mtimes[path]
+        self.children[dirname(path)].discard(basename(path))
+
+    def move(self, src_path, dst_path):
+        if src_path in self.children:
+            self.add_dirs(dst_path)
+            for name in list(self.children[src_path]):
+                self.move(posixjoin(src_path, name), posixjoin(dst_path, name))
+        else:
+            self.add_file(dst_path, self.files[src_path])
+
+    def file_status(self, path):
+        if path in self.files:
+            return {'type': 'FILE', 'length': len(self.files[path]), 'modificationTime': self.mtimes[path]}
+        elif path in self.children:
+            return {'type': 'DIRECTORY', 'length': 0, 'modificationTime': self.mtimes.get(path, 0)}
+        return None
+
+    def status(self, hdfs_path, strict=True):
+        with self.lock:
+            self.count('status')
+            path_status = self.file_status(hdfs_path)
+        if path_status is None and strict:
+            raise HdfsError("File does not exist: {0}".format(hdfs_path))
+        return path_status
+
+    def content(self, hdfs_path, strict=True):
+        with self.lock:
+            self.count('content')
+            path_status = self.file_status(hdfs_path)
+        if path_status is None and strict:
+            raise HdfsError("File does not exist: {0}".format(hdfs_path))
+        return path_status
+
+    def list(self, hdfs_path, status=False):
+        with self.lock:
+            self.count('list')
+            if hdfs_path not in self.children:
+                raise HdfsError("File {0} does not exist.".format(hdfs_path))
+            names = sorted(self.children[hdfs_path])
+            if status:
+                return [(name, self.file_status(posixjoin(hdfs_path, name))) for name in names]
+            return names
+
+    def read(self, hdfs_path):
+        with self.lock:
+            self.count('read')
+            if hdfs_path not in self.files:
+                raise HdfsError("File does not exist: {0}".format(hdfs_path))
+            return FakeReader(self.files[hdfs_path])
+
+    def write(self, hdfs_path, data=None, overwrite=False, append=False):
+        with self.lock:
+            if append:
+                self.count('append')
+                if hdfs_path not in self.files:
+                    raise HdfsError("File does not exist: {0}".format(hdfs_path))
+                self.files[hdfs_path] += data
+                self.mtimes[hdfs_path] = self.tick()
+            else:
+                self.count('write')
+                if self.file_status(hdfs_path) is not None and not overwrite:
+                    raise HdfsError("File {0} already exists.".format(hdfs_path))
+                self.add_file(hdfs_path, data)
+
+    def makedirs(self, hdfs_path):
+        with self.lock:
+            self.count('makedirs')
+            self.add_dirs(hdfs_path)
+
+    def rename(self, hdfs_src_path, hdfs_dst_path):
+        with self.lock:
+            self.count('rename')
+            if hdfs_dst_path in self.children:
+                hdfs_dst_path = posixjoin(hdfs_dst_path, basename(hdfs_src_path))
+            if (self.file_status(hdfs_src_path) is None or self.file_status(hdfs_dst_path) is not None or
+                    dirname(hdfs_dst_path) not in self.children):
+                raise HdfsError("Unable to rename {0} to {1}".format(hdfs_src_path, hdfs_dst_path))
+            self.move(hdfs_src_path, hdfs_dst_path)
+            self.remove(hdfs_src_path)
+
+    def delete(self, hdfs_path, recursive=False):
+        with self.lock:
+            self.count('delete')
+            if self.file_status(hdfs_path) is None:
+                return False
+            if self.children.get(hdfs_path) and not recursive:
+                raise HdfsError("{0} is non empty': Directory is not empty".format(hdfs_path))
+            self.remove(hdfs_path)
+            return True
+
+
+class FakeLease(object):
+    """Stand-in for a kazoo NonBlockingLease, held by the first identifier to ask until it expires or is released"""
+
+    def __init__(self, zk, path, duration, identifier=None):
+        self.obtained = zk.obtain_lease(path, duration, identifier)
+
+    def __bool__(self):
+        return self.obtained
+
+    __nonzero__ = __bool__
+
+
+class FakeZooKeeper(object):
+    """An in-memory kazoo client holding znodes in a dict, with watches on children and non-blocking leases
+    Leases are granted in the order requested and never expire by time, as runs are short; a lease requested with
+    a duration under two seconds, which shred.py uses to release one, releases it"""
+
+    state = 'CONNECTED'
+
+    def __init__(self):
+        self.nodes = {'/': b''}
+        self.watches = {}
+        self.leases = {}
+        self.lock = threading.RLock()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+    def parent(self, path):
+        return path.rstrip("/").rsplit("/", 1)[0] or "/"
+
+    def fire_watches(self, path):
+        for watch in self.watches.pop(path, []):
+            watch(None)
+
+    def exists(self, path):
+        with self.lock:
+            if (path.rstrip("/") or "/") in self.nodes:
+                return True
+        return None
+
+    def ensure_path(self, path):
+        with self.lock:
+            node = ""
+            for part in path.strip("/").split("/"):
+                node += "/" + part
+                if node not in self.nodes:
+                    self.nodes[node] = b''
+                    self.fire_watches(self.parent(node))
+
+    def create(self, path, value=b'', makepath=False):
+        with self.lock:
+            self.ensure_path(self.parent(path))
+            self.nodes[path] = value
+            self.fire_watches(self.parent(path))
+
+    def set(self, path, value):
+        with self.lock:
+            if path not in self.nodes:
+                raise NoNodeError()
+            self.nodes[path] = value
+
+    def get(self, path):
+        with self.lock:
+            if path not in self.nodes:
+                raise NoNodeError()
+            return self.nodes[path], None
+
+    def get_children(self, path, watch=None):
+        with self.lock:
+            path = path.rstrip("/") or "/"
+            if path not in self.nodes:
+                raise NoNodeError()
+            if watch is not None:
+                self.watches.setdefault(path, []).append(watch)
+            return [node.rsplit("/", 1)[1] for node in self.nodes if node != "/" and self.parent(node) == path]
+
+    def delete(self, path, recursive=False):
+        with self.lock:
+            path = path.rstrip("/")
+            for node in list(self.nodes.keys()):
+                if node == path or node.startswith(path + "/"):
+                    del self.nodes[node]
+            self.fire_watches(self.parent(path))
+
+    def obtain_lease(self, path, duration, identifier):
+        with self.lock:
+            if duration.days * 86400 + duration.seconds < 2:
+                self.leases.pop(path, None)
+                return False
+            if path in self.leases and self.leases[path] != identifier:
+                return False
+            self.leases[path] = identifier
+            return True
+
+    def NonBlockingLease(self, path, duration, identifier=None):
+        return FakeLease(self, path, duration, identifier)
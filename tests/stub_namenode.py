@@ -0,0 +1,179 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+A local stand-in for the WebHDFS API of a NameNode, serving an in-memory tree of files with synthetic blocks
+Answers the GETFILESTATUS, LISTSTATUS and GET_BLOCK_LOCATIONS operations used by the WebHDFS block location provider,
+and renders the same tree as 'hdfs fsck -files -blocks -locations' output so the providers can be compared
+"""
+
+import threading
+from json import dumps
+from posixpath import basename
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs, unquote
+
+
+webhdfs_prefix = "/webhdfs/v1"
+block_pool_id = "BP-929597290-192.168.0.1-1461159434758"
+block_size = 134217728
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubNameNode(object):
+    """Serves files, a dict of HDFS path to a list of blocks as (block id, generation stamp, length, [datanode IPs]),
+    on a free local port until stop is called; the url attribute is the address to give the HDFS client"""
+
+    def __init__(self, files):
+        self.files = files
+        self.requests = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.make_handler())
+        self.url = "http://127.0.0.1:{0}".format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def is_dir(self, path):
+        prefix = path.rstrip("/") + "/"
+        return any(file_path.startswith(prefix) for file_path in self.files)
+
+    def file_status(self, path):
+        if path in self.files:
+            return {'type': 'FILE', 'length': sum(block[2] for block in self.files[path]), 'pathSuffix': "",
+                    'blockSize': block_size, 'replication': 3, 'modificationTime': 0}
+        elif self.is_dir(path) or path == "/":
+            return {'type': 'DIRECTORY', 'length': 0, 'pathSuffix': "", 'modificationTime': 0}
+        return None
+
+    def list_status(self, path):
+        prefix = path.rstrip("/") + "/"
+        names = set()
+        for file_path in self.files:
+            if file_path.startswith(prefix):
+                names.add(file_path[len(prefix):].split("/")[0])
+        listing = []
+        for name in sorted(names):
+            item_status = self.file_status(prefix + name)
+            item_status['pathSuffix'] = name
+            listing.append(item_status)
+        return listing
+
+    def located_blocks(self, path, offset, length):
+        located = []
+        start_offset = 0
+        for block_id, generation_stamp, block_length, datanodes in self.files[path]:
+            if start_offset + block_length > offset and start_offset < offset + length:
+                located.append({
+                    'block': {'blockPoolId': block_pool_id, 'blockId': block_id, 'numBytes': block_length,
+                              'generationStamp': generation_stamp},
+                    'locations': [{'ipAddr': dn_ip, 'hostName': dn_ip, 'xferPort': 50010,
+                                   'storageID': "DS-" + dn_ip} for dn_ip in datanodes],
+                    'startOffset': start_offset,
+                    'isCorrupt': False,
+                })
+            start_offset += block_length
+        return {'LocatedBlocks': {'fileLength': start_offset, 'isUnderConstruction': False,
+                                  'isLastBlockComplete': True, 'locatedBlocks': located}}
+
+    def walk_files(self, path):
+        """Lists the files under path depth first in listing order, as fsck visits them"""
+        if path in self.files:
+            return [path]
+        file_paths = []
+        for item_status in self.list_status(path):
+            file_paths.extend(self.walk_files(path.rstrip("/") + "/" + item_status['pathSuffix']))
+        return file_paths
+
+    def fsck_output(self, path):
+        """Renders the tree under path, or a single file, in the format of 'hdfs fsck -files -blocks -locations'"""
+        lines = []
+        for file_path in self.walk_files(path):
+            blocks = self.files[file_path]
+            lines.append("{0} {1} bytes, {2} block(s):  OK\n".format(
+                file_path, sum(block[2] for block in blocks), len(blocks)))
+            for index, (block_id, generation_stamp, block_length, datanodes) in enumerate(blocks):
+                locations = ["DatanodeInfoWithStorage[{0}:50010,DS-{0},DISK]".format(dn_ip) for dn_ip in datanodes]
+                lines.append("{0}. {1}:blk_{2}_{3} len={4} Live_repl={5} [{6}]\n".format(
+                    index, block_pool_id, block_id, generation_stamp, block_length, len(datanodes),
+                    ", ".join(locations)))
+            lines.append("\n")
+        lines.append("Status: HEALTHY\n")
+        return lines
+
+    def make_handler(self):
+        namenode = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, code, content):
+                body = dumps(content).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_remote_exception(self, code, exception, message):
+                self.send_json(code, {'RemoteException': {'exception': exception, 'message': message,
+                                                          'javaClassName': 'java.io.' + exception}})
+
+            def do_GET(self):
+                request = urlparse(self.path)
+                path = unquote(request.path[len(webhdfs_prefix):]) or "/"
+                params = dict((key, values[0]) for key, values in parse_qs(request.query).items())
+                operation = params.get('op', '').upper()
+                namenode.requests.append((operation, path))
+                path_status = namenode.file_status(path)
+                if path_status is None:
+                    self.send_remote_exception(404, 'FileNotFoundException', "File does not exist: " + path)
+                elif operation == 'GETFILESTATUS':
+                    self.send_json(200, {'FileStatus': path_status})
+                elif operation == 'LISTSTATUS':
+                    if path_status['type'] == 'FILE':
+                        path_status['pathSuffix'] = basename(path)
+                        listing = [path_status]
+                    else:
+                        listing = namenode.list_status(path)
+                    self.send_json(200, {'FileStatuses': {'FileStatus': listing}})
+                elif operation == 'GET_BLOCK_LOCATIONS' and path_status['type'] == 'FILE':
+                    offset = int(params.get('offset', 0))
+                    length = int(params.get('length', path_status['length']))
+                    self.send_json(200, namenode.located_blocks(path, offset, length))
+                else:
+                    self.send_remote_exception(400, 'IllegalArgumentException',
+                                               "Invalid value for webhdfs parameter op: " + operation)
+
+        return Handler
+
+
+def synthetic_files(root, file_count, blocks_per_file, datanode_count=12, replication=3):
+    """Generates a files dict for StubNameNode with block placement like that of synthetic fsck output"""
+    files = {}
+    block_id = 1073741825
+    for file_index in range(file_count):
+        blocks = []
+        for _ in range(blocks_per_file):
+            datanodes = ["172.16.{0}.{1}".format(node // 250, node % 250 + 1)
+                         for node in [(block_id + replica) % datanode_count for replica in range(replication)]]
+            blocks.append((block_id, block_id - 1073740824, block_size, datanodes))
+            block_id += 1
+        files["{0}/part-m-{1:05d}".format(root, file_index)] = blocks
+    return files
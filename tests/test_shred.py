@@ -4,10 +4,23 @@
 from glob import glob
 from shlex import split as ssplit
 from os.path import join as ospathjoin
+from os.path import split as ospathsplit
 from os.path import isfile 
+from os.path import dirname, realpath
+from os import makedev
+from uuid import uuid4
+from json import loads
+from time import sleep, time
+from threading import Lock
+from signal import signal, setitimer, SIGALRM, ITIMER_REAL
+import sys
+import subprocess
 import pytest
 import shred
 import socket
+import hdfs
+from stub_namenode import StubNameNode
+from hdfs import InsecureClient
 
 
 test_file_size = "10"
@@ -28,6 +41,8 @@ remove_test_jobs = False
 
 
 def setup_module():
+    # Tests swapping in their own HDFS clients need the real HdfsError in place of its stand-in
+    shred.import_hdfs()
     # clear environment from previous test runs
     clear_test_jobs()
 
@@ -117,6 +132,8 @@ def test_init_program():
     args = shred.init_program(test_args)
     assert args.mode == "client"
     assert args.filename == test_file
+    # Connecting is left to the first stage to need HDFS
+    shred.ensure_hdfs()
     path_test = shred.hdfs.status(shred.conf.HDFS_SHRED_PATH)
     assert path_test['type'] == "DIRECTORY"
 
@@ -144,12 +161,25 @@ def test_run_stage_1():
     data_status = shred.retrieve_job_info(test_job_id, "data_status")
     assert shred.status_success in data_status
     assert shred.stage_1 in data_status
-    # Only tests a single file
-    target = shred.retrieve_job_info(test_job_id, "data_file_list")
-    target_exists = shred.hdfs.status(target, strict=False)
-    assert target_exists is not None
+    targets = shred.retrieve_job_info(test_job_id, "data_file_list")
+    for target in targets:
+        target_exists = shred.hdfs.status(target, strict=False)
+        assert target_exists is not None
     with pytest.raises(shred.HdfsError):
         shred.hdfs.status(test_file)
+    # test a glob matching several files, submitted as one job
+    test_dir = ospathjoin("/tmp", "shred_bulk_" + str(uuid4()))
+    shred.hdfs.makedirs(test_dir)
+    for name in ["a.dat", "b.dat", "c.txt"]:
+        shred.hdfs.write(ospathjoin(test_dir, name), data="testshred")
+    result, test_job_id = shred.run_stage(shred.stage_1, [ospathjoin(test_dir, "*.dat")])
+    assert result == shred.status_success
+    targets = shred.retrieve_job_info(test_job_id, "data_file_list")
+    assert sorted([ospathsplit(target)[1] for target in targets]) == ["a.dat", "b.dat"]
+    assert shred.hdfs.status(ospathjoin(test_dir, "c.txt"), strict=False) is not None
+    # test a glob with no matches
+    result, test_job_id = shred.run_stage(shred.stage_1, [ospathjoin(test_dir, "*.none")])
+    assert result == shred.status_fail
 
 
 @pytest.mark.skip
@@ -246,9 +276,10 @@ def test_run_stage_4():
     data_status = shred.retrieve_job_info(test_job_id, "data_status")
     assert shred.status_success in data_status
     assert shred.stage_4 in data_status
-    target = shred.retrieve_job_info(test_job_id, "data_file_list")
-    target_exists = shred.hdfs.status(target, strict=False)
-    assert target_exists is None
+    targets = shred.get_job_targets(test_job_id)
+    for target in targets:
+        target_exists = shred.hdfs.status(target, strict=False)
+        assert target_exists is None
     workers_list = shred.retrieve_job_info(test_job_id, "worker_list", strict=False)
     assert workers_list is not None
     for worker in workers_list:
@@ -344,12 +375,38 @@ def test_parse_user_args():
         shred.parse_user_args(["-m", "file"])
     with pytest.raises(SystemExit):
         shred.parse_user_args(["-m", "worker", "-f", "somefile"])
+    out = shred.parse_user_args(["-m", "client", "-l", "somemanifest"])
+    assert "somemanifest" in out.manifest
+    assert out.filename is None
+    with pytest.raises(SystemExit):
+        shred.parse_user_args(["-m", "client"])
+    with pytest.raises(SystemExit):
+        shred.parse_user_args(["-m", "shredder", "-l", "somemanifest"])
+    out = shred.parse_user_args(["-m", "worker", "--daemon"])
+    assert out.daemon
+    with pytest.raises(SystemExit):
+        shred.parse_user_args(["-m", "client", "-f", "somefile", "--daemon"])
+    out = shred.parse_user_args(["-m", "plan", "-f", "somefile"])
+    assert out.mode == "plan"
+    out = shred.parse_user_args(["-m", "worker", "--profile", "trace.jsonl", "--profile-stats", "stats"])
+    assert out.profile == ospathjoin(shred.realpath("."), "trace.jsonl")
+    assert out.profile_stats == ospathjoin(shred.realpath("."), "stats")
+    with pytest.raises(SystemExit):
+        shred.parse_user_args(["-m", "plan"])
     with pytest.raises(SystemExit):
         shred.parse_user_args(["-v"])
     with pytest.raises(SystemExit):
         shred.parse_user_args(["-h"])
 
 
+def test_read_manifest(tmpdir):
+    manifest = tmpdir.join("manifest")
+    manifest.write("# files to shred\n/tmp/shred_a\n\n  /tmp/shred_dir/*.dat  \n")
+    assert shred.read_manifest(str(manifest)) == ["/tmp/shred_a", "/tmp/shred_dir/*.dat"]
+    args = shred.parse_user_args(["-m", "client", "-l", str(manifest), "-f", "/tmp/shred_b"])
+    assert shred.get_client_targets(args) == ["/tmp/shred_a", "/tmp/shred_dir/*.dat", "/tmp/shred_b"]
+
+
 # @pytest.mark.skip
 def test_ensure_zk():
     shred.log.info("Testing ZooKeeper connector")
@@ -360,14 +417,56 @@ def test_ensure_zk():
     assert shred.zk.state == 'LOST'
 
 
+def test_wait_for_barrier():
+    test_job_id = str(uuid4())
+    shred.report_to_barrier(test_job_id, shred.stage_3, "172.16.0.80", shred.status_success)
+    # Times out while a worker has not reported
+    assert shred.wait_for_barrier(test_job_id, shred.stage_3, ["172.16.0.80", "172.16.0.40"], 1) is False
+    shred.report_to_barrier(test_job_id, shred.stage_3, "172.16.0.40", shred.status_success)
+    assert shred.wait_for_barrier(test_job_id, shred.stage_3, ["172.16.0.80", "172.16.0.40"], 60) is True
+    # Any failure wakes the leader straight away
+    shred.report_to_barrier(test_job_id, shred.stage_5, "172.16.0.80", shred.status_fail)
+    assert shred.wait_for_barrier(test_job_id, shred.stage_5, ["172.16.0.80", "172.16.0.40"], 60) is True
+    # Reports the caller has already been woken for do not wake it again
+    reported = {}
+    assert shred.wait_for_barrier(test_job_id, shred.stage_5, ["172.16.0.80", "172.16.0.40"], 60, reported) is True
+    assert shred.wait_for_barrier(test_job_id, shred.stage_5, ["172.16.0.80", "172.16.0.40"], 1, reported) is False
+    shred.clear_barrier(test_job_id)
+    assert shred.zk.exists(shred.get_barrier_path(test_job_id)) is None
+
+
 # @pytest.mark.skip
 def test_ensure_hdfs():
     shred.log.info("Testing Connection to HDFS")
     shred.ensure_hdfs()
+    assert shred.HdfsError is hdfs.HdfsError
     # TODO: Test HDFS connectivity stability
     # TODO: This really needs connection tracking
 
 
+def test_lazy_imports():
+    import_script = ("import sys, shred; "
+                     "print(' '.join(name for name in ['hdfs', 'kazoo', 'requests', 'uuid'] if name in sys.modules))")
+    output = subprocess.check_output([sys.executable, "-c", import_script], cwd=dirname(dirname(realpath(__file__))))
+    assert output.strip() == b""
+
+
+def test_setup_marker(tmpdir, monkeypatch):
+    shred.ensure_hdfs()
+    monkeypatch.setattr(shred.conf, "SETUP_MARKER_PATH", str(tmpdir.join("setup.json")))
+    assert not shred.is_setup_done('dirs')
+    shred.record_setup('dirs')
+    shred.record_setup('job_index')
+    shred.record_setup('dirs')
+    assert shred.read_setup_marker() == ['dirs', 'job_index']
+    assert shred.is_setup_done('dirs')
+    # Setup is redone against another shred path or cluster
+    monkeypatch.setattr(shred.conf, "HDFS_SHRED_PATH", "/tmp/testshred/" + str(uuid4()))
+    assert not shred.is_setup_done('dirs')
+    tmpdir.join("setup.json").write("not json")
+    assert shred.read_setup_marker() == []
+
+
 @pytest.mark.skip
 def test_run_shell_command():
     pass
@@ -381,40 +480,813 @@ def test_get_worker_identity():
     socket.inet_aton(worker_id)
 
 
-@pytest.mark.skip
-def test_find_mount_point():
-    # No test written
-    pass
+def test_find_mount_point(tmpdir, monkeypatch):
+    volume = tmpdir.mkdir("data 1")
+    mountinfo = tmpdir.join("mountinfo")
+    mountinfo.write("22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw\n"
+                    "35 22 8:17 / {0} rw,relatime shared:2 - ext4 /dev/sdb1 rw\n"
+                    .format(str(volume).replace(" ", "\\040")))
+    monkeypatch.setattr(shred, "mountinfo_path", str(mountinfo))
+    mount_points = shred.read_mount_points()
+    assert mount_points == [str(volume), "/"]
+    assert shred.find_mount_point(str(volume.join("dn", "blk_1")), mount_points) == str(volume)
+    assert shred.find_mount_point(str(tmpdir.join("data")), mount_points) == "/"
+    monkeypatch.setattr(shred.conf, "HDFS_ROOT", str(volume.join("dn")) + "," + str(tmpdir.join("dn")))
+    volume_map = shred.get_volume_map()
+    assert shred.find_shard_volume(str(volume.join("dn", "current", "blk_1")), volume_map) == str(volume)
+    assert shred.find_shard_volume(str(tmpdir.join("dn", "current", "blk_2")), volume_map) == "/"
+    monkeypatch.setattr(shred, "mountinfo_path", str(tmpdir.join("missing")))
+    assert shred.read_mount_points() is None
 
 
-@pytest.mark.skip
-def test_parse_fsck_iter():
-    # No test written
-    pass
+test_fsck_output = [
+    "/tmp/testshred/store/job/data/part-m-00000 1000 bytes, 2 block(s):  OK\n",
+    "0. BP-929597290-192.168.0.1-1461159434758:blk_1073839025_98201 len=500 Live_repl=2 "
+    "[DatanodeInfoWithStorage[172.16.0.80:50010,DS-0e5b2f33-7c4e-4d6b-9c47-5a2f0f6d8f7e,DISK], "
+    "DatanodeInfoWithStorage[172.16.0.40:50010,DS-6a1f7f3e-23c8-4c1c-8b1e-1b7a1d2a4f11,DISK]]\n",
+    "1. BP-929597290-192.168.0.1-1461159434758:blk_1073839026_98202 len=500 Live_repl=1 "
+    "[DatanodeInfoWithStorage[172.16.0.80:50010,DS-0e5b2f33-7c4e-4d6b-9c47-5a2f0f6d8f7e,DISK]]\n",
+    "\n",
+    "Status: HEALTHY\n",
+]
 
 
-@pytest.mark.skip
-def test_get_jobs():
-    # No test written
-    pass
+def test_parse_fsck_iter(tmpdir):
+    assert list(shred.iter_fsck_blocks(iter(test_fsck_output))) == [
+        ('172.16.0.80', 'blk_1073839025'), ('172.16.0.40', 'blk_1073839025'), ('172.16.0.80', 'blk_1073839026')
+    ]
+    assert shred.parse_fsck_iter(iter(test_fsck_output)) == {
+        '172.16.0.80': ['blk_1073839025', 'blk_1073839026'], '172.16.0.40': ['blk_1073839025']
+    }
+    assert list(shred.iter_fsck_replicas(iter(test_fsck_output))) == [
+        ('172.16.0.80', 'DS-0e5b2f33-7c4e-4d6b-9c47-5a2f0f6d8f7e', 'blk_1073839025', 500),
+        ('172.16.0.40', 'DS-6a1f7f3e-23c8-4c1c-8b1e-1b7a1d2a4f11', 'blk_1073839025', 500),
+        ('172.16.0.80', 'DS-0e5b2f33-7c4e-4d6b-9c47-5a2f0f6d8f7e', 'blk_1073839026', 500),
+    ]
+    spools = shred.spool_fsck_iter(iter(test_fsck_output), str(tmpdir))
+    assert sorted(spools.keys()) == ['172.16.0.40', '172.16.0.80']
+    with open(spools['172.16.0.80']) as spool:
+        assert spool.read().split() == ['blk_1073839025', 'blk_1073839026']
 
 
-@pytest.mark.skip
-def test_find_shard():
-    # No test written
-    pass
+def test_iter_webhdfs_blocks(monkeypatch):
+    files = {
+        "/shred/data/a.txt": [(1073839025, 98201, 500, ["172.16.0.80", "172.16.0.40"])],
+        "/shred/data/a/part-0": [(1073839026, 98202, 500, ["172.16.0.80"]),
+                                 (1073839027, 98203, 200, ["172.16.0.40", "172.16.0.50"])],
+        "/shred/data/empty": [],
+    }
+    namenode = StubNameNode(files)
+    try:
+        monkeypatch.setattr(shred, "hdfs", InsecureClient(namenode.url))
+        monkeypatch.setattr(shred.conf, "BLOCK_LOCATION_PROVIDER", "webhdfs")
+        assert list(shred.get_block_locations("/shred/data")) == list(
+            shred.iter_fsck_blocks(iter(namenode.fsck_output("/shred/data"))))
+        assert shred.group_block_locations(shred.get_block_locations("/shred/data")) == shred.parse_fsck_iter(
+            iter(namenode.fsck_output("/shred/data")))
+        assert list(shred.get_block_locations("/shred/data/a.txt")) == [
+            ('172.16.0.80', 'blk_1073839025'), ('172.16.0.40', 'blk_1073839025')
+        ]
+        assert list(shred.get_block_replicas("/shred/data")) == list(
+            shred.iter_fsck_replicas(iter(namenode.fsck_output("/shred/data"))))
+        with pytest.raises(shred.HdfsError):
+            list(shred.get_block_locations("/shred/missing"))
+    finally:
+        namenode.stop()
+
+
+def test_get_block_locations_fallbacks(monkeypatch):
+    files = {"/shred/data/a.txt": [(1073839025, 98201, 500, ["172.16.0.80"])]}
+    namenode = StubNameNode(files)
+    try:
+        monkeypatch.setattr(shred.conf, "BLOCK_LOCATION_PROVIDER", "webhdfs")
+        # An unreachable first NameNode is skipped, as the client itself fails over
+        monkeypatch.setattr(shred, "hdfs", InsecureClient("http://127.0.0.1:1;" + namenode.url))
+        assert list(shred.get_block_locations("/shred/data")) == [('172.16.0.80', 'blk_1073839025')]
+        # A client without NameNode urls uses fsck instead
+        monkeypatch.setattr(shred, "hdfs", object())
+        monkeypatch.setattr(shred, "run_shell_command", lambda command: iter(namenode.fsck_output(command[2])))
+        assert list(shred.get_block_locations("/shred/data")) == [('172.16.0.80', 'blk_1073839025')]
+    finally:
+        namenode.stop()
+
+
+def test_plan_shred(monkeypatch):
+    files = {
+        "/shred/data/a": [(1073839025, 98201, 1048576, ["172.16.0.80", "172.16.0.40"])],
+        "/shred/data/b": [(1073839026, 98202, 2097152, ["172.16.0.80"])],
+    }
+    namenode = StubNameNode(files)
+    try:
+        monkeypatch.setattr(shred, "hdfs", InsecureClient(namenode.url))
+        monkeypatch.setattr(shred.conf, "BLOCK_LOCATION_PROVIDER", "webhdfs")
+        monkeypatch.setattr(shred.conf, "SHRED_COUNT", 1)
+        monkeypatch.setattr(shred.conf, "SHRED_RATE_LIMIT", 0)
+        monkeypatch.setattr(shred.conf, "SHRED_RATE_SCHEDULE", [])
+        monkeypatch.setattr(shred.conf, "PLAN_DEFAULT_MB_PER_SECOND", 1)
+        monkeypatch.setattr(shred, "read_shred_throughputs", lambda: {"DS-172.16.0.80": 2})
+        plan = shred.plan_shred(["/shred/data"])
+    finally:
+        namenode.stop()
+    assert plan['bytes'] == 4194304
+    assert plan['nodes']['172.16.0.80']['blocks'] == 2
+    # 3 MB over 2 passes at the 2 MB/s measured, against 1 MB over 2 passes at the default 1 MB/s
+    assert plan['nodes']['172.16.0.80']['seconds'] == 3
+    assert plan['nodes']['172.16.0.40']['seconds'] == 2
+    assert plan['critical_node'] == '172.16.0.80'
+    assert plan['seconds'] == 3
+    report = shred.format_shred_plan(plan)
+    assert "critical path datanode [172.16.0.80]" in report
+    assert "DS-172.16.0.40: [0.0] GB at [1.0] MB/s (default)" in report
+
+
+def test_record_shred_throughput(tmpdir, monkeypatch):
+    shred.ensure_hdfs()
+    data_dir = tmpdir.mkdir("data")
+    data_dir.mkdir("current").join("VERSION").write("#Mon Jan 01 00:00:00 UTC 2017\n"
+                                                    "storageID=DS-0e5b2f33-7c4e-4d6b-9c47-5a2f0f6d8f7e\n")
+    monkeypatch.setattr(shred.conf, "HDFS_ROOT", str(data_dir))
+    monkeypatch.setattr(shred.conf, "HDFS_SHRED_PATH", "/tmp/testshred/" + str(uuid4()))
+    device = shred.osstat(str(data_dir)).st_dev
+    assert shred.read_shred_throughputs() == {}
+    shred.record_shred_throughput({device: 100.0, device + 1: 50.0})
+    assert shred.read_shred_throughputs() == {"DS-0e5b2f33-7c4e-4d6b-9c47-5a2f0f6d8f7e": 100.0}
+    # Averaged with the rate recorded before
+    shred.record_shred_throughput({device: 50.0})
+    assert shred.read_shred_throughputs() == {"DS-0e5b2f33-7c4e-4d6b-9c47-5a2f0f6d8f7e": 75.0}
+
+
+def test_get_jobs(monkeypatch):
+    shred.ensure_hdfs()
+    test_job_id = str(uuid4())
+    shred.persist_job_info(test_job_id, "master", shred.stage_1, shred.status_init)
+    assert test_job_id not in shred.get_jobs(shred.stage_2)
+    shred.persist_job_info(test_job_id, "master", shred.stage_1, shred.status_success)
+    assert test_job_id in shred.get_jobs(shred.stage_2)
+    assert test_job_id not in shred.get_jobs(shred.stage_3)
+    shred.persist_job_info(test_job_id, "master", shred.stage_2, shred.status_success)
+    assert test_job_id not in shred.get_jobs(shred.stage_2)
+    assert test_job_id in shred.get_jobs(shred.stage_4)
+    index_path = ospathjoin(shred.conf.HDFS_SHRED_PATH, "index")
+    assert shred.hdfs.status(ospathjoin(index_path, "s1-success", test_job_id), strict=False) is None
+    # Stale markers are ignored and removed
+    stale_marker = ospathjoin(index_path, "s1-success", test_job_id)
+    shred.hdfs.write(stale_marker, "", overwrite=True)
+    assert test_job_id not in shred.get_jobs(shred.stage_2)
+    assert shred.hdfs.status(stale_marker, strict=False) is None
+    # A leader task is taken over by another worker once it has been started for longer than a lease lasts
+    abandoned_job_id = str(uuid4())
+    shred.persist_job_info(abandoned_job_id, "master", shred.stage_4, shred.status_init)
+    master_path = ospathjoin(shred.conf.HDFS_SHRED_PATH, "jobs", abandoned_job_id)
+    monkeypatch.setattr(shred, "time", lambda: shred.hdfs.status(master_path)['modificationTime'] / 1000.0 + 60)
+    assert abandoned_job_id not in shred.get_jobs(shred.stage_4)
+    monkeypatch.setattr(shred.conf, "LEADER_WAIT", 0.5)
+    assert abandoned_job_id in shred.get_jobs(shred.stage_4)
+    assert abandoned_job_id not in shred.get_jobs(shred.stage_3)
+    # The scan of every job finds the same jobs as the index
+    monkeypatch.setattr(shred.conf, "JOB_INDEX", False)
+    monkeypatch.setattr(shred.conf, "JOB_SCAN_PAGE_SIZE", 2)
+    assert test_job_id in shred.get_jobs(shred.stage_3)
+    assert test_job_id not in shred.get_jobs(shred.stage_2)
+    assert abandoned_job_id in shred.get_jobs(shred.stage_4)
+    monkeypatch.setattr(shred.conf, "LEADER_WAIT", 15)
+    assert abandoned_job_id not in shred.get_jobs(shred.stage_4)
+    assert shred.parse_job_id(test_job_id) == test_job_id
+    assert shred.parse_job_id("_built") is None
+
+
+def test_run_job_stages_concurrently(monkeypatch):
+    job_list = [str(uuid4()) for _ in range(6)]
+    in_flight = []
+    peak = []
+    in_flight_lock = Lock()
+
+    def slow_job_stage(stage, job, worker, deferred=False):
+        with in_flight_lock:
+            in_flight.append(job)
+            peak.append(len(in_flight))
+        sleep(0.2)
+        with in_flight_lock:
+            in_flight.remove(job)
+
+    monkeypatch.setattr(shred, "get_jobs", lambda stage: job_list)
+    monkeypatch.setattr(shred, "run_job_stage", slow_job_stage)
+    monkeypatch.setattr(shred, "retrieve_job_info",
+                        lambda job, component, strict=True: shred.stage_4 + "-" + shred.status_success)
+    monkeypatch.setattr(shred.conf, "MAX_JOBS_IN_FLIGHT", 3)
+    assert shred.run_stage_tasks(shred.stage_4) == shred.status_success
+    assert len(peak) == len(job_list)
+    assert max(peak) == 3
+
+
+def test_run_job_stages_shutdown(monkeypatch):
+    # Jobs finish once shutdown is requested, or after five seconds if the signal is held off until they finish
+    def waiting_job_stage(stage, job, worker, deferred=False):
+        deadline = time() + 5
+        while not shred.shutdown_requested.is_set() and time() < deadline:
+            sleep(0.05)
+
+    monkeypatch.setattr(shred, "get_jobs", lambda stage: [str(uuid4()) for _ in range(2)])
+    monkeypatch.setattr(shred, "run_job_stage", waiting_job_stage)
+    previous_handler = signal(SIGALRM, shred.request_shutdown)
+    try:
+        start_time = time()
+        setitimer(ITIMER_REAL, 0.3)
+        assert shred.run_stage_tasks(shred.stage_5) == shred.status_skip
+        assert time() - start_time < 3
+    finally:
+        signal(SIGALRM, previous_handler)
+        shred.shutdown_requested.clear()
+
+
+def test_find_stragglers(monkeypatch):
+    shred.ensure_hdfs()
+    monkeypatch.setattr(shred.conf, "HDFS_SHRED_PATH", "/tmp/testshred/" + str(uuid4()))
+    monkeypatch.setattr(shred.conf, "STRAGGLER_DEADLINE", 10)
+    job = str(uuid4())
+    shred.persist_job_info(job, "worker_172.16.0.80_linked_shard_dict", shred.stage_5, {"blk_1": shred.status_init})
+    checkpoint_time = shred.hdfs.status(ospathjoin(
+        shred.conf.HDFS_SHRED_PATH, "store", job, "worker_172.16.0.80_linked_shard_dict"))['modificationTime'] / 1000.0
+    waiting_nodes = ["172.16.0.40", "172.16.0.80"]
+    wait_start = checkpoint_time - 700
+    assert shred.find_stragglers(job, waiting_nodes, wait_start, now=wait_start + 300) == []
+    # Only the worker that has not checkpointed since the leader started waiting is a straggler
+    assert shred.find_stragglers(job, waiting_nodes, wait_start, now=checkpoint_time + 30) == ["172.16.0.40"]
+    assert shred.find_stragglers(job, waiting_nodes, wait_start, now=checkpoint_time + 601) == waiting_nodes
+    # A heartbeat between checkpoints also counts as progress
+    heartbeat_path = ospathjoin(shred.conf.HDFS_SHRED_PATH, "store", job, "worker_172.16.0.40_heartbeat")
+    shred.hdfs.write(heartbeat_path, shred.dumps(shred.stage_3), overwrite=True)
+    heartbeat_time = shred.hdfs.status(heartbeat_path)['modificationTime'] / 1000.0
+    assert shred.find_stragglers(job, waiting_nodes, wait_start, now=heartbeat_time + 30) == []
+    monkeypatch.setattr(shred.conf, "STRAGGLER_DEADLINE", 0)
+    assert shred.find_stragglers(job, waiting_nodes, wait_start, now=checkpoint_time + 601) == []
+
+
+def test_worker_heartbeat(monkeypatch):
+    shred.ensure_hdfs()
+    monkeypatch.setattr(shred.conf, "WORKER_HEARTBEAT", 0.05)
+    job = str(uuid4())
+    heartbeat_path = ospathjoin(shred.conf.HDFS_SHRED_PATH, "store", job, "worker_172.16.0.40_heartbeat")
+    with shred.worker_heartbeat(job, "172.16.0.40", shred.stage_5):
+        sleep(0.2)
+        first_beat = shred.hdfs.status(heartbeat_path)['modificationTime']
+        sleep(0.2)
+        assert shred.hdfs.status(heartbeat_path)['modificationTime'] > first_beat
+    with shred.hdfs.read(heartbeat_path) as reader:
+        assert loads(reader.read()) == shred.stage_5
+    # Stopped with the work it covers
+    last_beat = shred.hdfs.status(heartbeat_path)['modificationTime']
+    sleep(0.2)
+    assert shred.hdfs.status(heartbeat_path)['modificationTime'] == last_beat
+
+
+def test_deferred_jobs(monkeypatch):
+    shred.ensure_hdfs()
+    monkeypatch.setattr(shred.conf, "HDFS_SHRED_PATH", "/tmp/testshred/" + str(uuid4()))
+    job = str(uuid4())
+    worker = "172.16.0.40"
+    assert shred.get_deferred_jobs(shred.stage_3, worker) == []
+    shred.defer_workers(job, shred.stage_3, [worker])
+    assert shred.retrieve_job_info(job, "deferred_worker_list") == [worker]
+    assert shred.get_deferred_jobs(shred.stage_3, worker) == [job]
+    assert shred.get_deferred_jobs(shred.stage_3, "172.16.0.80") == []
+    # Linking is followed by shredding whatever its result, and a failed shred is retried
+    shred.advance_deferred_job(job, shred.stage_3, worker, shred.status_fail)
+    assert shred.get_deferred_jobs(shred.stage_3, worker) == []
+    assert shred.get_deferred_jobs(shred.stage_5, worker) == [job]
+    shred.advance_deferred_job(job, shred.stage_5, worker, shred.status_fail)
+    assert shred.get_deferred_jobs(shred.stage_5, worker) == [job]
+    assert shred.get_pending_deferred_workers(job, [worker, "172.16.0.80"]) == [worker]
+    shred.advance_deferred_job(job, shred.stage_5, worker, shred.status_success)
+    assert shred.get_deferred_jobs(shred.stage_5, worker) == []
+    assert shred.get_pending_deferred_workers(job, [worker]) == []
+    shred.flush_job_info(job)
+
+
+def test_leader_worker_failed(monkeypatch):
+    shred.ensure_hdfs()
+    monkeypatch.setattr(shred.conf, "HDFS_SHRED_PATH", "/tmp/testshred/" + str(uuid4()))
+    leader = shred.get_worker_identity()
+    job = str(uuid4())
+    shred.persist_job_info(job, "worker_list", shred.stage_2, ["172.16.0.40", "172.16.0.80"])
+    shred.persist_job_info(job, "worker_" + leader + "_status", shred.stage_3, shred.status_success)
+    shred.persist_job_info(job, "worker_172.16.0.40_status", shred.stage_3, shred.status_fail)
+    shred.persist_job_info(job, "worker_172.16.0.80_status", shred.stage_3, shred.status_init)
+    shred.persist_job_info(job, "master", shred.stage_2, shred.status_success)
+    shred.flush_job_info(job)
+    shred.report_to_barrier(job, shred.stage_3, "172.16.0.40", shred.status_fail)
+    barrier_waits = []
+    monkeypatch.setattr(shred, "wait_for_barrier", lambda *args: barrier_waits.append(args))
+    # The stage fails on the failed worker without waiting on the one still linking
+    shred.run_job_stage(shred.stage_4, job, leader)
+    assert shred.retrieve_job_info(job, "master") == shred.stage_4 + "-" + shred.status_fail
+    assert barrier_waits == []
+    assert shred.zk.exists(shred.get_barrier_path(job, shred.stage_3)) is None
+
+
+def test_close_deferred_job(monkeypatch):
+    shred.ensure_hdfs()
+    monkeypatch.setattr(shred.conf, "HDFS_SHRED_PATH", "/tmp/testshred/" + str(uuid4()))
+    leader = shred.get_worker_identity()
+    deferred_worker = "172.16.0.40"
+    job = str(uuid4())
+    shred.persist_job_info(job, "worker_list", shred.stage_2, [leader, deferred_worker])
+    shred.persist_job_info(job, "worker_" + leader + "_status", shred.stage_5, shred.status_success)
+    shred.defer_workers(job, shred.stage_5, [deferred_worker])
+    shred.persist_job_info(job, "master", shred.stage_4, shred.status_success)
+    shred.flush_job_info(job)
+    # The job stays open, and is found by the next leader, while the deferred worker has shards to shred
+    shred.run_job_stage(shred.stage_6, job, leader)
+    assert shred.retrieve_job_info(job, "master") == shred.stage_6 + "-" + shred.status_deferred
+    assert job in shred.get_jobs(shred.stage_6)
+    assert job not in shred.get_jobs(shred.stage_5)
+    shred.advance_deferred_job(job, shred.stage_5, deferred_worker, shred.status_success)
+    shred.run_job_stage(shred.stage_6, job, leader)
+    assert shred.retrieve_job_info(job, "master") == shred.stage_6 + "-" + shred.status_success
+    assert job not in shred.get_jobs(shred.stage_6)
+
+
+def test_run_deferred_job_stages(tmpdir, monkeypatch):
+    shred.ensure_hdfs()
+    monkeypatch.setattr(shred.conf, "HDFS_SHRED_PATH", "/tmp/testshred/" + str(uuid4()))
+    data_dir = tmpdir.mkdir("data")
+    data_dir.mkdir("current").join("blk_1073839025").write("shard")
+    monkeypatch.setattr(shred.conf, "HDFS_ROOT", str(data_dir))
+    monkeypatch.setattr(shred.conf, "SHARD_INDEX_PATH", str(tmpdir.join("shard_index.json")))
+    monkeypatch.setattr(shred.conf, "SHRED_ENGINE", "native")
+    monkeypatch.setattr(shred.conf, "SHRED_COUNT", 1)
+    monkeypatch.setattr(shred, "shard_index", None)
+    monkeypatch.setattr(shred, "find_mount_point", lambda file_path, mount_points=None: str(tmpdir))
+    worker = "172.16.0.40"
+    # The DataNode removed the blocks of the second job, and one of the first, before the worker returned
+    job = str(uuid4())
+    gone_job = str(uuid4())
+    shred.persist_job_info(job, "worker_" + worker + "_source_shard_dict", shred.stage_2,
+                           {"blk_1073839025": shred.status_no_init, "blk_1073839026": shred.status_no_init})
+    shred.persist_job_info(gone_job, "worker_" + worker + "_source_shard_dict", shred.stage_2,
+                           {"blk_1073839027": shred.status_no_init})
+    for deferred_job in [job, gone_job]:
+        shred.defer_workers(deferred_job, shred.stage_3, [worker])
+        shred.run_job_stage(shred.stage_3, deferred_job, worker, deferred=True)
+    source_shard_dict = shred.retrieve_job_info(job, "worker_" + worker + "_source_shard_dict")
+    assert source_shard_dict["blk_1073839026"] == shred.status_fail
+    assert sorted(shred.get_deferred_jobs(shred.stage_5, worker)) == sorted([job, gone_job])
+    # The shards that were linked are shredded and both jobs leave the queue
+    for deferred_job in [job, gone_job]:
+        shred.run_job_stage(shred.stage_5, deferred_job, worker, deferred=True)
+    assert shred.get_deferred_jobs(shred.stage_5, worker) == []
+    assert not isfile(str(tmpdir.join(shred.conf.LINUXFS_SHRED_PATH, job, "blk_1073839025")))
+
+
+def test_order_leader_jobs():
+    job_list = [str(uuid4()) for _ in range(20)]
+    first_order = shred.order_leader_jobs(job_list, "172.16.0.80")
+    assert sorted(first_order) == sorted(job_list)
+    assert shred.order_leader_jobs(list(reversed(job_list)), "172.16.0.80") == first_order
+    # Each worker starts from a different job
+    first_jobs = set(shred.order_leader_jobs(job_list, "172.16.0.{0}".format(node))[0] for node in range(1, 13))
+    assert len(first_jobs) > 1
+
+
+def test_find_shard(tmpdir, monkeypatch):
+    data_dir = tmpdir.mkdir("data")
+    block_dir = data_dir.mkdir("current").mkdir("finalized").mkdir("subdir0")
+    block_dir.join("blk_1073839025").write("shard")
+    block_dir.join("blk_1073839025_98201.meta").write("meta")
+    monkeypatch.setattr(shred.conf, "HDFS_ROOT", str(data_dir))
+    monkeypatch.setattr(shred.conf, "SHARD_INDEX_PATH", str(tmpdir.join("shard_index.json")))
+    monkeypatch.setattr(shred, "shard_index", None)
+    assert shred.find_shard("blk_1073839025") == str(block_dir.join("blk_1073839025"))
+    assert "blk_1073839025_98201.meta" not in shred.shard_index['blocks']
+    assert isfile(str(tmpdir.join("shard_index.json")))
+    # A block added after the index was built is found by the rescan on a miss
+    new_dir = block_dir.mkdir("subdir1")
+    new_dir.join("blk_1073839026").write("shard")
+    assert shred.find_shard("blk_1073839026") == str(new_dir.join("blk_1073839026"))
+    # The index persisted on disk is reused by the next run
+    monkeypatch.setattr(shred, "shard_index", None)
+    index = shred.load_shard_index()
+    assert index['blocks']["blk_1073839026"] == str(new_dir.join("blk_1073839026"))
+    with pytest.raises(Exception):
+        shred.find_shard("blk_1")
+
+
+def test_shred_shards(tmpdir, monkeypatch):
+    monkeypatch.setattr(shred.conf, "SHRED_COUNT", 1)
+    monkeypatch.setattr(shred.conf, "SHRED_WORKERS_PER_DEVICE", 2)
+    shards = []
+    for i in range(4):
+        shard = tmpdir.join("blk_10000" + str(i))
+        shard.write("x" * 4096)
+        shards.append(str(shard))
+    missing = str(tmpdir.join("blk_missing"))
+    reported = {}
+    result = shred.shred_shards(shards + [missing], lambda shard, status: reported.update({shard: status}))
+    assert result[missing] == shred.status_fail
+    # Each shard is reported as it completes
+    assert reported == result
+    for shard in shards:
+        assert result[shard] == shred.status_success
+        assert not isfile(shard)
+    # Shards not started before shutdown are left in place and out of the results
+    shard = tmpdir.join("blk_100010")
+    shard.write("x" * 4096)
+    shred.shutdown_requested.set()
+    try:
+        result = shred.shred_shards([str(shard)])
+    finally:
+        shred.shutdown_requested.clear()
+    assert result == {}
+    assert isfile(str(shard))
+
+
+def test_link_shards(tmpdir, monkeypatch):
+    volumes = [tmpdir.mkdir("disk1"), tmpdir.mkdir("disk2")]
+    mountinfo = tmpdir.join("mountinfo")
+    mountinfo.write("".join("3{0} 22 8:1 / {1} rw - ext4 /dev/sd{0} rw\n".format(i, volume)
+                            for i, volume in enumerate(volumes)))
+    monkeypatch.setattr(shred, "mountinfo_path", str(mountinfo))
+    monkeypatch.setattr(shred.conf, "HDFS_ROOT", ",".join(str(volume.join("dn")) for volume in volumes))
+    shards = []
+    for i, volume in enumerate(volumes):
+        shard_file = volume.mkdir("dn").join("blk_10000" + str(i))
+        shard_file.write("x")
+        shards.append((shard_file.basename, str(shard_file)))
+    # A link left by a run that stopped before its checkpoint is taken as done
+    volumes[0].mkdir(shred.conf.LINUXFS_SHRED_PATH).mkdir("job")
+    shred.link(shards[0][1], str(volumes[0].join(shred.conf.LINUXFS_SHRED_PATH, "job", shards[0][0])))
+    reported = []
+    result = shred.link_shards("job", shards + [("blk_missing", str(volumes[1].join("dn", "blk_missing")))],
+                               lambda shard, linked_path, status: reported.append((shard, linked_path, status)))
+    assert result == {"blk_100000": shred.status_success, "blk_100001": shred.status_success,
+                      "blk_missing": shred.status_fail}
+    assert len(reported) == 3
+    for i, volume in enumerate(volumes):
+        linked_path = str(volume.join(shred.conf.LINUXFS_SHRED_PATH, "job", shards[i][0]))
+        assert (shards[i][0], linked_path, shred.status_success) in reported
+        assert shred.osstat(linked_path).st_ino == shred.osstat(shards[i][1]).st_ino
+
+
+def test_checkpoint_due(monkeypatch):
+    monkeypatch.setattr(shred.conf, "CHECKPOINT_SHARDS", 3)
+    monkeypatch.setattr(shred.conf, "CHECKPOINT_SECONDS", 60)
+    monkeypatch.setattr(shred.conf, "CHECKPOINT_MIN_INTERVAL", 10)
+    checkpoint = {'shards': 0, 'written': 1000}
+    assert not shred.checkpoint_due(checkpoint, 1020)
+    assert not shred.checkpoint_due(checkpoint, 1020)
+    assert shred.checkpoint_due(checkpoint, 1020)
+    # Never written more often than the minimum interval, however many shards complete
+    checkpoint = {'shards': 0, 'written': 1000}
+    for _ in range(5):
+        assert not shred.checkpoint_due(checkpoint, 1005)
+    assert shred.checkpoint_due(checkpoint, 1010)
+    # A slow shard is still checkpointed after the time limit
+    checkpoint = {'shards': 0, 'written': 1000}
+    assert shred.checkpoint_due(checkpoint, 1060)
+
+
+def test_persist_shard_dicts():
+    shred.ensure_hdfs()
+    test_job_id = str(uuid4())
+    checkpoint = shred.new_checkpoint()
+    checkpoint['shards'] = 5
+    shred.persist_shard_dicts(test_job_id, "a", shred.stage_3, {"blk_1": shred.status_success},
+                              {"/data/.shred/blk_1": shred.status_no_init}, checkpoint)
+    assert checkpoint['shards'] == 0
+    assert shred.retrieve_job_info(test_job_id, "worker_a_source_shard_dict") == {"blk_1": shred.status_success}
+    shred.persist_shard_dicts(test_job_id, "a", shred.stage_5, {"/data/.shred/blk_1": shred.status_init})
+    assert shred.retrieve_job_info(test_job_id, "worker_a_linked_shard_dict") == {
+        "/data/.shred/blk_1": shred.status_init}
+    with pytest.raises(Exception):
+        shred.persist_shard_dicts(test_job_id, "a", shred.stage_4, {})
+
+
+def test_write_metrics(tmpdir, monkeypatch):
+    monkeypatch.setattr(shred, "metrics", {})
+    monkeypatch.setattr(shred.conf, "METRICS_TEXTFILE_DIR", str(tmpdir))
+    monkeypatch.setattr(shred.conf, "METRICS_BUCKETS", [0.1, 1])
+    shred.inc_metric('shred_stage_jobs_total', labels={'stage': shred.stage_2})
+    shred.inc_metric('shred_stage_jobs_total', 2, {'stage': shred.stage_2})
+    shred.set_metric('shred_shred_throughput_mb_per_second', 12.5)
+    shred.observe_metric('shred_hdfs_request_seconds', 0.05, {'operation': 'read'})
+    shred.observe_metric('shred_hdfs_request_seconds', 0.5, {'operation': 'read'})
+    shred.write_metrics("worker")
+    lines = tmpdir.join("shred_worker.prom").read().splitlines()
+    assert '# TYPE shred_stage_jobs_total counter' in lines
+    assert 'shred_stage_jobs_total{mode="worker",stage="s2"} 3' in lines
+    assert 'shred_shred_throughput_mb_per_second{mode="worker"} 12.5' in lines
+    assert 'shred_hdfs_request_seconds_bucket{le="0.1",mode="worker",operation="read"} 1' in lines
+    assert 'shred_hdfs_request_seconds_bucket{le="1",mode="worker",operation="read"} 2' in lines
+    assert 'shred_hdfs_request_seconds_bucket{le="+Inf",mode="worker",operation="read"} 2' in lines
+    assert 'shred_hdfs_request_seconds_count{mode="worker",operation="read"} 2' in lines
+
+
+def test_trace_span(tmpdir, monkeypatch):
+    trace_path = str(tmpdir.join("trace.jsonl"))
+    monkeypatch.setattr(shred, "trace_file", open(trace_path, 'a'))
+
+    def failing_job_stage(stage, job):
+        with shred.trace_span('find_shard', {'shard': "blk_1"}):
+            pass
+        list(shred.trace_iter('shell', iter(["line\n"]), {'command': "hdfs"}))
+        with shred.trace_span('link_shard'):
+            raise OSError("link failed")
+
+    with pytest.raises(OSError):
+        shred.run_traced('job', failing_job_stage, (shred.stage_3, "job1"), {'job': "job1", 'stage': shred.stage_3})
+    # The context of the job is only kept while it runs
+    assert shred.get_trace_context() == {'job': None, 'stage': None}
+    shred.stop_profiling()
+    spans = [loads(line) for line in open(trace_path)]
+    assert [span['op'] for span in spans] == ['find_shard', 'shell', 'link_shard', 'job']
+    assert all(span['job'] == "job1" and span['stage'] == shred.stage_3 for span in spans)
+    assert spans[0]['shard'] == "blk_1"
+    assert spans[1]['command'] == "hdfs"
+    assert spans[2]['error'] == "OSError"
+    assert spans[3]['seconds'] >= 0
+
+
+def test_write_stage_profile(tmpdir, monkeypatch):
+    monkeypatch.setattr(shred, "profile_stats_dir", str(tmpdir))
+    for job in ["job1", "job2"]:
+        shred.run_traced('job', shred.get_worker_identity, (), {'job': job, 'stage': shred.stage_3})
+    assert len(shred.stage_profiles) == 2
+    shred.write_stage_profile(shred.stage_3)
+    assert shred.stage_profiles == []
+    stats_files = tmpdir.listdir()
+    assert len(stats_files) == 1
+    assert stats_files[0].basename.startswith("shred_s3_")
+    stats = shred.pstats.Stats(str(stats_files[0]))
+    assert [stat[0][2] == "get_worker_identity" for stat in stats.stats.items()].count(True) == 1
+    assert [stat[1][0] for stat in stats.stats.items() if stat[0][2] == "get_worker_identity"] == [2]
+
+
+def test_get_daemon_delay(monkeypatch):
+    monkeypatch.setattr(shred.conf, "DAEMON_INTERVAL", 60)
+    monkeypatch.setattr(shred.conf, "DAEMON_JITTER", 10)
+    monkeypatch.setattr(shred.conf, "DAEMON_MAX_INTERVAL", 300)
+    assert 60 <= shred.get_daemon_delay(0) <= 70
+    assert 120 <= shred.get_daemon_delay(1) <= 130
+    assert 300 <= shred.get_daemon_delay(1000) <= 310
+
+
+def test_get_scheduled_shred_rate(monkeypatch):
+    monkeypatch.setattr(shred.conf, "SHRED_RATE_LIMIT", 100)
+    monkeypatch.setattr(shred.conf, "SHRED_RATE_SCHEDULE", [(8, 18, 10), (22, 6, 0)])
+    assert shred.get_scheduled_shred_rate(shred.datetime(2017, 1, 1, 9)) == 10
+    assert shred.get_scheduled_shred_rate(shred.datetime(2017, 1, 1, 18)) == 100
+    assert shred.get_scheduled_shred_rate(shred.datetime(2017, 1, 1, 23)) == 0
+    assert shred.get_scheduled_shred_rate(shred.datetime(2017, 1, 1, 3)) == 0
+
+
+def test_throttle_device(tmpdir, monkeypatch):
+    sleeps = []
+    diskstats = tmpdir.join("diskstats")
+    diskstats.write("   8       1 sda1 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0\n")
+    device = makedev(8, 1)
+    monkeypatch.setattr(shred, "sleep", lambda seconds: sleeps.append(seconds))
+    monkeypatch.setattr(shred, "device_buckets", {})
+    monkeypatch.setattr(shred, "diskstats_path", str(diskstats))
+    monkeypatch.setattr(shred.conf, "SHRED_RATE_SCHEDULE", [])
+    monkeypatch.setattr(shred.conf, "SHRED_RATE_LIMIT", 1000000)
+    monkeypatch.setattr(shred.conf, "SHRED_UTIL_SAMPLE_SECONDS", 0)
+    # A second of writes is taken from the full bucket, then the next second's writes wait for it to refill
+    shred.throttle_device(device, 1000000)
+    assert sleeps == []
+    shred.throttle_device(device, 1000000)
+    assert 0.9 < sleeps[-1] <= 1
+    # A busy device halves the rate, so the bucket refills more slowly
+    shred.device_buckets[device]['sampled'] -= 1
+    diskstats.write("   8       1 sda1 0 0 0 0 0 0 0 0 0 1000 0 0 0 0 0\n")
+    shred.throttle_device(device, 500000)
+    assert shred.device_buckets[device]['factor'] == 0.5
+    assert 1.9 < sleeps[-1] <= 3
+    monkeypatch.setattr(shred.conf, "SHRED_RATE_LIMIT", 0)
+    shred.throttle_device(device, 1000000)
+    assert len(sleeps) == 2
+
+
+def test_native_shred_shard(tmpdir, monkeypatch):
+    monkeypatch.setattr(shred.conf, "SHRED_ENGINE", "native")
+    monkeypatch.setattr(shred.conf, "SHRED_COUNT", 2)
+    monkeypatch.setattr(shred.conf, "SHRED_BUFFER_SIZE", 65536)
+    # Larger than the buffer and not a multiple of the block size
+    shard = tmpdir.join("blk_1073839025")
+    shard.write("x" * 200001)
+    assert shred.shred_shard(str(shard)) is None
+    assert not isfile(str(shard))
+    assert shred.shred_shard(str(shard)) is not None
+    # The thread's buffer is reused for its next shard
+    buf = shred.shred_buffers.buf
+    shard.write("x" * 4096)
+    assert shred.shred_shard(str(shard)) is None
+    assert shred.shred_buffers.buf is buf
+
+
+def test_random_stream(monkeypatch):
+    next_random = shred.hash_stream()
+    first = next_random(100)
+    second = next_random(100)
+    assert len(first) == len(second) == 100
+    assert first != second
+    assert shred.hash_stream()(100) != first
+    # Without the cryptography module the source timed quicker on this node is used
+    monkeypatch.setitem(sys.modules, "cryptography.hazmat.primitives.ciphers", None)
+    monkeypatch.setattr(shred, "fallback_random_source", None)
+    assert shred.get_fallback_random_source(65536) in ['urandom', 'hash']
+    monkeypatch.setattr(shred, "fallback_random_source", "hash")
+    assert shred.random_stream(65536) is not shred.urandom
+    assert len(shred.random_stream(65536)(65536)) == 65536
+    monkeypatch.setattr(shred, "fallback_random_source", "urandom")
+    assert shred.random_stream(65536) is shred.urandom
 
 
-@pytest.mark.skip
 def test_persist_job_info():
-    # No test written
-    pass
+    shred.ensure_hdfs()
+    test_job_id = str(uuid4())
+    journal_dir = ospathjoin(shred.conf.HDFS_SHRED_PATH, "store", test_job_id, "journal")
+    shred.persist_job_info(test_job_id, "data_status", shred.stage_1, shred.status_init)
+    shred.persist_job_info(test_job_id, "data_status", shred.stage_1, shred.status_success)
+    shred.persist_job_info(test_job_id, "worker_list", shred.stage_2, ["172.16.0.80"])
+    # Journal entries are held until flushed, but are visible to this process meanwhile
+    assert shred.hdfs.status(journal_dir, strict=False) is None
+    assert shred.retrieve_job_info(test_job_id, "data_status") == shred.stage_1 + "-" + shred.status_success
+    shred.flush_job_info(test_job_id)
+    # One journal each for the client and worker roles
+    assert len(shred.hdfs.list(journal_dir)) == 2
+    shred.persist_job_info(test_job_id, "master", shred.stage_1, shred.status_success)
+    shred.persist_job_info(test_job_id, "worker_172.16.0.80_source_shard_dict", shred.stage_2,
+                           {"blk_1073839025": shred.status_no_init})
+    shard_dict_path = ospathjoin(shred.conf.HDFS_SHRED_PATH, "store", test_job_id,
+                                 "worker_172.16.0.80_source_shard_dict")
+    assert shred.hdfs.status(shard_dict_path, strict=False) is not None
 
 
-@pytest.mark.skip
-def test_retrieve_job_info():
-    # No test written
-    pass
+def test_flush_job_info(monkeypatch):
+    shred.ensure_hdfs()
+    test_job_id = str(uuid4())
+    journal_path = ospathjoin(shred.conf.HDFS_SHRED_PATH, "store", test_job_id, "journal",
+                              shred.get_journal_name(shred.stage_3))
+    hdfs_write = shred.hdfs.write
+    writes = []
+
+    def counted_write(hdfs_path, data=None, overwrite=False, append=False):
+        writes.append((overwrite, append))
+        return hdfs_write(hdfs_path, data, overwrite=overwrite, append=append)
+
+    monkeypatch.setattr(shred.hdfs, "write", counted_write)
+    # A new journal is created with its first entries, then appended to
+    shred.persist_job_info(test_job_id, "worker_172.16.0.80_status", shred.stage_3, shred.status_init)
+    shred.flush_job_info(test_job_id)
+    shred.persist_job_info(test_job_id, "worker_172.16.0.80_status", shred.stage_3, shred.status_success)
+    shred.flush_job_info(test_job_id)
+    assert writes == [(False, False), (False, True)]
+    # An overlapping run appends to the same journal; its entries survive this run compacting the journal
+    hdfs_write(journal_path, shred.dumps({'c': "worker_172.16.0.40_status", 'v': "s3-success", 't': 0, 's': 0}) + "\n",
+               append=True)
+    monkeypatch.setattr(shred.conf, "JOURNAL_COMPACT_ENTRIES", 2)
+    shred.persist_job_info(test_job_id, "worker_172.16.0.80_status", shred.stage_4, shred.status_init)
+    shred.flush_job_info(test_job_id)
+    assert writes[-1] == (True, False)
+    with shred.hdfs.read(journal_path) as reader:
+        state = shred.get_journal_state(shred.parse_journal(reader.read()))
+    assert state["worker_172.16.0.40_status"]['v'] == "s3-success"
+    assert state["worker_172.16.0.80_status"]['v'] == "s4-init"
+
+
+def test_retrieve_job_info(monkeypatch):
+    shred.ensure_hdfs()
+    test_job_id = str(uuid4())
+    assert shred.retrieve_job_info(test_job_id, "data_status", strict=False) is None
+    with pytest.raises(Exception):
+        shred.retrieve_job_info(test_job_id, "data_status")
+    shred.persist_job_info(test_job_id, "data_status", shred.stage_1, shred.status_init)
+    shred.flush_job_info(test_job_id)
+    shred.persist_job_info(test_job_id, "data_status", shred.stage_4, shred.status_success)
+    shred.flush_job_info(test_job_id)
+    assert shred.retrieve_job_info(test_job_id, "data_status") == shred.stage_4 + "-" + shred.status_success
+    assert shred.retrieve_job_info(test_job_id, "worker_list", strict=False) is None
+    # A failed append to an existing journal is raised rather than retried as a new file
+    hdfs_write = shred.hdfs.write
+
+    def failing_append(hdfs_path, data=None, overwrite=False, append=False):
+        if append:
+            raise shred.HdfsError("Failed to APPEND_FILE: lease is held by another client")
+        return hdfs_write(hdfs_path, data, overwrite=overwrite)
+
+    monkeypatch.setattr(shred.hdfs, "write", failing_append)
+    shred.persist_job_info(test_job_id, "data_status", shred.stage_4, shred.status_init)
+    with pytest.raises(shred.HdfsError) as excinfo:
+        shred.flush_job_info(test_job_id)
+    assert "lease" in str(excinfo.value)
+    monkeypatch.undo()
+    # Jobs from before journals were used are read from a file per component
+    legacy_job_id = str(uuid4())
+    shred.hdfs.write(ospathjoin(shred.conf.HDFS_SHRED_PATH, "store", legacy_job_id, "data_status"),
+                     shred.dumps(shred.stage_1 + "-" + shred.status_success))
+    assert shred.retrieve_job_info(legacy_job_id, "data_status") == shred.stage_1 + "-" + shred.status_success
+
+
+def test_shard_table(monkeypatch):
+    shard_dict = {"/grid/0/.shred/job/blk_1073839025": shred.status_no_init,
+                  "/grid/0/.shred/job/blk_1073839026": shred.status_success,
+                  "/grid/1/.shred/job/blk_1073839027": shred.status_fail}
+    table = shred.ShardTable(shard_dict)
+    assert len(table) == 3
+    assert dict(table.items()) == shard_dict
+    table["/grid/0/.shred/job/blk_1073839025"] = shred.status_init
+    table["/grid/1/.shred/job/blk_1073839001"] = shred.status_no_init
+    assert table["/grid/0/.shred/job/blk_1073839025"] == shred.status_init
+    assert "/grid/1/.shred/job/blk_1073839001" in table
+    assert "/grid/2/.shred/job/blk_1073839025" not in table
+    with pytest.raises(KeyError):
+        table["blk_1"]
+    with pytest.raises(ValueError):
+        table["/grid/0/blk_1073839025.meta"] = shred.status_init
+    decoded = shred.ShardTable.decode(table.encode())
+    assert dict(decoded.items()) == dict(table.items())
+    # Read back transparently beside JSON shard dicts, falling back to JSON for keys a table can't hold
+    shred.ensure_hdfs()
+    test_job_id = str(uuid4())
+    monkeypatch.setattr(shred.conf, "SHARD_DICT_FORMAT", "table")
+    shred.persist_job_info(test_job_id, "worker_a_linked_shard_dict", shred.stage_3, shard_dict)
+    shred.persist_job_info(test_job_id, "worker_b_linked_shard_dict", shred.stage_3, {"other": shred.status_init})
+    monkeypatch.setattr(shred.conf, "SHARD_DICT_FORMAT", "json")
+    shred.persist_job_info(test_job_id, "worker_c_linked_shard_dict", shred.stage_3, table)
+    result = shred.retrieve_job_info(test_job_id, "worker_a_linked_shard_dict")
+    assert isinstance(result, shred.ShardTable)
+    assert dict(result.items()) == shard_dict
+    assert shred.retrieve_job_info(test_job_id, "worker_b_linked_shard_dict") == {"other": shred.status_init}
+    assert shred.retrieve_job_info(test_job_id, "worker_c_linked_shard_dict") == dict(table.items())
+
+
+def test_retrieve_job_infos():
+    shred.ensure_hdfs()
+    test_job_id = str(uuid4())
+    shred.persist_job_info(test_job_id, "master", shred.stage_2, shred.status_success)
+    shred.persist_job_info(test_job_id, "worker_a_status", shred.stage_3, shred.status_success)
+    shred.flush_job_info(test_job_id)
+    shred.persist_job_info(test_job_id, "worker_b_status", shred.stage_3, shred.status_init)
+    result = shred.retrieve_job_infos(test_job_id, ["master", "worker_a_status", "worker_b_status"])
+    assert result == {
+        "master": shred.stage_2 + "-" + shred.status_success,
+        "worker_a_status": shred.stage_3 + "-" + shred.status_success,
+        "worker_b_status": shred.stage_3 + "-" + shred.status_init,
+    }
+    shred.flush_job_info(test_job_id)
+    assert shred.retrieve_job_infos(test_job_id, ["worker_c_status"], strict=False) == {"worker_c_status": None}
+    with pytest.raises(Exception):
+        shred.retrieve_job_infos(test_job_id, ["worker_c_status"])
+
+
+def test_hdfs_batch():
+    shred.ensure_hdfs()
+    test_path = ospathjoin(shred.conf.HDFS_SHRED_PATH, "batch_" + str(uuid4()))
+    results = shred.hdfs_batch(shred.hdfs.write, [(ospathjoin(test_path, str(i)), str(i)) for i in range(10)])
+    assert results == [None] * 10
+    results = shred.hdfs_batch(shred.hdfs.status, [(ospathjoin(test_path, str(i)),) for i in range(11)])
+    assert [result['length'] for result in results[:10]] == [1] * 10
+    assert isinstance(results[10], shred.HdfsError)
+
+
+def test_delete_job_targets():
+    shred.ensure_hdfs()
+    test_job_id = str(uuid4())
+    holding_pen_path = ospathjoin(shred.conf.HDFS_SHRED_PATH, "store", test_job_id, "data")
+    targets = [ospathjoin(holding_pen_path, "file"), ospathjoin(holding_pen_path, "dir"),
+               ospathjoin(holding_pen_path, "gone")]
+    shred.hdfs.write(targets[0], "testshred")
+    shred.hdfs.write(ospathjoin(targets[1], "part-m-00000"), "testshred")
+    shred.persist_job_info(test_job_id, "data_file_list", shred.stage_1, targets)
+    shred.flush_job_info(test_job_id)
+    assert shred.delete_job_targets(test_job_id) == dict((target, shred.status_success) for target in targets)
+    for target in targets:
+        assert shred.hdfs.status(target, strict=False) is None
+
+
+def test_read_job_file(monkeypatch):
+    shred.ensure_hdfs()
+    test_job_id = str(uuid4())
+    master_path = ospathjoin(shred.conf.HDFS_SHRED_PATH, "jobs", test_job_id)
+    shred.persist_job_info(test_job_id, "master", shred.stage_1, shred.status_init)
+    hits = shred.job_info_cache_stats['hits']
+    assert shred.retrieve_job_info(test_job_id, "master") == shred.stage_1 + "-" + shred.status_init
+    assert shred.job_info_cache_stats['hits'] == hits + 1
+    # Past the TTL content is revalidated, and reread once the file has changed
+    monkeypatch.setattr(shred.conf, "JOB_INFO_CACHE_TTL", 0)
+    shred.hdfs.write(master_path, shred.dumps(shred.stage_1 + "-" + shred.status_success), overwrite=True)
+    assert shred.retrieve_job_info(test_job_id, "master") == shred.stage_1 + "-" + shred.status_success
+    misses = shred.job_info_cache_stats['misses']
+    assert shred.retrieve_job_info(test_job_id, "master") == shred.stage_1 + "-" + shred.status_success
+    assert shred.job_info_cache_stats['misses'] == misses
+    # Reads from concurrent jobs are all counted
+    monkeypatch.setattr(shred.conf, "JOB_INFO_CACHE_TTL", 60)
+    hits = shred.job_info_cache_stats['hits']
+    shred.hdfs_batch(shred.read_job_file, [(master_path,)] * 200, threads=8)
+    assert shred.job_info_cache_stats['hits'] == hits + 200
+    monkeypatch.setattr(shred.conf, "JOB_INFO_CACHE_SIZE", 1)
+    shred.persist_job_info(test_job_id, "master", shred.stage_2, shred.status_init)
+    assert list(shred.job_info_cache.keys()) == [master_path]
 
 
 # ###################          Data fuzzing tests            ##########################